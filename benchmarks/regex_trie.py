@@ -0,0 +1,133 @@
+"""
+Benchmark of the guided regex built from a scene's entity names: flat alternation vs. prefix trie.
+
+Reports, for scenes of increasing size, the regex length, the time to compile it into the
+token-level FSM index used by outlines (with a character-level vocabulary), and the time to match
+commands against the Python re.Pattern.
+
+Usage: python benchmarks/regex_trie.py --sizes 10,100,1000,5000 --max-fsm-size 1000
+"""
+
+import argparse
+import random
+import re
+import time
+from typing import ClassVar
+
+import interegular
+from outlines.fsm.regex import (
+    create_fsm_index_tokenizer,
+    make_byte_level_fsm,
+    make_deterministic_fsm,
+)
+
+from gigax.scene import ParameterType, Skill
+
+SYLLABLES = ["al", "dr", "en", "jo", "hn", "an", "na", "ri", "ka", "mor", "th", "el", "is", "or", "un"]
+
+
+class CharTokenizer:
+    """Printable-ASCII character vocabulary, standing in for a model tokenizer."""
+
+    eos_token_id = 0
+    special_tokens: ClassVar[set[str]] = set()
+
+    def __init__(self):
+        self.vocabulary = {"</s>": 0} | {chr(c): c - 31 for c in range(32, 127)}
+
+    def convert_token_to_string(self, token: str) -> str:
+        return token
+
+
+def random_names(count: int, rng: random.Random) -> list[str]:
+    names: set[str] = set()
+    while len(names) < count:
+        first = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 3))).capitalize()
+        last = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+        names.add(f"{first} {last}")
+    return sorted(names)
+
+
+def flat_regex(skills: list[Skill], characters: list[str], locations: list[str], items: list[str]) -> str:
+    """The guided regex as previously built: one plain alternation per entity parameter."""
+    names = {
+        ParameterType.character: characters,
+        ParameterType.location: locations,
+        ParameterType.item: items,
+    }
+    parts = []
+    for skill in skills:
+        skill_parts = [re.escape(skill.name)]
+        for param in skill.parameter_types:
+            group_name = f"{skill.name}_{param.value[1:-1]}"
+            if param in names:
+                skill_parts.append(f"(?P<{group_name}>{'|'.join(map(re.escape, names[param]))})")
+            elif param == ParameterType.amount:
+                skill_parts.append(f"(?P<{group_name}>\\d+)")
+            elif param == ParameterType.content:
+                skill_parts.append(f'(?P<{group_name}>"[^"]*")')
+        parts.append(r"\s+".join(skill_parts))
+    return "|".join(parts)
+
+
+def trie_regex(skills: list[Skill], characters: list[str], locations: list[str], items: list[str]) -> str:
+    return "|".join(skill.to_regex(characters, locations, items) for skill in skills)
+
+
+def compile_index(pattern: str, tokenizer: CharTokenizer) -> int:
+    fsm = interegular.parse_pattern(pattern).to_fsm().reduce()
+    byte_fsm = make_byte_level_fsm(fsm, keep_utf8=True)
+    regex_fsm, _ = make_deterministic_fsm(byte_fsm)
+    create_fsm_index_tokenizer(regex_fsm, tokenizer)
+    return len(regex_fsm.states)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--matches", type=int, default=1000)
+    parser.add_argument(
+        "--max-fsm-size",
+        type=int,
+        default=1000,
+        help="Skip the FSM compilation above this many entities (it takes minutes to hours)",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    tokenizer = CharTokenizer()
+    skills = [
+        Skill(name="Say", description="", parameter_types=[ParameterType.character, ParameterType.content]),
+        Skill(name="Attack", description="", parameter_types=[ParameterType.character]),
+        Skill(name="Move", description="", parameter_types=[ParameterType.location]),
+        Skill(name="Give", description="", parameter_types=[ParameterType.character, ParameterType.item]),
+    ]
+    compile_index("warm|up", tokenizer)  # Numba JIT compilation
+
+    print(f"{'entities':>8} {'variant':>7} {'regex chars':>12} {'FSM states':>10} {'compile (s)':>11} {'match (us)':>10}")
+    for size in map(int, args.sizes.split(",")):
+        names = random_names(3 * size, rng)
+        characters, locations, items = names[0::3], names[1::3], names[2::3]
+        commands = [
+            f"Give {rng.choice(characters)} {rng.choice(items)}" for _ in range(args.matches)
+        ]
+        for variant, build in [("flat", flat_regex), ("trie", trie_regex)]:
+            pattern = build(skills, characters, locations, items)
+
+            n_states, compile_time = "-", "-"
+            if size <= args.max_fsm_size:
+                start = time.perf_counter()
+                n_states = compile_index(pattern, tokenizer)
+                compile_time = f"{time.perf_counter() - start:.3f}"
+
+            compiled = re.compile(pattern, re.IGNORECASE)
+            start = time.perf_counter()
+            for command in commands:
+                assert compiled.match(command)
+            match_time = (time.perf_counter() - start) / len(commands) * 1e6
+
+            print(f"{size:>8} {variant:>7} {len(pattern):>12} {n_states:>10} {compile_time:>11} {match_time:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
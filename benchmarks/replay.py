@@ -0,0 +1,125 @@
+"""
+Benchmark replaying a trace of NPC steps against a deterministic fake model, without GPU or network.
+
+Record a trace from a real model by wrapping its stepper in gigax.replay.StepRecorder, or generate a
+synthetic one. Each step gets its recorded response from the fake model, after the given per-token
+latency, and the benchmark reports p50/p95/p99 step latency, throughput and the per-phase breakdown
+(prompt, regex, fsm, chat template, decode, parse).
+
+Usage:
+    python benchmarks/replay.py --generate 200 --trace /tmp/trace.jsonl
+    python benchmarks/replay.py --trace /tmp/trace.jsonl --backend api --token-latency 0.001
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+
+from outlines import models
+
+from gigax.fakes import FakeLlama, FakeOpenAIServer
+from gigax.parse import CharacterAction
+from gigax.replay import StepRecorder, load_trace, replay, trace_responder
+from gigax.scene import (
+    Character,
+    Item,
+    Location,
+    ParameterType,
+    ProtagonistCharacter,
+    Skill,
+)
+from gigax.step import NPCStepper
+
+SKILLS = [
+    Skill(name="Say", description="Say something", parameter_types=[ParameterType.character, ParameterType.content]),
+    Skill(name="Attack", description="Attack someone", parameter_types=[ParameterType.character]),
+    Skill(name="Move", description="Go somewhere", parameter_types=[ParameterType.location]),
+]
+
+
+def generate_trace(path: str, steps: int, entities: int, seed: int = 0):
+    """
+    Record a synthetic trace: random scenes, with random (valid) responses.
+    """
+    rng = random.Random(seed)
+    locations = [Location(name=f"Location {i}", description="A place") for i in range(entities)]
+    NPCs = [
+        Character(name=f"Villager {i}", description="A villager", current_location=rng.choice(locations))
+        for i in range(entities)
+    ]
+    items = [Item(name=f"Item {i}", description="A thing") for i in range(entities)]
+    llama = FakeLlama()
+    recorder = StepRecorder(NPCStepper(model=models.LlamaCpp(llama)), path)  # type: ignore
+    events: list[CharacterAction] = []
+
+    async def record():
+        for i in range(steps):
+            npc = rng.choice(NPCs)
+            protagonist = ProtagonistCharacter(
+                name=npc.name,
+                description=npc.description,
+                current_location=npc.current_location,
+                memories=[],
+                quests=[],
+                skills=SKILLS,
+                psychological_profile="Curious",
+            )
+            llama.reply = rng.choice(
+                [
+                    f'Say {rng.choice(NPCs).name} "Hello number {i}"',
+                    f"Attack {rng.choice(NPCs).name}",
+                    f"Move {rng.choice(locations).name}",
+                ]
+            )
+            action = await recorder.get_action(
+                "A vast open world", locations, NPCs, protagonist, items, events[-10:]
+            )
+            events.append(action)
+
+    asyncio.run(record())
+    recorder.close()
+    recorder.stepper.close()
+
+
+async def run(args: argparse.Namespace):
+    trace = load_trace(args.trace)
+    if args.backend == "api":
+        server = FakeOpenAIServer(token_latency=args.token_latency).start()
+        stepper = NPCStepper(model="gigax-fake", api_key="fake", api_url=server.url)
+        server.respond = trace_responder(stepper, trace)
+    else:
+        llama = FakeLlama(token_latency=args.token_latency)
+        stepper = NPCStepper(model=models.LlamaCpp(llama))  # type: ignore
+        llama.respond = trace_responder(stepper, trace)
+
+    try:
+        report = await replay(stepper, trace, concurrency=args.concurrency)
+    finally:
+        await stepper.aclose()
+        if args.backend == "api":
+            server.stop()
+    print(json.dumps(report.summary(), indent=2) if args.json else report)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", default="trace.jsonl")
+    parser.add_argument("--generate", type=int, help="Record a synthetic trace of this many steps first.")
+    parser.add_argument("--entities", type=int, default=50, help="Entities per kind in the synthetic scene.")
+    parser.add_argument("--backend", choices=["llamacpp", "api"], default="llamacpp")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per generated token.")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    if args.generate:
+        if os.path.exists(args.trace):
+            os.remove(args.trace)
+        generate_trace(args.trace, args.generate, args.entities)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark of the per-step CPU overhead around decoding, for scenes of increasing size.
+
+Compares, per step:
+- request: validating the scene sent as JSON (StepRequest), then deriving everything from the models,
+- models: deriving everything from already validated models (name index, guided regex, prompt prefix,
+  parsing of the response into a CharacterAction),
+- compact: the same work on a CompactScene, converted once per scene (its conversion time is reported
+  separately), parsing the response into a CompactAction.
+
+Usage: python benchmarks/step_overhead.py --sizes 10,100,1000,5000 --steps 50
+"""
+
+import argparse
+import functools
+import random
+import time
+
+from gigax.compact import CompactScene
+from gigax.parse import CharacterAction, get_guided_regex
+from gigax.prompt import NPCPromptPrefix
+from gigax.scene import (
+    Character,
+    Item,
+    Location,
+    ParameterType,
+    ProtagonistCharacter,
+    SceneIndex,
+    Skill,
+)
+from gigax.step import StepRequest
+
+SKILLS = [
+    Skill(name="Say", description="", parameter_types=[ParameterType.character, ParameterType.content]),
+    Skill(name="Attack", description="", parameter_types=[ParameterType.character]),
+    Skill(name="Move", description="", parameter_types=[ParameterType.location]),
+    Skill(name="Give", description="", parameter_types=[ParameterType.character, ParameterType.item]),
+]
+
+
+def build_scene(size: int, rng: random.Random) -> StepRequest:
+    locations = [Location(name=f"Location {i}", description="A place") for i in range(size)]
+    NPCs = [
+        Character(name=f"Character {i}", description="A villager", current_location=rng.choice(locations))
+        for i in range(size)
+    ]
+    items = [Item(name=f"Item {i}", description="A thing") for i in range(size)]
+    protagonist = ProtagonistCharacter(
+        name="Aldren",
+        description="Brave and curious",
+        current_location=locations[0],
+        memories=[],
+        quests=[],
+        skills=SKILLS,
+        psychological_profile="Determined",
+    )
+    return StepRequest(
+        context="A vast open world", locations=locations, NPCs=NPCs, protagonist=protagonist, items=items, events=[]
+    )
+
+
+def step_models(request: StepRequest, response: str) -> CharacterAction:
+    scene_index = SceneIndex(request.NPCs, request.locations, request.items)
+    guided_regex = get_guided_regex(SKILLS, request.NPCs, request.locations, request.items, scene_index)
+    NPCPromptPrefix(request.context, request.locations, request.NPCs)
+    return CharacterAction.from_str(
+        response, request.protagonist, request.NPCs, request.locations, request.items, guided_regex, scene_index
+    )
+
+
+def step_request(payload: dict, response: str) -> CharacterAction:
+    return step_models(StepRequest.model_validate(payload), response)
+
+
+def step_compact(scene: CompactScene, protagonist: str, response: str):
+    guided_regex = scene.guided_regex(SKILLS)
+    scene.prompt_prefix()
+    return scene.parse_action(response, protagonist, guided_regex)
+
+
+def timed(func, steps: int) -> float:
+    start = time.perf_counter()
+    for _ in range(steps):
+        func()
+    return (time.perf_counter() - start) / steps * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--steps", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'entities':>8} {'request (ms)':>12} {'models (ms)':>11} {'compact (ms)':>12} {'conversion (ms)':>15}")
+    for size in map(int, args.sizes.split(",")):
+        request = build_scene(size, rng)
+        payload = request.model_dump()
+        response = f"Give Character {rng.randrange(size)} Item {rng.randrange(size)}"
+
+        start = time.perf_counter()
+        scene = CompactScene(request.context, request.locations, request.NPCs, request.items)
+        conversion = (time.perf_counter() - start) * 1e3
+        assert str(step_compact(scene, "Aldren", response)) == str(step_models(request, response))
+
+        request_time = timed(functools.partial(step_request, payload, response), args.steps)
+        models_time = timed(functools.partial(step_models, request, response), args.steps)
+        compact_time = timed(functools.partial(step_compact, scene, "Aldren", response), args.steps)
+        print(f"{size:>8} {request_time:>12.3f} {models_time:>11.3f} {compact_time:>12.3f} {conversion:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
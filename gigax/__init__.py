@@ -1,9 +1,17 @@
 """ Gigax package. """
 
-from gigax import scene
-from gigax import parse
-from gigax import step
-from gigax import prompt
-
+import importlib
 
+# Submodules are imported on first access, so that e.g. `gigax.scene` and `gigax.parse` can be used
+# without loading the generation backends of `gigax.step`
 __all__ = ["scene", "parse", "step", "prompt"]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f"gigax.{name}")
+    raise AttributeError(f"module 'gigax' has no attribute '{name}'")
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + __all__)
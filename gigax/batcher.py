@@ -0,0 +1,164 @@
+"""This module contains a dynamic batcher, coalescing concurrent step requests into NPCStepper batches."""
+
+import asyncio
+import logging
+
+from gigax.metrics import Histogram, render_counter, render_gauge, render_histogram
+from gigax.parse import CharacterAction
+from gigax.step import NPCStepper, StepRequest
+
+logger = logging.getLogger("uvicorn")
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class QueueFullError(Exception):
+    """Raised when a request is submitted while the batcher's queue is full."""
+
+
+class DynamicBatcher:
+    """
+    Queues step requests and hands them to the stepper in batches: a batch is sent as soon as it
+    reaches max_batch_size, or max_wait seconds after its first request.
+    The queue is bounded: once max_queue_size requests are waiting, new ones are rejected.
+    """
+
+    def __init__(
+        self,
+        stepper: NPCStepper,
+        max_batch_size: int = 8,
+        max_wait: float = 0.005,
+        max_queue_size: int = 128,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.stepper = stepper
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.rejected = 0
+        self.in_flight = 0
+        # Created in the event loop, on the first submitted request
+        self._queue: asyncio.Queue[tuple[StepRequest, asyncio.Future]] | None = None
+        self._arrived: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._batch: list[tuple[StepRequest, asyncio.Future]] = []
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._arrived = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def submit(self, request: StepRequest) -> CharacterAction:
+        """
+        Queue a request and wait for its action. Raises QueueFullError if the queue is full.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((request, future))  # type: ignore
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(
+                f"{self.max_queue_size} requests are already waiting, try again later."
+            )
+        self._arrived.set()  # type: ignore
+        return await future
+
+    async def next_batch(self) -> list[tuple[StepRequest, asyncio.Future]]:
+        queue, arrived = self._queue, self._arrived
+        assert queue is not None and arrived is not None
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while True:
+            while not queue.empty() and len(batch) < self.max_batch_size:
+                batch.append(queue.get_nowait())
+            timeout = deadline - loop.time()
+            if len(batch) >= self.max_batch_size or timeout <= 0:
+                break
+            arrived.clear()
+            try:
+                await asyncio.wait_for(arrived.wait(), timeout)
+            except TimeoutError:
+                pass
+        # Requests cancelled while queued, e.g. by a client going away, are not worth decoding
+        return [(request, future) for request, future in batch if not future.done()]
+
+    async def run(self):
+        """
+        Step the queued requests batch after batch, until the batcher is closed.
+        """
+        while True:
+            batch = self._batch = await self.next_batch()
+            if not batch:
+                continue
+            self.batch_sizes.observe(len(batch))
+            self.in_flight = len(batch)
+            try:
+                actions = await self.stepper.get_actions(
+                    [request for request, _ in batch], return_exceptions=True
+                )
+            except Exception as e:
+                logger.exception(f"Error while stepping a batch of {len(batch)} NPCs")
+                actions = [e] * len(batch)
+            finally:
+                self.in_flight = 0
+            for (_, future), action in zip(batch, actions):
+                if future.done():
+                    continue
+                if isinstance(action, Exception):
+                    future.set_exception(action)
+                else:
+                    future.set_result(action)
+
+    async def close(self):
+        """
+        Stop batching, and fail the requests still waiting in the queue.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        pending = self._batch
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("The batcher was closed."))
+        self._batch = []
+
+    def render_metrics(self, namespace: str = "gigax") -> str:
+        """
+        Return the queue and batch metrics in the Prometheus text format.
+        """
+        lines: list[str] = []
+        render_histogram(
+            lines,
+            f"{namespace}_batch_size",
+            "Number of requests per batch.",
+            {(): self.batch_sizes},
+        )
+        render_gauge(
+            lines, f"{namespace}_queue_size", "Requests waiting in the queue.", {(): self.queue_size}
+        )
+        render_gauge(
+            lines, f"{namespace}_in_flight", "Requests being stepped.", {(): self.in_flight}
+        )
+        render_counter(
+            lines,
+            f"{namespace}_rejected_requests_total",
+            "Requests rejected because the queue was full.",
+            {(): self.rejected},
+        )
+        return "\n".join(lines) + "\n"
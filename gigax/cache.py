@@ -0,0 +1,107 @@
+"""This module contains the caches used to avoid recomputing expensive objects between steps."""
+
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass
+from typing import Generic, TypeVar
+
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    """Counters describing how a cache has been used."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class LRUCache(Generic[V]):
+    """
+    Bounded least-recently-used cache, with hit/miss/eviction counters.
+    e.g.: the compiled guided-generation FSMs, keyed by (model identity, regex pattern).
+    """
+
+    def __init__(self, maxsize: int = 32):
+        if maxsize < 0:
+            raise ValueError(f"maxsize must be positive, got {maxsize}")
+        self.maxsize = maxsize
+        self.stats = CacheStats()
+        self._data: OrderedDict[Hashable, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable) -> V | None:
+        """
+        Return the cached value for key (marking it as recently used), or None.
+        """
+        if key not in self._data:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key: Hashable, value: V) -> None:
+        """
+        Insert a value, evicting the least recently used entries if the cache is full.
+        """
+        if self.maxsize == 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats.evictions += 1
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], V]) -> V:
+        """
+        Return the cached value for key, building it with factory() on a miss.
+        """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class TTLCache(LRUCache[V]):
+    """
+    Bounded least-recently-used cache whose entries also expire ttl seconds after being stored.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 32,
+        ttl: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.clock = clock
+
+    def get(self, key: Hashable) -> V | None:
+        item = self._data.get(key)
+        if item is not None and self.clock() >= item[0]:  # type: ignore
+            del self._data[key]
+            self.stats.expirations += 1
+        item = super().get(key)
+        return None if item is None else item[1]  # type: ignore
+
+    def put(self, key: Hashable, value: V) -> None:
+        super().put(key, (self.clock() + self.ttl, value))  # type: ignore
@@ -0,0 +1,195 @@
+"""This module contains the `gigax` command line interface."""
+
+import argparse
+import asyncio
+import logging
+import os
+
+from gigax.pool import LlamaCppReplica, StepperPool, TransformersReplica
+from gigax.server import StepServer
+from gigax.step import NPCStepper
+
+
+def load_model(args: argparse.Namespace):
+    """
+    Load the model to serve: a GGUF file or Hub repository with llama.cpp, a transformers model,
+    or the name of an API model.
+    """
+    if args.backend == "api":
+        return args.model
+
+    from outlines import models
+
+    if args.backend == "llamacpp":
+        from llama_cpp import Llama
+
+        kwargs = {"n_ctx": args.n_ctx, "n_gpu_layers": args.n_gpu_layers, "verbose": False}
+        if os.path.exists(args.model):
+            llm = Llama(model_path=args.model, **kwargs)
+        else:
+            llm = Llama.from_pretrained(repo_id=args.model, filename=args.filename, **kwargs)
+        return models.LlamaCpp(llm)  # type: ignore
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    return models.Transformers(
+        AutoModelForCausalLM.from_pretrained(args.model),
+        AutoTokenizer.from_pretrained(args.model),
+    )
+
+
+def load_replica(args: argparse.Namespace):
+    """
+    Model factory for the worker processes of a StepperPool.
+    """
+    if args.backend == "llamacpp":
+        model_path = args.model
+        if not os.path.exists(model_path):
+            from huggingface_hub import hf_hub_download
+
+            model_path = hf_hub_download(repo_id=args.model, filename=args.filename)
+        return LlamaCppReplica(
+            model_path, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers
+        )
+    return TransformersReplica(args.model)
+
+
+async def serve(args: argparse.Namespace):
+    stepper_kwargs = {
+        "index_store": args.index_store,
+        "prefix_cache_bytes": args.prefix_cache_mb << 20,
+        "prompt_token_budget": args.prompt_token_budget,
+        "memory_top_k": args.memory_top_k,
+        "max_parse_attempts": args.max_parse_attempts,
+        "parse_retry_seconds": args.parse_retry_seconds,
+        "temperature": args.temperature,
+    }
+    if args.replicas > 1 and args.backend != "api":
+        stepper = StepperPool(
+            load_replica(args),
+            replicas=args.replicas,
+            threads_per_replica=args.threads_per_replica,
+            **stepper_kwargs,
+        )
+        await stepper.astart()
+    else:
+        stepper = NPCStepper(
+            model=load_model(args),
+            api_key=args.api_key,
+            api_url=args.api_url,
+            api_single_flight=args.api_single_flight,
+            api_rate_limit=args.api_rate_limit,
+            adaptive_concurrency=args.adaptive_concurrency,
+            **stepper_kwargs,
+        )
+    server = StepServer(
+        stepper,
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        max_queue_size=args.max_queue_size,
+    )
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="gigax", description="Runtime, LLM-powered NPCs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser(
+        "serve", help="Serve NPC steps over HTTP/JSON, with dynamic batching."
+    )
+    model = serve_parser.add_argument_group("model")
+    model.add_argument(
+        "--model",
+        required=True,
+        help="GGUF file or Hub repository (llamacpp), Hub model (transformers), or model name (api).",
+    )
+    model.add_argument(
+        "--backend", choices=["llamacpp", "transformers", "api"], default="llamacpp"
+    )
+    model.add_argument("--filename", help="GGUF file of the Hub repository (llamacpp).")
+    model.add_argument("--n-ctx", type=int, default=2048)
+    model.add_argument("--n-gpu-layers", type=int, default=0)
+    model.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Local model replicas, each in its own process pinned to a subset of the cores.",
+    )
+    model.add_argument(
+        "--threads-per-replica",
+        type=int,
+        help="Threads of each replica (defaults to its number of cores).",
+    )
+    model.add_argument("--api-key", default=os.environ.get("GIGAX_API_KEY"))
+    model.add_argument("--api-url", default="https://gig.ax/llm/v1")
+    model.add_argument(
+        "--api-single-flight",
+        action="store_true",
+        help="Send identical API requests in flight only once (api).",
+    )
+    model.add_argument("--api-rate-limit", type=float, help="API requests per second (api).")
+    model.add_argument(
+        "--adaptive-concurrency",
+        action="store_true",
+        help="Back off concurrent API requests on errors and latency spikes (api).",
+    )
+
+    stepper = serve_parser.add_argument_group("stepper")
+    stepper.add_argument("--index-store", help="Directory of compiled regex indices.")
+    stepper.add_argument("--prefix-cache-mb", type=int, default=0)
+    stepper.add_argument("--prompt-token-budget", type=int)
+    stepper.add_argument("--memory-top-k", type=int)
+    stepper.add_argument(
+        "--max-parse-attempts",
+        type=int,
+        default=2,
+        help="Generations per step when responses cannot be parsed.",
+    )
+    stepper.add_argument(
+        "--parse-retry-seconds",
+        type=float,
+        help="No more regeneration once a step has taken this long.",
+    )
+    stepper.add_argument(
+        "--temperature",
+        type=float,
+        help="Sampling temperature, 0 for greedy decoding (default: 0.8 for the API, 1.0 locally).",
+    )
+
+    server = serve_parser.add_argument_group("server")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8000)
+    server.add_argument("--max-batch-size", type=int, default=8)
+    server.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5.0,
+        help="How long the first request of a batch waits for others to join it.",
+    )
+    server.add_argument(
+        "--max-queue-size",
+        type=int,
+        default=128,
+        help="Requests beyond this many waiting ones are rejected with 429.",
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None):
+    from dotenv import load_dotenv
+
+    load_dotenv()  # e.g. GIGAX_API_KEY
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "serve":
+        asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
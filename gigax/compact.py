@@ -0,0 +1,255 @@
+"""This module contains a compact scene representation, for the per-step work on large scenes."""
+
+import re
+import sys
+from dataclasses import dataclass
+
+from gigax.parse import (
+    CharacterAction,
+    ProtagonistCharacter,
+    compile_guided_regex,
+    parse_command,
+)
+from gigax.prompt import NPCPromptPrefix
+from gigax.scene import Character, EntityNames, Item, Location, Object, Skill
+
+KINDS: dict[str, type] = {"character": Character, "location": Location, "item": Item}
+
+
+@dataclass(slots=True, frozen=True)
+class CompactEntity:
+    """
+    Character, location or item of a CompactScene, referred to by its position in the scene.
+    Characters refer to their current location by its position in the scene's location table.
+    """
+
+    kind: str
+    index: int
+    name: str
+    description: str
+    location: int = -1
+
+    def __str__(self) -> str:
+        return self.name
+
+
+@dataclass(slots=True)
+class CompactAction:
+    """
+    Plain counterpart of CharacterAction, referring to the protagonist by name.
+    """
+
+    command: str
+    protagonist: str
+    parameters: list[str | int | CompactEntity]
+
+    def __str__(self) -> str:
+        return f"{self.protagonist}: {self.command} {' '.join(map(str, self.parameters))}"
+
+    @staticmethod
+    def from_model(action: CharacterAction, scene: "CompactScene") -> "CompactAction":
+        parameters: list[str | int | CompactEntity] = []
+        for param in action.parameters:
+            if isinstance(param, Object):
+                kind = next(k for k, cls in KINDS.items() if isinstance(param, cls))
+                entity = scene.find(kind, param.name)
+                if entity is None:
+                    raise ValueError(f"Unknown {kind} '{param.name}'")
+                param = entity
+            parameters.append(param)
+        return CompactAction(action.command, action.protagonist.name, parameters)
+
+    def to_model(
+        self, protagonist: ProtagonistCharacter, scene: "CompactScene"
+    ) -> CharacterAction:
+        return CharacterAction(
+            command=self.command,
+            protagonist=protagonist,
+            parameters=[
+                scene.model(param) if isinstance(param, CompactEntity) else param
+                for param in self.parameters
+            ],
+        )
+
+
+class CompactScene:
+    """
+    Interned, slotted representation of the entities of a scene, with a case-folded name index.
+    Converted from the pydantic models once, at the API boundary, and back without loss:
+    characters located outside of the scene's locations get their location appended to the
+    location table (after the scene's own), and entities of subclasses (e.g. a ProtagonistCharacter
+    among the NPCs) are converted back to the very same model.
+    It can be passed to NPCStepper.get_action as the scene index: the guided regex, prompt prefix
+    and name lookups of the step then come from the compact scene, and only the entities of the
+    parsed action are converted back to models.
+    """
+
+    __slots__ = (
+        "_index",
+        "_models",
+        "_names",
+        "_originals",
+        "_prefix",
+        "character_names",
+        "context",
+        "entities",
+        "item_names",
+        "location_count",
+        "location_names",
+    )
+
+    def __init__(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        items: list[Item],
+    ):
+        self.context = context
+        self._originals: dict[tuple[str, int], Object] = {}
+        self._models: dict[tuple[str, int], Object] = {}
+        self._names: EntityNames | None = None
+        self._prefix: str | None = None
+        self.entities: dict[str, tuple[CompactEntity, ...]] = {}
+
+        location_table = list(locations)
+        self.location_count = len(locations)
+        # Characters usually stand in one of the scene's locations: only the others are appended
+        positions: dict[tuple[str, str], int] = {}
+        for i, loc in enumerate(locations):
+            positions.setdefault((loc.name, loc.description), i)
+        character_locations = []
+        for char in NPCs:
+            loc = char.current_location
+            key = (loc.name, loc.description)
+            if type(loc) is not Location or key not in positions:
+                character_locations.append(len(location_table))
+                location_table.append(loc)
+                if type(loc) is Location:
+                    positions[key] = character_locations[-1]
+            else:
+                character_locations.append(positions[key])
+
+        self.entities["location"] = self._intern("location", location_table)
+        self.entities["character"] = self._intern("character", NPCs, character_locations)
+        self.entities["item"] = self._intern("item", items)
+        self.location_names = tuple(
+            loc.name for loc in self.entities["location"][: self.location_count]
+        )
+        self.character_names = tuple(char.name for char in self.entities["character"])
+        self.item_names = tuple(item.name for item in self.entities["item"])
+        self._index: dict[str, dict[str, CompactEntity]] = {}
+
+    def _intern(
+        self, kind: str, models: list, locations: list[int] | None = None
+    ) -> tuple[CompactEntity, ...]:
+        entities = []
+        for i, model in enumerate(models):
+            if type(model) is not KINDS[kind]:
+                self._originals[(kind, i)] = model
+            entities.append(
+                CompactEntity(
+                    kind,
+                    i,
+                    sys.intern(model.name),
+                    model.description,
+                    locations[i] if locations is not None else -1,
+                )
+            )
+        return tuple(entities)
+
+    @property
+    def locations(self) -> tuple[CompactEntity, ...]:
+        return self.entities["location"][: self.location_count]
+
+    @property
+    def characters(self) -> tuple[CompactEntity, ...]:
+        return self.entities["character"]
+
+    @property
+    def items(self) -> tuple[CompactEntity, ...]:
+        return self.entities["item"]
+
+    def find(self, kind: str, name: str) -> CompactEntity | None:
+        """
+        Case-insensitive lookup of an entity by name. The first entity wins on duplicate names.
+        """
+        index = self._index.get(kind)
+        if index is None:
+            entities = self.locations if kind == "location" else self.entities[kind]
+            index = self._index[kind] = {}
+            for entity in entities:
+                index.setdefault(entity.name.casefold(), entity)
+        return index.get(name.casefold())
+
+    def model(self, entity: CompactEntity) -> Object:
+        """
+        The pydantic model of an entity, built on first use.
+        """
+        key = (entity.kind, entity.index)
+        model = self._originals.get(key) or self._models.get(key)
+        if model is None:
+            if entity.kind == "character":
+                model = Character(
+                    name=entity.name,
+                    description=entity.description,
+                    current_location=self.model(self.entities["location"][entity.location]),
+                )
+            else:
+                model = KINDS[entity.kind](name=entity.name, description=entity.description)
+            self._models[key] = model
+        return model
+
+    def _lookup(self, kind: str, name: str) -> Object | None:
+        entity = self.find(kind, name)
+        return self.model(entity) if entity is not None else None
+
+    # Same lookups as SceneIndex, so that the shared parsers resolve entities through the compact scene
+    def character(self, name: str) -> Character | None:
+        return self._lookup("character", name)  # type: ignore
+
+    def location(self, name: str) -> Location | None:
+        return self._lookup("location", name)  # type: ignore
+
+    def item(self, name: str) -> Item | None:
+        return self._lookup("item", name)  # type: ignore
+
+    @property
+    def names(self) -> EntityNames:
+        if self._names is None:
+            self._names = EntityNames(self.character_names, self.location_names, self.item_names)
+        return self._names
+
+    def to_models(self) -> tuple[str, list[Location], list[Character], list[Item]]:
+        """
+        Convert back to the arguments of NPCStepper.get_action: context, locations, NPCs and items.
+        """
+        return (
+            self.context,
+            [self.model(loc) for loc in self.locations],  # type: ignore
+            [self.model(char) for char in self.characters],  # type: ignore
+            [self.model(item) for item in self.items],  # type: ignore
+        )
+
+    def prompt_prefix(self) -> str:
+        """
+        NPCPromptPrefix of the scene, rendered once from the interned names.
+        """
+        if self._prefix is None:
+            self._prefix = NPCPromptPrefix(self.context, self.locations, self.characters)
+        return self._prefix
+
+    def guided_regex(self, skills: list[Skill]) -> re.Pattern:
+        """
+        Same as get_guided_regex, from the interned names.
+        """
+        return compile_guided_regex(skills, self.names)
+
+    def parse_action(
+        self, command_str: str, protagonist: str, compiled_regex: re.Pattern
+    ) -> CompactAction:
+        """
+        Same as CharacterAction.from_str, without building any pydantic model.
+        """
+        command, parameters = parse_command(command_str, compiled_regex, self.find)
+        return CompactAction(command, protagonist, parameters)
@@ -0,0 +1,273 @@
+"""
+This module contains deterministic stand-ins for the models, to test and benchmark NPCStepper offline:
+a character-level llama.cpp model, and an OpenAI-compatible chat completion server.
+Both reply with a fixed string, or with respond(prompt), after a configurable per-token latency.
+"""
+
+import json
+import threading
+import time
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class FakeTokenizer:
+    def __init__(self, vocabulary: list[str]):
+        self.vocabulary = vocabulary
+
+    def decode(self, token_ids: list[int]) -> str:
+        return "".join(self.vocabulary[t] for t in token_ids)
+
+
+class FakeInnerModel:
+    def __init__(self, vocabulary: list[str]):
+        self.vocabulary = vocabulary
+
+    def token_get_text(self, token_id: int) -> str:
+        return self.vocabulary[token_id]
+
+
+class FakeLlamaState:
+    def __init__(self, input_ids: list[int]):
+        self.input_ids = list(input_ids)
+        self.llama_state_size = 16 * len(input_ids)
+
+
+class FakeLlama:
+    """
+    Character-level stand-in for llama_cpp.Llama: greedily decodes `reply`, within what the logits processors allow.
+    Like llama-cpp-python, it only evaluates the prompt tokens that follow the tokens already in its KV state.
+    With respond, the reply to each prompt is respond(user message) instead.
+    """
+
+    eos_token = "</s>"
+    chat_template = "{{ bos_token }}{% for message in messages %}<|user|>{{ message['content'] }}<|end|>{% endfor %}<|assistant|>"
+
+    def __init__(
+        self,
+        reply: str = "",
+        respond: Callable[[str], str] | None = None,
+        token_latency: float = 0.0,
+        prompt_token_latency: float = 0.0,
+    ):
+        self.reply = reply
+        self.respond = respond
+        self.token_latency = token_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.vocabulary = [self.eos_token] + [chr(c) for c in range(32, 127)]
+        self.metadata = {
+            "tokenizer.ggml.bos_token_id": "0",
+            "tokenizer.chat_template": self.chat_template,
+        }
+        self._model = FakeInnerModel(self.vocabulary)
+        self.prompts: list[str] = []
+        self.input_ids: list[int] = []
+        self.evaluated = 0
+
+    def token_eos(self) -> int:
+        return 0
+
+    def n_vocab(self) -> int:
+        return len(self.vocabulary)
+
+    def tokenizer(self) -> FakeTokenizer:
+        return FakeTokenizer(self.vocabulary)
+
+    def tokenize(self, text: bytes | str, add_bos: bool = True, special: bool = False) -> list[int]:
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        return [self.vocabulary.index(c) if c in self.vocabulary else 1 for c in text]
+
+    def eval(self, tokens: list[int]):
+        self.input_ids += tokens
+        self.evaluated += len(tokens)
+
+    def save_state(self) -> FakeLlamaState:
+        return FakeLlamaState(self.input_ids)
+
+    def load_state(self, state: FakeLlamaState):
+        self.input_ids = list(state.input_ids)
+
+    def reset(self):
+        self.input_ids = []
+
+    def __call__(
+        self,
+        prompt: str,
+        max_tokens: int | None = None,
+        logits_processor=None,
+        stream: bool = False,
+        **kwargs,
+    ):
+        self.prompts.append(prompt)
+        prompt_ids = self.tokenize(prompt)
+        reused = 0
+        for a, b in zip(self.input_ids, prompt_ids[:-1]):
+            if a != b:
+                break
+            reused += 1
+        self.input_ids = self.input_ids[:reused]
+        time.sleep(self.prompt_token_latency * (len(prompt_ids) - reused))
+        self.eval(prompt_ids[reused:])
+
+        reply = self.reply
+        if self.respond is not None:
+            message = prompt.split("<|user|>", 1)[-1].rsplit("<|end|>", 1)[0]
+            reply = self.respond(message)
+        tokens = self.generate(max_tokens, logits_processor, reply)
+        if stream:
+            return (
+                {"choices": [{"text": self.tokenizer().decode([token])}]} for token in tokens
+            )
+        return {"choices": [{"text": self.tokenizer().decode(list(tokens))}]}
+
+    def generate(self, max_tokens: int | None, logits_processor, reply: str | None = None):
+        reply = self.reply if reply is None else reply
+        # Like llama.cpp, a sampled token is only evaluated when the next one is requested
+        generated: list[int] = []
+        while max_tokens is None or len(generated) <= max_tokens:
+            time.sleep(self.token_latency)
+            scores = np.zeros(self.n_vocab(), dtype=np.float32)
+            position = len(generated)
+            target = reply[position] if position < len(reply) else None
+            scores[self.vocabulary.index(target) if target else 0] = 1.0
+            for processor in logits_processor or []:
+                scores = processor(np.array(self.input_ids), scores)
+            token = int(np.argmax(scores))
+            if token == self.token_eos():
+                break
+            generated.append(token)
+            yield token
+            self.eval([token])
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive connections
+
+    def do_POST(self):
+        server: FakeOpenAIServer = self.server  # type: ignore
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append(body)
+            server.connections.add(self.client_address)
+            overloaded = server.capacity is not None and server.in_flight >= server.capacity
+            if overloaded:
+                server.rejected += 1
+            else:
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        if overloaded:
+            return self.send_error_json(429, "Too many requests in flight")
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        reply = server.reply
+        if server.respond is not None:
+            reply = server.respond(body["messages"][-1]["content"])
+        if body.get("stream"):
+            return self.send_stream(server, body, reply)
+
+        time.sleep(server.token_latency * len(reply or ""))
+        data = json.dumps(
+            {
+                "id": f"chatcmpl-{len(server.requests)}",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply},
+                        "finish_reason": "stop",
+                    }
+                ],
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_error_json(self, status: int, message: str):
+        data = json.dumps({"error": {"message": message, "type": "rate_limit_error"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, server: "FakeOpenAIServer", body: dict, reply: str):
+        """
+        Server-sent events, with one chunk per character of the reply.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for char in reply:
+            time.sleep(server.token_latency)
+            chunk = {
+                "id": f"chatcmpl-{len(server.requests)}",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": char}, "finish_reason": None}],
+            }
+            self.send_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.send_chunk("data: [DONE]\n\n")
+        self.send_chunk("")
+
+    def send_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible chat completion server, answering every request with `reply`,
+    or respond(user message), after delay seconds plus token_latency per character.
+    Beyond capacity concurrent requests, requests are rejected with 429 Too Many Requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        reply: str = "",
+        delay: float = 0.0,
+        respond: Callable[[str], str] | None = None,
+        token_latency: float = 0.0,
+        capacity: int | None = None,
+    ):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.reply = reply
+        self.delay = delay
+        self.respond = respond
+        self.token_latency = token_latency
+        self.capacity = capacity
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.requests: list[dict] = []
+        self.connections: set[tuple] = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,175 @@
+"""This module contains an on-disk store for the token-transition indices of guided regexes."""
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from outlines.fsm.guide import Instruction, RegexGuide
+
+logger = logging.getLogger("uvicorn")
+
+# Layout of a stored index, as a single flat int64 array:
+# [n_offsets, n_transitions, eos_token_id, n_finals, offsets..., tokens..., next_states..., finals...]
+HEADER_SIZE = 4
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Stable hash of a tokenizer's vocabulary, used to key the indices compiled against it.
+    """
+    digest = hashlib.sha256()
+    for token, token_id in sorted(tokenizer.vocabulary.items(), key=lambda x: x[1]):
+        digest.update(f"{token_id}:{token}\x00".encode("utf-8", "surrogatepass"))
+    digest.update(f"eos:{tokenizer.eos_token_id}".encode())
+    return digest.hexdigest()
+
+
+class StoredRegexGuide:
+    """
+    Regex guide backed by a CSR-encoded transition table, which can be memory-mapped from disk.
+    Implements the same interface as outlines' RegexGuide.
+    """
+
+    initial_state = 0
+
+    def __init__(self, data: np.ndarray):
+        n_offsets, n_transitions, eos_token_id, n_finals = (
+            int(x) for x in data[:HEADER_SIZE]
+        )
+        start = HEADER_SIZE
+        self.offsets = data[start : start + n_offsets]
+        start += n_offsets
+        self.tokens = data[start : start + n_transitions]
+        start += n_transitions
+        self.next_states = data[start : start + n_transitions]
+        start += n_transitions
+        self.final_states = {int(x) for x in data[start : start + n_finals]} | {-1}
+        self.eos_token_id = eos_token_id
+        self.data = data
+
+    @staticmethod
+    def encode(guide: "RegexGuide") -> np.ndarray:
+        """
+        Flatten the states_to_token_maps of a compiled RegexGuide into the stored layout.
+        """
+        n_states = max(guide.states_to_token_maps, default=-1) + 1
+        offsets = np.zeros(n_states + 1, dtype=np.int64)
+        tokens, next_states = [], []
+        for state in range(n_states):
+            transitions = sorted(guide.states_to_token_maps.get(state, {}).items())
+            tokens.extend(token for token, _ in transitions)
+            next_states.extend(next_state for _, next_state in transitions)
+            offsets[state + 1] = len(tokens)
+        finals = sorted(s for s in guide.final_states if s >= 0)
+        header = [len(offsets), len(tokens), guide.eos_token_id, len(finals)]
+        return np.concatenate(
+            [
+                np.array(header, dtype=np.int64),
+                offsets,
+                np.array(tokens, dtype=np.int64),
+                np.array(next_states, dtype=np.int64),
+                np.array(finals, dtype=np.int64),
+            ]
+        )
+
+    def _transitions(self, state: int) -> tuple[np.ndarray, np.ndarray]:
+        if state < 0 or state + 1 >= len(self.offsets):
+            return self.tokens[:0], self.next_states[:0]
+        start, end = self.offsets[state], self.offsets[state + 1]
+        return self.tokens[start:end], self.next_states[start:end]
+
+    def get_next_instruction(self, state: int) -> "Instruction":
+        from outlines.fsm.guide import Generate, Write
+
+        tokens, _ = self._transitions(state)
+        if len(tokens) == 0:
+            return Write([self.eos_token_id])
+        return Generate(tokens.tolist())
+
+    def get_next_state(self, state: int, token_id: int) -> int:
+        if token_id == self.eos_token_id:
+            return -1
+        elif state in self.final_states:
+            return state
+
+        tokens, next_states = self._transitions(state)
+        position = int(np.searchsorted(tokens, token_id))
+        if position < len(tokens) and tokens[position] == token_id:
+            return int(next_states[position])
+        return -1
+
+    def is_final_state(self, state: int) -> bool:
+        return state in self.final_states
+
+    def copy(self) -> "StoredRegexGuide":
+        return self
+
+
+class IndexStore:
+    """
+    Directory of compiled regex indices, keyed by tokenizer fingerprint and regex pattern.
+    Each index is a single .npy file, memory-mapped on load, so warm starts skip FSM compilation.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._loaded: dict[str, StoredRegexGuide] = {}
+
+    @staticmethod
+    def _key(fingerprint: str, pattern: str) -> str:
+        pattern_hash = hashlib.sha256(pattern.encode("utf-8")).hexdigest()
+        return f"{fingerprint[:16]}-{pattern_hash[:32]}"
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}.npy"
+
+    def preload(self, fingerprint: str) -> int:
+        """
+        Memory-map every index stored for the given tokenizer, and return how many were found.
+        """
+        count = 0
+        for file in self.path.glob(f"{fingerprint[:16]}-*.npy"):
+            if file.stem not in self._loaded:
+                self._loaded[file.stem] = StoredRegexGuide(np.load(file, mmap_mode="r"))
+                count += 1
+        return count
+
+    def get(self, fingerprint: str, pattern: str) -> StoredRegexGuide | None:
+        key = self._key(fingerprint, pattern)
+        if key not in self._loaded:
+            file = self._file(key)
+            if not file.exists():
+                return None
+            self._loaded[key] = StoredRegexGuide(np.load(file, mmap_mode="r"))
+        return self._loaded[key]
+
+    def put(self, fingerprint: str, pattern: str, guide: "RegexGuide") -> StoredRegexGuide:
+        key = self._key(fingerprint, pattern)
+        file = self._file(key)
+        tmp_file = file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            np.save(f, StoredRegexGuide.encode(guide))
+        os.replace(tmp_file, file)  # Atomic, so concurrent workers never read partial files
+        self._loaded[key] = StoredRegexGuide(np.load(file, mmap_mode="r"))
+        return self._loaded[key]
+
+    def get_or_compile(
+        self, tokenizer, pattern: str, fingerprint: str | None = None
+    ) -> StoredRegexGuide:
+        """
+        Return the stored index for pattern, compiling and storing it on a miss.
+        """
+        fingerprint = fingerprint or tokenizer_fingerprint(tokenizer)
+        guide = self.get(fingerprint, pattern)
+        if guide is None:
+            from outlines.fsm.guide import RegexGuide
+
+            logger.info(f"Compiling and storing the index of regex {pattern[:50]}...")
+            guide = self.put(fingerprint, pattern, RegexGuide(pattern, tokenizer))
+        return guide
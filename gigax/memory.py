@@ -0,0 +1,142 @@
+"""This module contains a local retrieval index for the memories of the protagonists."""
+
+import hashlib
+import itertools
+import re
+from typing import Protocol
+
+import numpy as np
+
+from gigax.parse import CharacterAction
+from gigax.scene import ProtagonistCharacter
+
+
+class Embedder(Protocol):
+    """
+    Turns texts into an array of shape (len(texts), dim) of L2-normalized embeddings.
+    """
+
+    def __call__(self, texts: list[str]) -> np.ndarray: ...
+
+
+class HashingEmbedder:
+    """
+    Deterministic bag-of-words embedder using the hashing trick: no model or external service needed.
+    Words and word bigrams are hashed into `dim` signed buckets.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def features(self, text: str) -> list[str]:
+        words = re.findall(r"\w+", text.lower())
+        return words + [f"{a} {b}" for a, b in itertools.pairwise(words)]
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                sign = 1.0 if value & 1 else -1.0
+                embeddings[row, (value >> 1) % self.dim] += sign
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+class MemoryStore:
+    """
+    Embeddings of a protagonist's memories, in a growable NumPy array, with cosine top-k search.
+    """
+
+    def __init__(self, embedder: Embedder, capacity: int = 64):
+        self.embedder = embedder
+        self.memories: list[str] = []
+        self._embeddings: np.ndarray | None = None
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return len(self.memories)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        if self._embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._embeddings[: len(self.memories)]
+
+    def add(self, memories: list[str]):
+        """
+        Embed and insert new memories, growing the array geometrically if needed.
+        """
+        if not memories:
+            return
+        new_embeddings = self.embedder(memories)
+        size = len(self.memories)
+        if self._embeddings is None:
+            self._embeddings = np.zeros(
+                (max(self._capacity, len(memories)), new_embeddings.shape[1]),
+                dtype=np.float32,
+            )
+        elif size + len(memories) > len(self._embeddings):
+            grown = np.zeros(
+                (max(2 * len(self._embeddings), size + len(memories)), self._embeddings.shape[1]),
+                dtype=np.float32,
+            )
+            grown[:size] = self._embeddings[:size]
+            self._embeddings = grown
+        self._embeddings[size : size + len(memories)] = new_embeddings
+        self.memories.extend(memories)
+
+    def search(self, query: str, k: int) -> list[int]:
+        """
+        Return the indices of the k memories closest to the query, best first.
+        """
+        if k <= 0 or not self.memories:
+            return []
+        scores = self.embeddings @ self.embedder([query])[0]
+        if k >= len(scores):
+            return np.argsort(-scores, kind="stable").tolist()
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")].tolist()
+
+
+class MemoryRetriever:
+    """
+    Keeps one MemoryStore per protagonist in sync with its memories, and selects the k memories
+    most relevant to the current location and last events.
+    """
+
+    def __init__(self, embedder: Embedder | None = None, k: int = 5, query_events: int = 5):
+        self.embedder = embedder or HashingEmbedder()
+        self.k = k
+        self.query_events = query_events
+        self.stores: dict[str, MemoryStore] = {}
+
+    def sync(self, protagonist: ProtagonistCharacter) -> MemoryStore:
+        """
+        Embed the protagonist's new memories. Memories are expected to be appended over time;
+        if the list was otherwise modified, the store is rebuilt.
+        """
+        store = self.stores.get(protagonist.name)
+        memories = protagonist.memories
+        if store is None or memories[: len(store)] != store.memories:
+            store = self.stores[protagonist.name] = MemoryStore(self.embedder)
+        store.add(memories[len(store) :])
+        return store
+
+    def query(self, protagonist: ProtagonistCharacter, events: list[CharacterAction]) -> str:
+        location = protagonist.current_location
+        recent_events = [str(event) for event in events[-self.query_events :]]
+        return "\n".join([f"{location.name}: {location.description}", *recent_events])
+
+    def retrieve(
+        self, protagonist: ProtagonistCharacter, events: list[CharacterAction]
+    ) -> list[str]:
+        """
+        Return the k most relevant memories, in their original order.
+        """
+        if len(protagonist.memories) <= self.k:
+            return protagonist.memories
+        store = self.sync(protagonist)
+        indices = sorted(store.search(self.query(protagonist, events), self.k))
+        return [store.memories[i] for i in indices]
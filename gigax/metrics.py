@@ -0,0 +1,273 @@
+"""This module contains the instrumentation of NPC steps: per-phase timings, token counts and cache hits."""
+
+import bisect
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Protocol
+
+# Phases of a step, in order:
+# prompt (rendering), regex (get_guided_regex), fsm (generator lookup or compilation),
+# chat_template, prefix (prefix cache), decode (generation, or the API round trip), parse
+PHASES = ("prompt", "regex", "fsm", "chat_template", "prefix", "decode", "parse")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+@dataclass
+class StepMetrics:
+    """
+    Measurements of one call to NPCStepper.get_action, or of one batch of get_actions.
+    """
+
+    npc: str | None = None
+    batch_size: int = 1
+    batch: bool = False  # Measurements of a whole get_actions batch
+    seconds: float = 0.0
+    phases: dict[str, float] = field(default_factory=dict)
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    cache_hits: dict[str, int] = field(default_factory=dict)
+    cache_misses: dict[str, int] = field(default_factory=dict)
+    # Responses that did not parse, regenerations, and how the failures were recovered from
+    parse_failures: int = 0
+    parse_retries: int = 0
+    parse_recoveries: dict[str, int] = field(default_factory=dict)
+    # Raw responses generated for each step of the batch, in order, regenerations included
+    responses: list[list[str]] = field(default_factory=list)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time the enclosed block, adding up with previous timings of the same phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def cache(self, name: str, hit: bool):
+        counts = self.cache_hits if hit else self.cache_misses
+        counts[name] = counts.get(name, 0) + 1
+
+    def recovery(self, method: str):
+        """
+        Count a parse failure recovered from, by method: "repair", "retry" or "default".
+        """
+        self.parse_recoveries[method] = self.parse_recoveries.get(method, 0) + 1
+
+    @property
+    def tokens_per_second(self) -> float:
+        decode = self.phases.get("decode", 0.0)
+        return self.generated_tokens / decode if decode > 0 else 0.0
+
+
+class MetricsHook(Protocol):
+    """
+    Receives the metrics of every step, e.g. to export them or to log slow steps.
+    """
+
+    def __call__(self, metrics: StepMetrics) -> None: ...
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds, as in Prometheus.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+        total = 0
+        counts = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        key
+        + '="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metric(
+    lines: list[str], name: str, help: str, type: str, values: dict[tuple, float]
+):
+    """
+    Append a metric, with one value per tuple of (label, value) pairs, in the Prometheus text format.
+    """
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {type}")
+    for labels, value in values.items():
+        lines.append(f"{name}{_format_labels(dict(labels))} {value}")
+
+
+def render_counter(lines: list[str], name: str, help: str, values: dict[tuple, float]):
+    render_metric(lines, name, help, "counter", values)
+
+
+def render_gauge(lines: list[str], name: str, help: str, values: dict[tuple, float]):
+    render_metric(lines, name, help, "gauge", values)
+
+
+def render_histogram(lines: list[str], name: str, help: str, values: dict[tuple, Histogram]):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in values.items():
+        for bound, count in histogram.cumulative_counts():
+            bucket_labels = _format_labels({**dict(labels), "le": bound})
+            lines.append(f"{name}_bucket{bucket_labels} {count}")
+        lines.append(f"{name}_sum{_format_labels(dict(labels))} {histogram.sum}")
+        lines.append(f"{name}_count{_format_labels(dict(labels))} {histogram.count}")
+
+
+class PrometheusExporter:
+    """
+    Metrics hook aggregating steps into histograms and counters, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, namespace: str = "gigax", buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self.step_seconds = Histogram(buckets)
+        self.batch_seconds = Histogram(buckets)
+        self.phase_seconds: dict[str, Histogram] = {}
+        self.tokens_per_second = Histogram(TOKENS_PER_SECOND_BUCKETS)
+        self.steps = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.cache_hits: dict[str, int] = {}
+        self.cache_misses: dict[str, int] = {}
+        self.parse_failures = 0
+        self.parse_retries = 0
+        self.parse_recoveries: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, metrics: StepMetrics) -> None:
+        with self._lock:
+            self.steps += metrics.batch_size
+            # Batches take longer than single steps: they would skew the step latencies
+            if metrics.batch:
+                self.batch_seconds.observe(metrics.seconds)
+            else:
+                self.step_seconds.observe(metrics.seconds)
+            for phase, seconds in metrics.phases.items():
+                if phase not in self.phase_seconds:
+                    self.phase_seconds[phase] = Histogram(self.buckets)
+                self.phase_seconds[phase].observe(seconds)
+            self.prompt_tokens += metrics.prompt_tokens
+            self.generated_tokens += metrics.generated_tokens
+            if metrics.generated_tokens:
+                self.tokens_per_second.observe(metrics.tokens_per_second)
+            for name, count in metrics.cache_hits.items():
+                self.cache_hits[name] = self.cache_hits.get(name, 0) + count
+            for name, count in metrics.cache_misses.items():
+                self.cache_misses[name] = self.cache_misses.get(name, 0) + count
+            self.parse_failures += metrics.parse_failures
+            self.parse_retries += metrics.parse_retries
+            for method, count in metrics.parse_recoveries.items():
+                self.parse_recoveries[method] = self.parse_recoveries.get(method, 0) + count
+
+    def render(self) -> str:
+        """
+        Return the current metrics in the Prometheus text exposition format.
+        """
+        lines: list[str] = []
+        ns = self.namespace
+        with self._lock:
+            render_counter(lines, f"{ns}_steps_total", "NPC steps.", {(): self.steps})
+            render_histogram(
+                lines,
+                f"{ns}_step_seconds",
+                "Duration of single NPC steps.",
+                {(): self.step_seconds},
+            )
+            render_histogram(
+                lines,
+                f"{ns}_batch_seconds",
+                "Duration of batches of NPC steps.",
+                {(): self.batch_seconds},
+            )
+            ordered_phases = sorted(
+                self.phase_seconds,
+                key=lambda p: (PHASES.index(p) if p in PHASES else len(PHASES), p),
+            )
+            render_histogram(
+                lines,
+                f"{ns}_step_phase_seconds",
+                "Duration of each phase of NPC steps.",
+                {(("phase", p),): self.phase_seconds[p] for p in ordered_phases},
+            )
+            render_histogram(
+                lines,
+                f"{ns}_tokens_per_second",
+                "Generated tokens per second of decoding.",
+                {(): self.tokens_per_second},
+            )
+            render_counter(
+                lines, f"{ns}_prompt_tokens_total", "Prompt tokens.", {(): self.prompt_tokens}
+            )
+            render_counter(
+                lines,
+                f"{ns}_generated_tokens_total",
+                "Generated tokens.",
+                {(): self.generated_tokens},
+            )
+            render_counter(
+                lines,
+                f"{ns}_cache_hits_total",
+                "Cache hits, by cache.",
+                {(("cache", c),): n for c, n in sorted(self.cache_hits.items())},
+            )
+            render_counter(
+                lines,
+                f"{ns}_cache_misses_total",
+                "Cache misses, by cache.",
+                {(("cache", c),): n for c, n in sorted(self.cache_misses.items())},
+            )
+            render_counter(
+                lines,
+                f"{ns}_parse_failures_total",
+                "Responses that could not be parsed into an action.",
+                {(): self.parse_failures},
+            )
+            render_counter(
+                lines,
+                f"{ns}_parse_retries_total",
+                "Responses regenerated after a parse failure.",
+                {(): self.parse_retries},
+            )
+            render_counter(
+                lines,
+                f"{ns}_parse_recoveries_total",
+                "Parse failures recovered from, by method.",
+                {(("method", m),): n for m, n in sorted(self.parse_recoveries.items())},
+            )
+        return "\n".join(lines) + "\n"
@@ -2,16 +2,21 @@
 
 import logging
 import re
-from typing import Union
+from collections.abc import Callable, Sequence
+from typing import Any, Union
 
 from pydantic import BaseModel
 
+from gigax.cache import LRUCache
 from gigax.scene import (
+    Character,
+    EntityNames,
     Item,
-    Object,
     Location,
-    Character,
+    Object,
+    ParameterType,
     ProtagonistCharacter,
+    SceneIndex,
     Skill,
 )
 
@@ -46,75 +51,282 @@ class CharacterAction(BaseModel):
         valid_locations: list[Location],
         valid_items: list[Item],
         compiled_regex: re.Pattern,
+        scene_index: SceneIndex | None = None,
     ) -> "CharacterAction":
         """
         Parse a command string into a CharacterAction object.
+        Entities are resolved case-insensitively, like the regex matching, through the scene index.
         """
+        if scene_index is None:
+            scene_index = SceneIndex(valid_characters, valid_locations, valid_items)
+        command, parameters = parse_command(
+            command_str,
+            compiled_regex,
+            lambda param_type, name: getattr(scene_index, param_type)(name),
+        )
+        action = CharacterAction(
+            command=command, protagonist=protagonist, parameters=[]
+        )
+        action.parameters.extend(parameters)  # Already resolved: not validated again
+        return action
 
-        match = compiled_regex.match(command_str)
-        if not match:
-            raise ValueError("Invalid command format")
 
-        if match.lastgroup is None:
-            raise ValueError(
-                f"Could not find a matching skill in command_str '{command_str}'"
-            )
+def parse_command(
+    command_str: str,
+    compiled_regex: re.Pattern,
+    resolve: Callable[[str, str], Any],
+) -> tuple[str, list]:
+    """
+    Parse a command string into its command name and parameters.
+    Entities are resolved by resolve(param_type, name), e.g. through a scene index.
+    """
+    match = compiled_regex.match(command_str)
+    if not match:
+        raise ValueError("Invalid command format")
 
-        command = match.lastgroup.split("_")[0]  # Extract command name
-        action = CharacterAction(
-            command=command, protagonist=protagonist, parameters=[]
+    if match.lastgroup is None:
+        raise ValueError(
+            f"Could not find a matching skill in command_str '{command_str}'"
         )
 
-        # Extract parameters based on their named groups
-        for group_name, value in match.groupdict().items():
-            if not value:
-                continue
+    command = match.lastgroup.split("_")[0]  # Extract command name
+    parameters: list = []
 
-            param_type = group_name[
-                len(f"{command}_") :
-            ]  # Remove command prefix to get parameter type
+    # Extract parameters based on their named groups
+    for group_name, value in match.groupdict().items():
+        if not value:
+            continue
 
-            # Add parameters based on their type
-            if param_type == "character":
-                # Assuming characters are directly referred by name
-                action.parameters.append(
-                    next(char for char in valid_characters if char.name == value),
-                )
-            elif param_type == "location":
-                action.parameters.append(
-                    next(loc for loc in valid_locations if loc.name == value),
-                )
-            elif param_type == "item":
-                action.parameters.append(
-                    next(item for item in valid_items if item.name == value)
-                )
-            elif param_type == "amount":
-                action.parameters.append(int(value))
-            elif param_type == "content":
-                # Remove quotation marks if present
-                action.parameters.append(value.strip('"'))
+        param_type = group_name[
+            len(f"{command}_") :
+        ]  # Remove command prefix to get parameter type
+
+        # Add parameters based on their type
+        if param_type in ("character", "location", "item"):
+            # Entities are directly referred by name
+            entity = resolve(param_type, value)
+            if entity is None:
+                raise ActionParsingError(f"Unknown {param_type} '{value}'")
+            parameters.append(entity)
+        elif param_type == "amount":
+            parameters.append(int(value))
+        elif param_type == "content":
+            # Remove quotation marks if present
+            parameters.append(value.strip('"'))
+
+    return command, parameters
+
+
+class ActionStreamParser:
+    """
+    Incremental parser of a command string streamed token by token, for the skills of a protagonist.
+    Returns partial actions as soon as their command and parameters are known (contents while they are
+    being written), and tells when the command is complete, i.e. when no further character is allowed.
+    """
 
+    def __init__(self, protagonist: ProtagonistCharacter, scene_index: SceneIndex):
+        self.protagonist = protagonist
+        self.scene_index = scene_index
+        self.text = ""
+        self.complete = False
+        self._last: tuple | None = None
+
+    def feed(self, chunk: str) -> "CharacterAction | None":
+        """
+        Add a chunk of generated text, and return the partial action if it progressed.
+        """
+        self.text += chunk
+        action, self.complete = self.parse(self.text)
+        if action is None:
+            return None
+        key = (action.command, tuple(str(param) for param in action.parameters))
+        if key == self._last:
+            return None
+        self._last = key
         return action
 
+    @staticmethod
+    def match_name(text: str, names: Sequence[str]) -> str | None:
+        """
+        Return the name text starts with, once no longer name can match it anymore.
+        """
+        folded = text.casefold()
+        compatible = [
+            name
+            for name in names
+            if folded.startswith(name.casefold()) or name.casefold().startswith(folded)
+        ]
+        if not compatible:
+            return None
+        longest = max(compatible, key=len)
+        return longest if folded.startswith(longest.casefold()) else None
+
+    def parse(self, text: str) -> tuple["CharacterAction | None", bool]:
+        """
+        Parse a prefix of a command string into a partial action, and whether it is complete.
+        """
+        skills = {skill.name: skill for skill in self.protagonist.skills}
+        name = self.match_name(text, list(skills))
+        if name is None:
+            return None, False
+        skill = skills[name]
+        action = CharacterAction(
+            command=name.split("_")[0], protagonist=self.protagonist, parameters=[]
+        )
+        params = [
+            param
+            for param in skill.parameter_types
+            if param != ParameterType.other  # Not part of the guided regex
+        ]
+        if not params:
+            return action, True
+
+        rest = text[len(name) :]
+        if rest and not rest[0].isspace():
+            return None, False
+        rest = rest.lstrip()
+        for i, param in enumerate(params):
+            is_last = i == len(params) - 1
+            if param in (ParameterType.character, ParameterType.location, ParameterType.item):
+                param_type = param.value[1:-1]
+                entity_name = self.match_name(
+                    rest, getattr(self.scene_index, f"{param_type}_names")
+                )
+                if entity_name is None:
+                    return action, False
+                action.parameters.append(getattr(self.scene_index, param_type)(entity_name))
+                rest = rest[len(entity_name) :]
+                if is_last:
+                    return action, True
+            elif param == ParameterType.amount:
+                match = re.match(r"\d+", rest)
+                # More digits may follow, until a separator
+                if match is None or match.end() == len(rest):
+                    return action, False
+                action.parameters.append(int(match.group()))
+                rest = rest[match.end() :]
+            elif param == ParameterType.content:
+                if not rest.startswith('"'):
+                    return action, False
+                end = rest.find('"', 1)
+                if end < 0:
+                    action.parameters.append(rest[1:])  # Content being written
+                    return action, False
+                action.parameters.append(rest[1:end])
+                rest = rest[end + 1 :]
+                if is_last:
+                    return action, True
+            if rest and not rest[0].isspace():
+                return None, False
+            rest = rest.lstrip()
+        return action, False
+
+
+def repair_action_text(
+    text: str | None,
+    protagonist: ProtagonistCharacter,
+    scene_index: SceneIndex,
+    guided_regex: re.Pattern | None = None,
+) -> str | None:
+    """
+    Repair a response that does not parse, e.g. truncated by max_tokens, from its longest prefix that
+    the guided regex accepts: the prefix itself if it is a complete command, or with the closing quote
+    of its last content if only that is missing. Return None if no such prefix exists, or if there is
+    no response at all (e.g. an API message without content).
+    With guided_regex, a prefix ending with a name that a longer one extends (Jon, of Jon Snow) is
+    complete too.
+    """
+    if not isinstance(text, str):
+        return None
+    text = text.lstrip()
+    parser = ActionStreamParser(protagonist, scene_index)
+    skills = {skill.name: skill for skill in protagonist.skills}
+    for end in range(len(text), 0, -1):
+        prefix = text[:end]
+        if guided_regex is not None and guided_regex.fullmatch(prefix):
+            return prefix
+        action, complete = parser.parse(prefix)
+        if action is None:
+            continue
+        if complete:
+            return prefix
+        skill = skills[parser.match_name(prefix, list(skills))]  # type: ignore
+        params = [param for param in skill.parameter_types if param != ParameterType.other]
+        if (
+            params
+            and params[-1] == ParameterType.content
+            and len(action.parameters) == len(params)
+        ):
+            return prefix + '"'  # Content being written when the response was cut
+    return None
+
+
+# Compiled guided regexes, keyed by the fingerprints of the skills and of the entity names
+guided_regex_cache: LRUCache[re.Pattern] = LRUCache(maxsize=256)
+
+
+def skills_fingerprint(skills: Sequence[Skill]) -> tuple:
+    """
+    What the guided regex depends on in a list of skills: their names and parameter types.
+    """
+    return tuple((skill.name, tuple(skill.parameter_types)) for skill in skills)
+
+
+def compile_guided_regex(skills: Sequence[Skill], names: EntityNames) -> re.Pattern:
+    """
+    Compose the regex fragments of the skills with the entity names, and compile the combined pattern.
+    Both are memoised by (skill set, entity set), so unchanged scenes reuse the same re.Pattern.
+    """
+    return guided_regex_cache.get_or_create(
+        (skills_fingerprint(skills), names),
+        lambda: re.compile(
+            "|".join(
+                skill.to_regex(names.characters, names.locations, names.items)
+                for skill in skills
+            ),
+            re.IGNORECASE,
+        ),
+    )
+
 
 def get_guided_regex(
     skills: list[Skill],
     authorized_characters: list[Character],
     authorized_locations: list[Location],
     authorized_items: list[Item],
+    scene_index: SceneIndex | None = None,
 ) -> re.Pattern:
     """
     Generate a combined regex pattern for all the skills of the protagonist.
     """
-    # Get names of al authorized characters, locations, and items
-    characters_names = [char.name for char in authorized_characters]
-    locations_names = [loc.name for loc in authorized_locations]
-    items_names = [item.name for item in authorized_items]
-
-    # Generate a combined regex pattern for all skills
-    combined_regex_parts = [
-        skill.to_regex(characters_names, locations_names, items_names)
-        for skill in skills
-    ]
-    combined_regex = "|".join(combined_regex_parts)
-    return re.compile(combined_regex, re.IGNORECASE)
+    if scene_index is None:
+        scene_index = SceneIndex(
+            authorized_characters, authorized_locations, authorized_items
+        )
+    return compile_guided_regex(skills, scene_index.names)
+
+
+def get_guided_completions(
+    skills: list[Skill],
+    scene_index: SceneIndex,
+    limit: int,
+) -> list[str] | None:
+    """
+    Enumerate the completions allowed by the guided regex of the protagonist's skills,
+    or return None if there are more than limit of them (or infinitely many).
+    """
+    completions: list[str] = []
+    for skill in skills:
+        skill_completions = skill.completions(
+            scene_index.character_names,
+            scene_index.location_names,
+            scene_index.item_names,
+            limit,
+        )
+        if skill_completions is None:
+            return None
+        completions.extend(skill_completions)
+    completions = list(dict.fromkeys(completions))
+    if not completions or len(completions) > limit:
+        return None
+    return completions
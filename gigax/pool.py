@@ -0,0 +1,395 @@
+"""This module contains a stepper running model replicas in worker processes, for many-core machines."""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import traceback
+from collections.abc import AsyncIterator, Callable
+from typing import TYPE_CHECKING, Any
+
+from gigax.compact import CompactScene
+from gigax.metrics import MetricsHook, StepMetrics
+from gigax.parse import CharacterAction, ProtagonistCharacter
+from gigax.scene import Character, Item, Location, SceneIndex
+from gigax.step import StepRequest
+
+if TYPE_CHECKING:
+    from typing import Self
+
+logger = logging.getLogger("uvicorn")
+
+ModelFactory = Callable[[int], Any]
+
+
+class LlamaCppReplica:
+    """
+    Loads a GGUF model with llama.cpp in a worker process, with the worker's thread count.
+    Weights are memory-mapped read-only, so the replicas share their pages in the OS page cache.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 2048, **llama_kwargs):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.llama_kwargs = llama_kwargs
+
+    def __call__(self, n_threads: int):
+        from llama_cpp import Llama
+        from outlines import models
+
+        llm = Llama(
+            model_path=self.model_path,
+            n_ctx=self.n_ctx,
+            n_threads=n_threads,
+            n_threads_batch=n_threads,
+            use_mmap=True,
+            use_mlock=False,
+            verbose=False,
+            **self.llama_kwargs,
+        )
+        return models.LlamaCpp(llm)  # type: ignore
+
+
+class TransformersReplica:
+    """
+    Loads a transformers model in a worker process, with the worker's torch thread count.
+    """
+
+    def __init__(self, model_name: str, **model_kwargs):
+        self.model_name = model_name
+        self.model_kwargs = model_kwargs
+
+    def __call__(self, n_threads: int):
+        import torch
+        from outlines import models
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        torch.set_num_threads(n_threads)
+        return models.Transformers(
+            AutoModelForCausalLM.from_pretrained(self.model_name, **self.model_kwargs),
+            AutoTokenizer.from_pretrained(self.model_name),
+        )
+
+
+def split_cores(cores: list[int], replicas: int) -> list[list[int]]:
+    """
+    Split the available cores into one contiguous subset per replica.
+    With fewer cores than replicas, replicas share cores.
+    """
+    if len(cores) < replicas:
+        return [[cores[i % len(cores)]] for i in range(replicas)]
+    size, extra = divmod(len(cores), replicas)
+    subsets, start = [], 0
+    for i in range(replicas):
+        end = start + size + (i < extra)
+        subsets.append(cores[start:end])
+        start = end
+    return subsets
+
+
+def run_worker(
+    conn, model_factory: ModelFactory, cores: list[int], n_threads: int, stepper_kwargs: dict
+):
+    """
+    Entry point of a worker process: step the batches received on conn, one at a time.
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Before any OpenMP runtime is loaded
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+
+    from gigax.step import NPCStepper
+
+    collected: list[StepMetrics] = []
+    try:
+        stepper = NPCStepper(
+            model=model_factory(n_threads), metrics_hooks=[collected.append], **stepper_kwargs
+        )
+    except Exception:
+        logger.exception("Error while loading the model in a worker")
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ready", os.getpid()))
+
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            task_id, batch = message
+            try:
+                actions = loop.run_until_complete(
+                    stepper.get_actions(batch, return_exceptions=True)
+                )
+                conn.send((task_id, actions, collected[:]))
+            except Exception as e:
+                logger.exception(f"Error while stepping a batch of {len(batch)} NPCs in a worker")
+                conn.send((task_id, RuntimeError(f"Worker error: {e!r}"), collected[:]))
+            collected.clear()
+    finally:
+        stepper.close()
+        loop.close()
+
+
+class Worker:
+    """
+    A worker process, with the futures of the batches sent to it.
+    """
+
+    def __init__(self, process, conn, cores: list[int]):
+        self.process = process
+        self.conn = conn
+        self.cores = cores
+        self.in_flight = 0
+        self.futures: dict[int, asyncio.Future] = {}
+        self.send_lock = threading.Lock()
+        self.reader: threading.Thread | None = None
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class StepperPool:
+    """
+    Steps NPCs with replicas of a local model, each loaded in its own process by model_factory(n_threads),
+    pinned to its own subset of the cores. Each batch goes to the least-loaded replica.
+    Same step API as NPCStepper, so it can back a DynamicBatcher, TickScheduler or StepServer;
+    stepper_kwargs configure the NPCStepper of each replica.
+    """
+
+    def __init__(
+        self,
+        model_factory: ModelFactory,
+        replicas: int = 2,
+        threads_per_replica: int | None = None,
+        pin_cores: bool = True,
+        metrics_hooks: list[MetricsHook] | None = None,
+        start_timeout: float = 600.0,
+        **stepper_kwargs,
+    ):
+        if replicas < 1:
+            raise ValueError(f"replicas must be at least 1, got {replicas}")
+        self.model_factory = model_factory
+        self.replicas = replicas
+        self.threads_per_replica = threads_per_replica
+        self.pin_cores = pin_cores
+        self.metrics_hooks = list(metrics_hooks or [])
+        self.start_timeout = start_timeout
+        self.stepper_kwargs = stepper_kwargs
+        self.workers: list[Worker] = []
+        self._task_ids = itertools.count()
+
+    def start(self):
+        """
+        Start the worker processes, and wait for their models to be loaded.
+        """
+        if self.workers:
+            return
+        available = (
+            sorted(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else list(range(os.cpu_count() or 1))
+        )
+        # Spawned workers do not inherit the parent's threads and locks
+        context = multiprocessing.get_context("spawn")
+        for cores in split_cores(available, self.replicas):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                args=(
+                    child_conn,
+                    self.model_factory,
+                    cores if self.pin_cores else [],
+                    self.threads_per_replica or len(cores),
+                    self.stepper_kwargs,
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.workers.append(Worker(process, conn, cores))
+
+        for worker in self.workers:
+            try:
+                if worker.conn.poll(self.start_timeout):
+                    status, detail = worker.conn.recv()
+                else:
+                    status, detail = "error", f"Timed out after {self.start_timeout}s."
+            except EOFError:
+                status, detail = "error", "The process exited."
+            if status != "ready":
+                self.close()
+                raise RuntimeError(f"A worker failed to load its model:\n{detail}")
+            logger.info(f"Worker {detail} ready on cores {worker.cores}")
+            worker.reader = threading.Thread(target=self.read, args=(worker,), daemon=True)
+            worker.reader.start()
+
+    async def astart(self):
+        """
+        Same as start, without blocking the event loop while the models are loaded.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.start)
+
+    async def __aenter__(self) -> "Self":
+        await self.astart()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def read(self, worker: Worker):
+        """
+        Hand the results of a worker to the event loops awaiting them.
+        """
+        while True:
+            try:
+                task_id, result, metrics = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            future = worker.futures.pop(task_id)
+            for step_metrics in metrics:
+                self.emit_metrics(step_metrics)
+            future.get_loop().call_soon_threadsafe(self._resolve, future, result)
+        # The worker is gone: fail whatever it still had to step
+        for future in list(worker.futures.values()):
+            future.get_loop().call_soon_threadsafe(
+                self._resolve, future, RuntimeError("The worker process exited.")
+            )
+        worker.futures.clear()
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result):
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def emit_metrics(self, metrics: StepMetrics):
+        for hook in self.metrics_hooks:
+            try:
+                hook(metrics)
+            except Exception:
+                logger.exception(f"Error in metrics hook {hook}")
+
+    def least_loaded(self) -> Worker:
+        alive = [worker for worker in self.workers if worker.process.is_alive()]
+        if not alive:
+            raise RuntimeError("No worker process is running.")
+        return min(alive, key=lambda worker: worker.in_flight)
+
+    async def get_actions(
+        self, batch: list[StepRequest], return_exceptions: bool = False
+    ) -> list[CharacterAction]:
+        """
+        Step a batch on the least-loaded replica. Same semantics as NPCStepper.get_actions.
+        The pool must have been started, with start(), astart() or `async with pool`.
+        """
+        if not self.workers:
+            raise RuntimeError("The pool is not started: call start() or use `async with pool`.")
+        worker = self.least_loaded()
+        task_id = next(self._task_ids)
+        future = asyncio.get_running_loop().create_future()
+        worker.futures[task_id] = future
+        worker.in_flight += len(batch)
+        try:
+            # A busy worker is not reading its pipe: a large batch would block until it is
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, worker.send, (task_id, batch)
+                )
+            except BaseException:
+                worker.futures.pop(task_id, None)
+                raise
+            actions = await future
+        finally:
+            worker.in_flight -= len(batch)
+        if not return_exceptions:
+            for action in actions:
+                if isinstance(action, Exception):
+                    raise action
+        return actions
+
+    async def get_action(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        scene_index: SceneIndex | CompactScene | None = None,
+        guided_regex: re.Pattern | None = None,
+        prompt_prefix: str | None = None,
+    ) -> CharacterAction:
+        """
+        Prompt the NPC for an input, on the least-loaded replica.
+        The scene index, guided regex and prompt prefix are accepted for compatibility with
+        NPCStepper.get_action, e.g. from a Scene session, but not sent: each replica derives them
+        from the scene, which costs less than pickling them through its pipe.
+        """
+        request = StepRequest(
+            context=context,
+            locations=locations,
+            NPCs=NPCs,
+            protagonist=protagonist,
+            items=items,
+            events=events,
+        )
+        (action,) = await self.get_actions([request])
+        return action
+
+    async def stream_action(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        scene_index: SceneIndex | CompactScene | None = None,
+        guided_regex: re.Pattern | None = None,
+        prompt_prefix: str | None = None,
+    ) -> AsyncIterator[CharacterAction]:
+        """
+        Same as NPCStepper.stream_action, except that the replicas do not send partial actions:
+        only the complete action is yielded, once it is stepped.
+        """
+        yield await self.get_action(
+            context,
+            locations,
+            NPCs,
+            protagonist,
+            items,
+            events,
+            scene_index=scene_index,
+            guided_regex=guided_regex,
+            prompt_prefix=prompt_prefix,
+        )
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        for worker in self.workers:
+            try:
+                worker.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            if worker.reader is not None:
+                worker.reader.join(timeout=10)
+            worker.conn.close()
+        self.workers = []
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,177 @@
+"""This module contains the cache of model states after the prompt prefix shared by the NPCs of a scene."""
+
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any
+
+from gigax.cache import CacheStats
+
+if TYPE_CHECKING:
+    from outlines import models
+
+
+def kv_cache_nbytes(kv_cache: Any) -> int:
+    """
+    Size in bytes of a transformers KV cache, either legacy tuples of tensors or a Cache object.
+    """
+    if hasattr(kv_cache, "to_legacy_cache"):
+        kv_cache = kv_cache.to_legacy_cache()
+    if isinstance(kv_cache, (tuple, list)):
+        return sum(kv_cache_nbytes(x) for x in kv_cache)
+    if hasattr(kv_cache, "element_size"):
+        return kv_cache.numel() * kv_cache.element_size()
+    return 0
+
+
+def expand_kv_cache(kv_cache: Any, batch_size: int) -> Any:
+    """
+    Repeat a transformers KV cache of a single sequence along the batch dimension.
+    """
+    if hasattr(kv_cache, "to_legacy_cache"):
+        return type(kv_cache).from_legacy_cache(
+            expand_kv_cache(kv_cache.to_legacy_cache(), batch_size)
+        )
+    if isinstance(kv_cache, (tuple, list)):
+        return tuple(expand_kv_cache(x, batch_size) for x in kv_cache)
+    return kv_cache.repeat(batch_size, *[1] * (kv_cache.dim() - 1))
+
+
+def common_prefix_length(a: list[int], b: list[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache:
+    """
+    Model states (llama.cpp state or transformers past_key_values) after a prompt prefix,
+    keyed by the prefix tokens, with least-recently-used eviction under a memory budget.
+    A cache holds the states of a single model, e.g. that of its stepper. Generation threads
+    share it under lock, e.g. the stepper's.
+    """
+
+    def __init__(self, max_bytes: int, lock: "threading.Lock | None" = None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.stats = CacheStats()
+        self.lock = lock if lock is not None else threading.Lock()
+        self._data: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @staticmethod
+    def key(tokens: list[int]) -> tuple:
+        digest = hashlib.sha256(" ".join(map(str, tokens)).encode()).hexdigest()
+        return (len(tokens), digest)
+
+    def get(self, key: tuple) -> Any | None:
+        with self.lock:
+            if key not in self._data:
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key: tuple, state: Any, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (state, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._data.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.stats.evictions += 1
+
+    def load_llamacpp(self, llm: "models.LlamaCpp", chat_prompt: str, chat_prefix: str):
+        """
+        Load the llama.cpp state after chat_prefix, evaluating and caching it on a miss.
+        llama-cpp-python then only evaluates the tokens of chat_prompt that follow the prefix.
+        """
+        llama = llm.model
+        prompt_tokens = llama.tokenize(chat_prompt.encode("utf-8"), special=True)
+        prefix_tokens = llama.tokenize(chat_prefix.encode("utf-8"), special=True)
+        # Tokens may merge across the prefix boundary: only keep the tokens both share
+        length = common_prefix_length(prompt_tokens, prefix_tokens)
+        if length == 0:
+            return
+        prefix_tokens = prompt_tokens[:length]
+
+        key = self.key(prefix_tokens)
+        state = self.get(key)
+        if state is None:
+            llama.reset()
+            llama.eval(prefix_tokens)
+            state = llama.save_state()
+            self.put(key, state, state.llama_state_size)
+        else:
+            llama.load_state(state)
+
+    def wrap_transformers(
+        self, llm: "models.Transformers", chat_prompt: str, chat_prefix: str
+    ) -> "PrefixedTransformers | models.Transformers":
+        """
+        Return a model whose first forward pass starts from the cached past_key_values of chat_prefix.
+        """
+        import torch
+
+        prompt_ids, _ = llm.tokenizer.encode([chat_prompt])
+        prefix_ids, _ = llm.tokenizer.encode([chat_prefix])
+        length = common_prefix_length(prompt_ids[0].tolist(), prefix_ids[0].tolist())
+        # At least one token must remain to compute the logits of the first generated token
+        length = min(length, prompt_ids.shape[1] - 1)
+        if length <= 0:
+            return llm
+
+        key = self.key(prompt_ids[0, :length].tolist())
+        past_key_values = self.get(key)
+        if past_key_values is None:
+            with torch.inference_mode():
+                output = llm.model(
+                    prompt_ids[:, :length].to(llm.device),
+                    return_dict=True,
+                    use_cache=True,
+                )
+            past_key_values = output.past_key_values
+            self.put(key, past_key_values, kv_cache_nbytes(past_key_values))
+        return PrefixedTransformers(llm, past_key_values, length)
+
+
+class PrefixedTransformers:
+    """
+    Transformers model wrapper for outlines' sequence generator, which resumes from a cached prefix.
+    """
+
+    def __init__(self, llm: "models.Transformers", past_key_values: Any, prefix_length: int):
+        self.llm = llm
+        self.tokenizer = llm.tokenizer
+        self.device = llm.device
+        self.past_key_values = past_key_values
+        self.prefix_length = prefix_length
+
+    def __call__(self, input_ids, attention_mask, past_key_values=None):
+        if past_key_values is not None:
+            return self.llm(input_ids, attention_mask, past_key_values)
+
+        import torch
+
+        with torch.inference_mode():
+            output = self.llm.model(
+                input_ids[..., self.prefix_length :],
+                attention_mask=attention_mask,
+                # Cache objects are updated in place, so the cached prefix is never handed out directly
+                past_key_values=copy.deepcopy(self.past_key_values),
+                return_dict=True,
+                output_attentions=False,
+                output_hidden_states=False,
+            )
+        return output.logits[..., -1, :], output.past_key_values
@@ -1,28 +1,72 @@
-import outlines
+import inspect
+import re
+from collections.abc import Callable
+from typing import Literal
+
+from jinja2 import Environment, StrictUndefined, Template
+
+from gigax.cache import LRUCache
+from gigax.parse import CharacterAction
 from gigax.scene import (
     Character,
     Item,
     Location,
     ProtagonistCharacter,
 )
-from typing import Literal
-from gigax.parse import CharacterAction
-from jinja2 import Template
 
 
-@outlines.prompt
-def NPCPrompt(
+class PromptTemplate:
+    """
+    Prompt function whose docstring is a Jinja2 template, rendered like outlines.prompt does,
+    but compiled once, and without importing outlines in API mode.
+    """
+
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.signature = inspect.signature(fn)
+        self.template = fn.__doc__ or ""
+        # Dedent, and keep the trailing linebreak of templates ending with an empty line
+        cleaned = inspect.cleandoc(self.template)
+        if self.template.replace(" ", "").endswith("\n\n"):
+            cleaned += "\n"
+        cleaned = re.sub(r"(?![\r\n])(\b\s+)", " ", cleaned)
+        env = Environment(
+            trim_blocks=True,
+            lstrip_blocks=True,
+            keep_trailing_newline=True,
+            undefined=StrictUndefined,
+        )
+        self.compiled = env.from_string(cleaned)
+
+    def __call__(self, *args, **kwargs) -> str:
+        arguments = self.signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        return self.compiled.render(**arguments.arguments)
+
+    def __str__(self) -> str:
+        return self.template
+
+
+@PromptTemplate
+def NPCPromptPrefix(
     context: str,
     locations: list[Location],
     NPCs: list[Character],
-    protagonist: ProtagonistCharacter,
-    items: list[Item],
-    events: list[CharacterAction],
 ):
     """
     - WORLD KNOWLEDGE: {{ context }}
     - KNOWN LOCATIONS: {{ locations | map(attribute='name') | join(', ') }}
     - NPCS: {{ NPCs | map(attribute='name') | join(', ') }}
+    """
+
+
+@PromptTemplate
+def NPCPromptSuffix(
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+    events: list[CharacterAction],
+):
+    """
     - CURRENT LOCATION: {{ protagonist.current_location.name }}: {{ protagonist.current_location.description }}
     - CURRENT LOCATION ITEMS: {{ items | map(attribute='name') | join(', ') }}
     - LAST EVENTS:
@@ -49,6 +93,123 @@ def NPCPrompt(
     """
 
 
+def NPCPrompt(
+    context: str,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+    events: list[CharacterAction],
+    prefix: str | None = None,
+) -> str:
+    """
+    Render the full NPC prompt.
+    It is split into a prefix shared by every NPC of a scene, and a suffix specific to the protagonist,
+    so that the model state after the prefix can be cached and reused. The prefix is only rendered if
+    not given, e.g. by a Scene session that keeps it between steps.
+    """
+    if prefix is None:
+        prefix = NPCPromptPrefix(context, locations, NPCs)
+    return (
+        prefix
+        + "\n"
+        + NPCPromptSuffix(protagonist, items, events)
+    )
+
+
+def approximate_token_count(text: str) -> int:
+    """
+    Rough token count (about 4 characters per token), for when the model's tokenizer is not available.
+    """
+    return len(text) // 4 + 1
+
+
+class NPCPromptBuilder:
+    """
+    Renders NPCPrompt within a token budget.
+    The protagonist's quests are kept first, then as many of the most recent events as fit,
+    then as many of the most recent memories as fit; the rest is left out of the prompt.
+    Token counts are cached per line, and for the prompt prefix and the rest of the base prompt,
+    so only new events and memories, or a changed scene, are tokenized at each step.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+        max_events: int = 50,
+        token_count_cache_size: int = 4096,
+    ):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.max_events = max_events
+        self.token_counts: LRUCache[int] = LRUCache(maxsize=token_count_cache_size)
+
+    def text_tokens(self, text: str) -> int:
+        return self.token_counts.get_or_create(text, lambda: self.count_tokens(text))
+
+    def line_tokens(self, line: str) -> int:
+        """
+        Token count of a prompt line, including its newline.
+        """
+        return self.text_tokens(line) + 1
+
+    def fit(self, lines: list[str], budget: int) -> tuple[list[int], int]:
+        """
+        Return the indices of the most recent (last) lines that fit in the budget, and the budget left.
+        """
+        kept = []
+        for i in range(len(lines) - 1, -1, -1):
+            cost = self.line_tokens(lines[i])
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append(i)
+        return kept[::-1], budget
+
+    def __call__(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        prefix: str | None = None,
+    ) -> str:
+        if prefix is None:
+            prefix = NPCPromptPrefix(context, locations, NPCs)
+        # Only the last max_events events are ever considered, however long the history is
+        events = events[-self.max_events :]
+        bare_protagonist = protagonist.model_copy(update={"memories": [], "quests": []})
+        # The base prompt is the prefix, and the suffix without events, memories nor quests
+        budget = (
+            self.max_tokens
+            - self.line_tokens(prefix)
+            - self.text_tokens(NPCPromptSuffix(bare_protagonist, items, []))
+        )
+
+        quests, budget = self.fit(protagonist.quests, budget)
+        kept_events, budget = self.fit([str(event) for event in events], budget)
+        memories, budget = self.fit(protagonist.memories, budget)
+
+        windowed_protagonist = protagonist.model_copy(
+            update={
+                "memories": [protagonist.memories[i] for i in memories],
+                "quests": [protagonist.quests[i] for i in quests],
+            }
+        )
+        return NPCPrompt(
+            context,
+            locations,
+            NPCs,
+            windowed_protagonist,
+            items,
+            [events[i] for i in kept_events],
+            prefix,
+        )
+
+
 def llama_chat_template(
     message: list[dict[Literal["role", "content"], str]],
     bos_token: str,
@@ -56,3 +217,39 @@ def llama_chat_template(
 ):
     tpl = Template(chat_template)
     return tpl.render(messages=message, bos_token=bos_token)
+
+
+class LlamaChatFormatter:
+    """
+    Chat template of a llama.cpp model, compiled once, with its BOS token looked up once.
+    When the template renders the user message verbatim, the chat prompt is split into a fixed header
+    and footer around it, so that formatting a prompt is a plain concatenation.
+    """
+
+    SENTINEL = "<|gigax-content|>"
+    PROBE = "  gigax\n probe  "
+
+    def __init__(self, llama):
+        self.bos_token = llama._model.token_get_text(
+            int(llama.metadata["tokenizer.ggml.bos_token_id"])
+        )
+        self.template = Template(llama.metadata["tokenizer.chat_template"])
+
+        self.header: str | None = None
+        self.footer: str | None = None
+        rendered = self.render(self.SENTINEL)
+        if rendered.count(self.SENTINEL) == 1:
+            header, footer = rendered.split(self.SENTINEL)
+            # Templates may strip or escape the message: only keep the split if it is exact
+            if self.render(self.PROBE) == header + self.PROBE + footer:
+                self.header, self.footer = header, footer
+
+    def render(self, content: str) -> str:
+        return self.template.render(
+            messages=[{"role": "user", "content": content}], bos_token=self.bos_token
+        )
+
+    def __call__(self, content: str) -> str:
+        if self.header is None:
+            return self.render(content)
+        return self.header + content + self.footer  # type: ignore
@@ -0,0 +1,293 @@
+"""This module contains a recorder of NPC steps to JSONL traces, and a benchmark replaying them."""
+
+import asyncio
+import math
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+from pydantic import BaseModel
+
+from gigax.metrics import StepMetrics
+from gigax.parse import CharacterAction, ProtagonistCharacter
+from gigax.scene import Character, Item, Location, Object
+from gigax.step import NPCStepper, StepRequest
+
+T = TypeVar("T")
+
+
+def action_to_command(action: CharacterAction) -> str:
+    """
+    The command string the model generated for an action, e.g.: Say John "Hello"
+    """
+    params = []
+    for param in action.parameters:
+        if isinstance(param, Object):
+            params.append(param.name)
+        elif isinstance(param, str):
+            params.append(f'"{param}"')  # Contents are the only string parameters
+        else:
+            params.append(str(param))
+    return " ".join([action.command, *params])
+
+
+class TraceEntry(BaseModel):
+    """
+    One recorded step: its inputs, the model's raw response, and the resulting action.
+    """
+
+    request: StepRequest
+    response: str
+    action: str
+    seconds: float
+    retries: list[str] = []  # Regenerated responses, if the first one did not parse
+
+
+# Metrics of the steps made by the current call to a StepRecorder, collected by its metrics hook
+_recorded: ContextVar[list[StepMetrics] | None] = ContextVar("recorded", default=None)
+
+
+class StepRecorder:
+    """
+    Wraps a stepper, appending the inputs and outputs of every step to a JSONL trace.
+    The raw responses are taken from the step metrics, so that parse failures replay as well.
+    The trace is written in order by a single thread, off the event loop.
+    """
+
+    def __init__(self, stepper: NPCStepper, path: str):
+        self.stepper = stepper
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        stepper.metrics_hooks.append(self.collect)
+
+    def collect(self, metrics: StepMetrics):
+        recorded = _recorded.get()
+        if recorded is not None:
+            recorded.append(metrics)
+
+    async def recording(
+        self, step: Callable[[], Awaitable[T]]
+    ) -> tuple[T, list[list[str]]]:
+        """
+        Await step(), and return its result with the raw responses of each of its steps.
+        The metrics hook is called in the task of the step, so concurrent calls are told apart.
+        """
+        recorded: list[StepMetrics] = []
+        token = _recorded.set(recorded)
+        try:
+            result = await step()
+        finally:
+            _recorded.reset(token)
+        return result, recorded[-1].responses if recorded else []
+
+    @staticmethod
+    def entry(
+        request: StepRequest,
+        action: CharacterAction,
+        seconds: float,
+        responses: list[str],
+    ) -> TraceEntry:
+        # Steps without generation (cached, or a single allowed action) replay their action
+        responses = responses or [action_to_command(action)]
+        return TraceEntry(
+            request=request,
+            response=responses[0],
+            action=str(action),
+            seconds=seconds,
+            retries=responses[1:],
+        )
+
+    async def record(self, entries: list[TraceEntry]):
+        lines = "".join(entry.model_dump_json() + "\n" for entry in entries)
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._write, lines)
+
+    def _write(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    def close(self):
+        """
+        Wait for the trace to be written, and stop recording the stepper.
+        """
+        self._writer.shutdown()
+        self.stepper.metrics_hooks.remove(self.collect)
+
+    async def get_action(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+    ) -> CharacterAction:
+        start = time.perf_counter()
+        action, responses = await self.recording(
+            lambda: self.stepper.get_action(
+                context, locations, NPCs, protagonist, items, events
+            )
+        )
+        request = StepRequest(
+            context=context,
+            locations=locations,
+            NPCs=NPCs,
+            protagonist=protagonist,
+            items=items,
+            events=events,
+        )
+        seconds = time.perf_counter() - start
+        await self.record(
+            [self.entry(request, action, seconds, responses[0] if responses else [])]
+        )
+        return action
+
+    async def get_actions(
+        self, batch: list[StepRequest], return_exceptions: bool = False
+    ) -> list[CharacterAction]:
+        start = time.perf_counter()
+        actions, responses = await self.recording(
+            lambda: self.stepper.get_actions(batch, return_exceptions=return_exceptions)
+        )
+        seconds = time.perf_counter() - start
+        await self.record(
+            [
+                self.entry(request, action, seconds, step_responses)
+                for request, action, step_responses in zip(batch, actions, responses)
+                if not isinstance(action, Exception)
+            ]
+        )
+        return actions
+
+
+def load_trace(path: str) -> list[TraceEntry]:
+    with open(path, encoding="utf-8") as f:
+        return [TraceEntry.model_validate_json(line) for line in f if line.strip()]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile, e.g. q=0.95 for the p95.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+@dataclass
+class ReplayReport:
+    """
+    Step latencies and throughput of a replayed trace, with the per-phase breakdown.
+    """
+
+    latencies: list[float] = field(default_factory=list)
+    phases: dict[str, list[float]] = field(default_factory=dict)
+    seconds: float = 0.0
+    mismatches: int = 0  # Steps whose action differs from the recorded one
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "steps": len(self.latencies),
+            "mismatches": self.mismatches,
+            "throughput": self.throughput,
+            "latency": {
+                f"p{round(q * 100)}": percentile(self.latencies, q) for q in (0.5, 0.95, 0.99)
+            },
+            "phases": {
+                phase: {"mean": sum(values) / len(values), "p95": percentile(values, 0.95)}
+                for phase, values in self.phases.items()
+            },
+        }
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        lines = [
+            (
+                f"{summary['steps']} steps, {summary['mismatches']} mismatches, "
+                f"{summary['throughput']:.1f} steps/s"
+            ),
+            "latency (ms): "
+            + ", ".join(f"{k} {v * 1e3:.2f}" for k, v in summary["latency"].items()),
+        ]
+        for phase, stats in summary["phases"].items():
+            lines.append(
+                f"  {phase:<14} mean {stats['mean'] * 1e3:8.3f} ms   p95 {stats['p95'] * 1e3:8.3f} ms"
+            )
+        return "\n".join(lines)
+
+
+def trace_responder(stepper: NPCStepper, trace: list[TraceEntry]) -> Callable[[str], str]:
+    """
+    respond(prompt) for the fake models of gigax.fakes, replying to each recorded prompt with its
+    recorded responses in turn: the first one, then the regenerated ones.
+    """
+    responses: dict[str, deque[str]] = {}
+    for entry in trace:
+        prompt = stepper.render_prompt(
+            context=entry.request.context,
+            locations=entry.request.locations,
+            NPCs=entry.request.NPCs,
+            protagonist=entry.request.protagonist,
+            items=entry.request.items,
+            events=entry.request.events,
+        )
+        responses.setdefault(prompt, deque()).extend([entry.response, *entry.retries])
+
+    def respond(prompt: str) -> str:
+        queue = responses.get(prompt)
+        if not queue:
+            return ""
+        # The last response is kept for any further request
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    return respond
+
+
+async def replay(
+    stepper: NPCStepper, trace: list[TraceEntry], concurrency: int = 1
+) -> ReplayReport:
+    """
+    Step every request of the trace again, up to concurrency at a time, and report their latencies.
+    The stepper's model is expected to give the recorded responses, e.g. a fake model of gigax.fakes
+    using trace_responder.
+    """
+    report = ReplayReport()
+
+    def collect(metrics: StepMetrics):
+        for phase, seconds in metrics.phases.items():
+            report.phases.setdefault(phase, []).append(seconds)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def step(entry: TraceEntry):
+        async with semaphore:
+            start = time.perf_counter()
+            request = entry.request
+            action = await stepper.get_action(
+                request.context,
+                request.locations,
+                request.NPCs,
+                request.protagonist,
+                request.items,
+                request.events,
+            )
+            report.latencies.append(time.perf_counter() - start)
+            if str(action) != entry.action:
+                report.mismatches += 1
+
+    stepper.metrics_hooks.append(collect)
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(step(entry) for entry in trace))
+    finally:
+        report.seconds = time.perf_counter() - start
+        stepper.metrics_hooks.remove(collect)
+    return report
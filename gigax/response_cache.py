@@ -0,0 +1,64 @@
+"""This module contains the cache of model responses, for NPCs prompted with the same scene again."""
+
+import hashlib
+import json
+import random
+from typing import Any, Protocol
+
+from gigax.cache import CacheStats, TTLCache
+
+
+class ResponseCacheBackend(Protocol):
+    """
+    Storage of the cached responses, e.g. in-process (TTLCache) or shared between processes.
+    Backends are responsible for expiring and evicting entries.
+    """
+
+    def get(self, key: str) -> list[str] | None: ...
+
+    def put(self, key: str, value: list[str]) -> None: ...
+
+
+class ResponseCache:
+    """
+    Responses of the model, keyed by a stable hash of the rendered prompt, guided regex, model and
+    sampling parameters. Up to `candidates` different responses are kept per key: until there are
+    that many, lookups miss so that new ones get generated, then a random one is returned.
+    With deterministic sampling (temperature 0), a single response is kept.
+    """
+
+    def __init__(
+        self,
+        backend: ResponseCacheBackend | None = None,
+        maxsize: int = 1024,
+        ttl: float = 60.0,
+        candidates: int = 1,
+        namespace: str = "",
+    ):
+        self.backend = backend or TTLCache(maxsize=maxsize, ttl=ttl)
+        self.candidates = candidates
+        self.namespace = namespace
+        self.stats = CacheStats()
+
+    def key(self, prompt: str, guided_regex: str, model: str, sampling: dict[str, Any]) -> str:
+        data = json.dumps(
+            [self.namespace, model, sampling, guided_regex, prompt], sort_keys=True
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def max_candidates(self, sampling: dict[str, Any]) -> int:
+        return 1 if sampling.get("temperature", 1.0) == 0 else self.candidates
+
+    def get(self, key: str, sampling: dict[str, Any]) -> str | None:
+        responses = self.backend.get(key)
+        if not responses or len(responses) < self.max_candidates(sampling):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return random.choice(responses)
+
+    def put(self, key: str, response: str, sampling: dict[str, Any]) -> None:
+        responses = self.backend.get(key) or []
+        if len(responses) >= self.max_candidates(sampling):
+            return
+        self.backend.put(key, responses + [response])
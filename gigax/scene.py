@@ -1,9 +1,48 @@
-from enum import Enum
 import re
+from collections.abc import Sequence
+from enum import Enum
+from functools import cached_property, lru_cache
 from typing import Union
+
 from pydantic import BaseModel, Field
 
 
+@lru_cache(maxsize=256)
+def names_to_regex(names: tuple[str, ...]) -> str:
+    """
+    Alternation matching exactly the given names, factored as a prefix trie.
+    e.g.: ("John", "Johanna", "Jon") -> "Jo(?:h(?:n|anna)|n)"
+    The result is cached, so skills sharing the same entities share the same regex.
+    """
+    trie: dict = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[""] = {}  # End of a name
+
+    def to_regex(node: dict) -> str:
+        branches = []
+        optional = "" in node
+        for char, child in node.items():
+            if char == "":
+                continue
+            # Collapse chains of single-child nodes into a literal
+            literal = re.escape(char)
+            while len(child) == 1 and "" not in child:
+                (char, child), = child.items()
+                literal += re.escape(char)
+            branches.append(literal + to_regex(child))
+        if not branches:
+            return ""
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        group = f"(?:{'|'.join(branches)})"
+        return f"{group}?" if optional else group
+
+    return to_regex(trie)
+
+
 class ParameterType(str, Enum):
     character = "<character>"
     location = "<location>"
@@ -13,6 +52,35 @@ class ParameterType(str, Enum):
     other = "<other>"
 
 
+@lru_cache(maxsize=1024)
+def skill_regex_fragments(
+    name: str, parameter_types: tuple[ParameterType, ...]
+) -> tuple[tuple[str, str | None], ...]:
+    """
+    The regex of a skill, precompiled into (fragment, slot) pairs: each fixed fragment is followed by
+    the alternation of the names of an entity type ("character", "location" or "item"), or by nothing.
+    e.g.: say <character> <content> -> (("say\\s+(?P<say_character>", "character"),
+    (')\\s+(?P<say_content>"[^"]*")', None))
+    """
+    fragments = []
+    fragment = re.escape(name)
+    for param in parameter_types:
+        if param == ParameterType.other:
+            continue  # Not part of the guided regex
+        # Each group name follows format: skillname_paramtype, without <>
+        group_name = f"{name}_{param.value[1:-1]}"
+        fragment += r"\s+"
+        if param in (ParameterType.character, ParameterType.location, ParameterType.item):
+            fragments.append((f"{fragment}(?P<{group_name}>", param.value[1:-1]))
+            fragment = ")"
+        elif param == ParameterType.amount:
+            fragment += f"(?P<{group_name}>\\d+)"
+        elif param == ParameterType.content:
+            fragment += f'(?P<{group_name}>"[^"]*")'  # Match content within quotes
+    fragments.append((fragment, None))
+    return tuple(fragments)
+
+
 class Object(BaseModel):
     name: str
     description: str
@@ -74,33 +142,119 @@ class Skill(BaseModel):
 
     def to_regex(
         self,
-        character_names: list[str],
-        location_names: list[str],
-        item_names: list[str],
+        character_names: Sequence[str],
+        location_names: Sequence[str],
+        item_names: Sequence[str],
     ) -> str:
-        parts = [re.escape(self.name)]
+        names = {
+            "character": character_names,
+            "location": location_names,
+            "item": item_names,
+        }
+        return "".join(
+            fragment + (names_to_regex(tuple(names[slot])) if slot else "")
+            for fragment, slot in skill_regex_fragments(self.name, tuple(self.parameter_types))
+        )
+
+    def completions(
+        self,
+        character_names: Sequence[str],
+        location_names: Sequence[str],
+        item_names: Sequence[str],
+        limit: int,
+    ) -> list[str] | None:
+        """
+        Every string matched by to_regex, with single spaces between parameters as in the training format.
+        Returns None if there are more than limit of them, or infinitely many (amounts and contents).
+        """
+        completions = [self.name]
         for param in self.parameter_types:
-            # Each group name follows format: skillname_paramtype, without <>
-            group_name = f"{self.name}_{param.value[1:-1]}"
             if param == ParameterType.character:
-                parts.append(
-                    f"(?P<{group_name}>{'|'.join(map(re.escape, character_names))})"
-                )
+                names = character_names
             elif param == ParameterType.location:
-                parts.append(
-                    f"(?P<{group_name}>{'|'.join(map(re.escape, location_names))})"
-                )
+                names = location_names
             elif param == ParameterType.item:
-                parts.append(
-                    f"(?P<{group_name}>{'|'.join(map(re.escape, item_names))})"
-                )
-            elif param == ParameterType.amount:
-                parts.append(f"(?P<{group_name}>\\d+)")
-            elif param == ParameterType.content:
-                parts.append(
-                    f'(?P<{group_name}>"[^"]*")'
-                )  # Match content within quotes
-        return r"\s+".join(parts)
+                names = item_names
+            elif param in (ParameterType.amount, ParameterType.content):
+                return None
+            else:
+                continue
+            completions = [f"{completion} {name}" for completion in completions for name in names]
+            if len(completions) > limit:
+                return None
+        return completions
+
+
+class EntityNames:
+    """
+    The character, location and item names of a scene, as a cache key hashed only once:
+    hashing thousands of names again on every lookup would cost more than the lookup saves.
+    """
+
+    __slots__ = ("_hash", "characters", "items", "locations")
+
+    def __init__(
+        self,
+        characters: Sequence[str],
+        locations: Sequence[str],
+        items: Sequence[str],
+    ):
+        self.characters = tuple(characters)
+        self.locations = tuple(locations)
+        self.items = tuple(items)
+        self._hash = hash((self.characters, self.locations, self.items))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, EntityNames)
+            and self._hash == other._hash
+            and self.characters == other.characters
+            and self.locations == other.locations
+            and self.items == other.items
+        )
+
+
+class SceneIndex:
+    """
+    Case-folded name -> entity lookup for the characters, locations and items of a scene.
+    Built once per scene, and shared by the guided regex generation and the action parsing.
+    """
+
+    def __init__(
+        self,
+        characters: list[Character],
+        locations: list[Location],
+        items: list[Item],
+    ):
+        self.character_names = tuple(char.name for char in characters)
+        self.location_names = tuple(loc.name for loc in locations)
+        self.item_names = tuple(item.name for item in items)
+        # The first entity wins on duplicate names, as with a linear scan
+        self.characters: dict[str, Character] = {}
+        for char in characters:
+            self.characters.setdefault(char.name.casefold(), char)
+        self.locations: dict[str, Location] = {}
+        for loc in locations:
+            self.locations.setdefault(loc.name.casefold(), loc)
+        self.items: dict[str, Item] = {}
+        for item in items:
+            self.items.setdefault(item.name.casefold(), item)
+
+    @cached_property
+    def names(self) -> EntityNames:
+        return EntityNames(self.character_names, self.location_names, self.item_names)
+
+    def character(self, name: str) -> Character | None:
+        return self.characters.get(name.casefold())
+
+    def location(self, name: str) -> Location | None:
+        return self.locations.get(name.casefold())
+
+    def item(self, name: str) -> Item | None:
+        return self.items.get(name.casefold())
 
 
 class ProtagonistCharacter(Character):
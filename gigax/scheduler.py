@@ -0,0 +1,222 @@
+"""This module contains a scheduler of NPC steps with priorities and deadlines, layered over NPCStepper."""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+from collections.abc import Callable
+from dataclasses import dataclass
+from enum import IntEnum
+
+from gigax.metrics import render_counter, render_gauge
+from gigax.parse import CharacterAction
+from gigax.scene import ParameterType
+from gigax.step import NPCStepper, StepRequest
+
+logger = logging.getLogger("uvicorn")
+
+
+class Priority(IntEnum):
+    """Priority classes of steps: lower values are stepped first."""
+
+    interactive = 0  # e.g. an NPC talking to a player
+    normal = 1
+    background = 2  # e.g. villagers going about their day
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a step misses its deadline and the scheduler has no fallback action."""
+
+
+@dataclass
+class DeadlineStats:
+    """Counters of the steps of one priority class."""
+
+    submitted: int = 0
+    met: int = 0
+    missed: int = 0
+    dropped: int = 0  # Missed steps that were never decoded
+
+    @property
+    def miss_rate(self) -> float:
+        total = self.met + self.missed
+        return self.missed / total if total else 0.0
+
+
+def idle_action(request: StepRequest, command: str = "Wait") -> CharacterAction:
+    """
+    Cheap fallback action: the NPC stays idle, with the skill named command (e.g. through
+    functools.partial(idle_action, command="Rest")). Raise DeadlineExceededError if the NPC
+    has no such skill, or if it takes parameters.
+    """
+    protagonist = request.protagonist
+    skill = next(
+        (s for s in protagonist.skills if s.name.casefold() == command.casefold()), None
+    )
+    if skill is None or any(p != ParameterType.other for p in skill.parameter_types):
+        raise DeadlineExceededError(
+            f"NPC {protagonist.name} missed its deadline, and has no {command} skill"
+            " without parameters to stay idle with."
+        )
+    return CharacterAction(
+        command=skill.name.split("_")[0], protagonist=protagonist, parameters=[]
+    )
+
+
+class TickScheduler:
+    """
+    Steps requests in batches, most urgent first: by priority class, then earliest deadline.
+    A step that is not done by its deadline gets the fallback action instead. A queued step
+    that cannot finish in time (based on a moving average of batch durations) is not decoded at all.
+    """
+
+    def __init__(
+        self,
+        stepper: NPCStepper,
+        max_batch_size: int = 8,
+        fallback: Callable[[StepRequest], CharacterAction] | None = idle_action,
+        smoothing: float = 0.2,
+    ):
+        self.stepper = stepper
+        self.max_batch_size = max_batch_size
+        self.fallback = fallback
+        self.smoothing = smoothing
+        # Moving average of batch durations, in seconds
+        self.step_seconds = 0.0
+        self.stats: dict[Priority, DeadlineStats] = {p: DeadlineStats() for p in Priority}
+        self._heap: list[tuple] = []
+        self._order = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._batch: list[tuple[StepRequest, asyncio.Future]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def submit(
+        self,
+        request: StepRequest,
+        priority: Priority = Priority.normal,
+        deadline: float | None = None,
+    ) -> CharacterAction:
+        """
+        Step a request, within deadline seconds if given. Past its deadline, the step returns
+        the fallback action, or raises DeadlineExceededError if there is none.
+        """
+        self.start()
+        priority = Priority(priority)
+        stats = self.stats[priority]
+        stats.submitted += 1
+        loop = asyncio.get_running_loop()
+        due = loop.time() + deadline if deadline is not None else math.inf
+        future = loop.create_future()
+        heapq.heappush(self._heap, (priority, due, next(self._order), request, future))
+        self._wakeup.set()  # type: ignore
+
+        try:
+            action = await asyncio.wait_for(asyncio.shield(future), timeout=deadline)
+        except TimeoutError:
+            future.cancel()  # The scheduler skips it if it is still queued
+        except DeadlineExceededError:
+            stats.dropped += 1
+        else:
+            stats.met += 1
+            return action
+
+        stats.missed += 1
+        logger.info(f"NPC {request.protagonist.name} missed its {deadline}s deadline")
+        if self.fallback is None:
+            raise DeadlineExceededError(
+                f"The step of NPC {request.protagonist.name} missed its {deadline}s deadline."
+            )
+        return self.fallback(request)
+
+    def next_batch(self) -> list[tuple[StepRequest, asyncio.Future]]:
+        """
+        Pop the most urgent requests, dropping those that would miss their deadline anyway.
+        """
+        now = asyncio.get_running_loop().time()
+        batch = []
+        while self._heap and len(batch) < self.max_batch_size:
+            _, due, _, request, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            if due - now < self.step_seconds:
+                future.set_exception(DeadlineExceededError())
+                continue
+            batch.append((request, future))
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._heap:
+                self._wakeup.clear()  # type: ignore
+                await self._wakeup.wait()  # type: ignore
+                continue
+            batch = self._batch = self.next_batch()
+            if not batch:
+                continue
+
+            start = loop.time()
+            try:
+                actions = await self.stepper.get_actions(
+                    [request for request, _ in batch], return_exceptions=True
+                )
+            except Exception as e:
+                logger.exception(f"Error while stepping a batch of {len(batch)} NPCs")
+                actions = [e] * len(batch)
+            duration = loop.time() - start
+            self.step_seconds += self.smoothing * (duration - self.step_seconds)
+
+            for (_, future), action in zip(batch, actions):
+                if future.done():
+                    continue
+                if isinstance(action, Exception):
+                    future.set_exception(action)
+                else:
+                    future.set_result(action)
+
+    async def close(self):
+        """
+        Stop scheduling, and fail the requests still queued.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        futures = [future for _, future in self._batch]
+        futures += [future for *_, future in self._heap]
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError("The scheduler was closed."))
+        self._batch, self._heap = [], []
+
+    def render_metrics(self, namespace: str = "gigax") -> str:
+        """
+        Return the deadline counters of each priority class in the Prometheus text format.
+        """
+        lines: list[str] = []
+        for name in ["submitted", "met", "missed", "dropped"]:
+            render_counter(
+                lines,
+                f"{namespace}_deadline_{name}_total",
+                f"Steps {name}, by priority class.",
+                {(("priority", p.name),): getattr(s, name) for p, s in self.stats.items()},
+            )
+        render_gauge(
+            lines,
+            f"{namespace}_deadline_miss_rate",
+            "Share of steps that missed their deadline, by priority class.",
+            {(("priority", p.name),): s.miss_rate for p, s in self.stats.items()},
+        )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,203 @@
+"""This module contains a local HTTP/JSON server, stepping NPCs for game servers written in any language."""
+
+import asyncio
+import json
+import logging
+from urllib.parse import urlsplit
+
+from pydantic import ValidationError
+
+from gigax.batcher import DynamicBatcher, QueueFullError
+from gigax.metrics import PrometheusExporter
+from gigax.parse import ActionParsingError
+from gigax.step import NPCStepper, StepRequest
+
+logger = logging.getLogger("uvicorn")
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class StepServer:
+    """
+    Minimal HTTP/1.1 server, with keep-alive connections, exposing:
+    - POST /step: a JSON StepRequest in, the JSON of the parsed CharacterAction out
+    - GET /health: liveness and queue state
+    - GET /metrics: step, queue and batch metrics in the Prometheus text format
+    Steps go through a DynamicBatcher, so concurrent requests are decoded together.
+    """
+
+    def __init__(
+        self,
+        stepper: NPCStepper,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_batch_size: int = 8,
+        max_wait: float = 0.005,
+        max_queue_size: int = 128,
+        max_body_size: int = 1 << 20,
+    ):
+        self.stepper = stepper
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.batcher = DynamicBatcher(
+            stepper,
+            max_batch_size=max_batch_size,
+            max_wait=max_wait,
+            max_queue_size=max_queue_size,
+        )
+        self.exporter = PrometheusExporter()
+        stepper.metrics_hooks.append(self.exporter)
+        self._server: asyncio.Server | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        """
+        Start listening. With port 0, the OS picks a free port, stored in self.port.
+        """
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Gigax server listening on {self.url}")
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:  # type: ignore
+            await self._server.serve_forever()  # type: ignore
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.batcher.close()
+        await self.stepper.aclose()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # First byte of the next request, read while watching for the client going away
+        leftover = b""
+        try:
+            while True:
+                request_line = leftover + await reader.readline()
+                leftover = b""
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                path = urlsplit(target).path
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = headers.get("connection", "").lower() != "close" and (
+                    version == "HTTP/1.1"
+                    or headers.get("connection", "").lower() == "keep-alive"
+                )
+                length = int(headers.get("content-length", 0))
+                if length > self.max_body_size:
+                    status, content_type, body = self.error(
+                        HTTPError(413, f"Request bodies are limited to {self.max_body_size} bytes.")
+                    )
+                    keep_alive = False
+                else:
+                    payload = await reader.readexactly(length) if length else b""
+                    route = asyncio.ensure_future(self.route(method, path, payload))
+                    watch = asyncio.ensure_future(reader.read(1))
+                    try:
+                        await asyncio.wait([route, watch], return_when=asyncio.FIRST_COMPLETED)
+                        gone = watch.done() and (
+                            watch.exception() is not None or watch.result() == b""
+                        )
+                        if gone and not route.done():
+                            # The client went away: its step is cancelled, and skipped if still queued
+                            break
+                        if watch.done() and not gone:
+                            leftover = watch.result()
+                        status, content_type, body = await route
+                    finally:
+                        route.cancel()
+                        watch.cancel()
+
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        + ("Retry-After: 1\r\n" if status == 429 else "")
+                        + "\r\n"
+                    ).encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, payload: bytes) -> tuple[int, str, bytes]:
+        try:
+            if path == "/step":
+                if method != "POST":
+                    raise HTTPError(405, "Use POST to step an NPC.")
+                return self.json(200, await self.step(payload))
+            if path == "/health":
+                return self.json(
+                    200,
+                    {
+                        "status": "ok",
+                        "queue_size": self.batcher.queue_size,
+                        "max_queue_size": self.batcher.max_queue_size,
+                        "in_flight": self.batcher.in_flight,
+                    },
+                )
+            if path == "/metrics":
+                metrics = self.exporter.render() + self.batcher.render_metrics()
+                return 200, "text/plain; version=0.0.4", metrics.encode("utf-8")
+            raise HTTPError(404, f"Unknown path {path}.")
+        except HTTPError as e:
+            return self.error(e)
+        except Exception:
+            logger.exception(f"Error while handling {method} {path}")
+            return self.error(HTTPError(500, "Internal server error."))
+
+    async def step(self, payload: bytes) -> dict:
+        try:
+            request = StepRequest.model_validate_json(payload)
+        except ValidationError as e:
+            raise HTTPError(400, f"Invalid step request: {e}")
+        try:
+            action = await self.batcher.submit(request)
+        except QueueFullError as e:
+            raise HTTPError(429, str(e))
+        except ActionParsingError as e:
+            raise HTTPError(422, str(e))
+        return {"action": str(action), **action.model_dump(mode="json")}
+
+    @staticmethod
+    def json(status: int, data: dict) -> tuple[int, str, bytes]:
+        return status, "application/json", json.dumps(data).encode("utf-8")
+
+    def error(self, error: HTTPError) -> tuple[int, str, bytes]:
+        return self.json(error.status, {"error": error.message})
@@ -0,0 +1,187 @@
+"""This module contains a stateful scene session, updated with deltas instead of being resubmitted at each step."""
+
+import re
+from typing import TYPE_CHECKING
+
+from gigax.parse import CharacterAction, ProtagonistCharacter, get_guided_regex
+from gigax.prompt import NPCPromptPrefix
+from gigax.scene import Character, Item, Location, SceneIndex
+from gigax.step import NPCStepper
+
+if TYPE_CHECKING:
+    from gigax.pool import StepperPool
+
+Entity = Character | Location | Item
+
+
+class Scene:
+    """
+    World state of a scene, kept between steps: the game sends small deltas (entities added, moved or
+    removed, events appended) instead of the whole world at each tick.
+    The data derived from the scene is only recomputed when a delta affects it:
+    - the name index and guided regexes when entities are added or removed,
+    - the prompt prefix when the context, locations or characters are added or removed.
+    Moving a character changes none of them, since they only depend on names.
+    Entities are identified by name, which must be unique within each kind of entity.
+    """
+
+    def __init__(
+        self,
+        context: str,
+        locations: list[Location] | None = None,
+        NPCs: list[Character] | None = None,
+        items: list[Item] | None = None,
+        events: list[CharacterAction] | None = None,
+        max_events: int | None = None,
+    ):
+        self._context = context
+        self._entities: dict[type, dict[str, Entity]] = {
+            Location: {},
+            Character: {},
+            Item: {},
+        }
+        self._lists: dict[type, list] = {}
+        self.max_events = max_events
+        self.events: list[CharacterAction] = []
+        # Derived data, reset by the deltas affecting it
+        self._index: SceneIndex | None = None
+        self._regexes: dict[tuple, re.Pattern] = {}
+        self._prefix: str | None = None
+
+        for entity in [*(locations or []), *(NPCs or []), *(items or [])]:
+            self.add(entity)
+        for event in events or []:
+            self.append_event(event)
+
+    @staticmethod
+    def kind(entity: Entity | type) -> type:
+        for kind in (Character, Location, Item):
+            if isinstance(entity, kind) or entity is kind:
+                return kind
+        raise TypeError(f"Scenes hold characters, locations and items, not {entity}")
+
+    def _entities_changed(self, kind: type):
+        self._lists.pop(kind, None)
+        self._index = None
+        self._regexes.clear()
+        if kind is not Item:  # Items are not part of the prompt prefix
+            self._prefix = None
+
+    @property
+    def context(self) -> str:
+        return self._context
+
+    @context.setter
+    def context(self, context: str):
+        if context != self._context:
+            self._context = context
+            self._prefix = None
+
+    def entities(self, kind: type) -> list:
+        entities = self._lists.get(kind)
+        if entities is None:
+            entities = self._lists[kind] = list(self._entities[kind].values())
+        return entities
+
+    @property
+    def locations(self) -> list[Location]:
+        return self.entities(Location)
+
+    @property
+    def NPCs(self) -> list[Character]:
+        return self.entities(Character)
+
+    @property
+    def items(self) -> list[Item]:
+        return self.entities(Item)
+
+    def get(self, kind: type, name: str) -> Entity | None:
+        return self._entities[self.kind(kind)].get(name)
+
+    def add(self, entity: Entity):
+        """
+        Add a character, location or item to the scene.
+        """
+        kind = self.kind(entity)
+        if entity.name in self._entities[kind]:
+            raise ValueError(f"The scene already has a {kind.__name__} named {entity.name}")
+        self._entities[kind][entity.name] = entity
+        self._entities_changed(kind)
+
+    def remove(self, kind: type, name: str) -> Entity:
+        """
+        Remove a character, location or item from the scene, and return it.
+        """
+        kind = self.kind(kind)
+        if name not in self._entities[kind]:
+            raise KeyError(f"The scene has no {kind.__name__} named {name}")
+        entity = self._entities[kind].pop(name)
+        self._entities_changed(kind)
+        return entity
+
+    def move(self, name: str, location: Location | str) -> Character:
+        """
+        Move a character to a location of the scene, and return the moved character.
+        """
+        if isinstance(location, str):
+            location = self._entities[Location][location]  # type: ignore
+        character: Character = self._entities[Character][name]  # type: ignore
+        moved = character.model_copy(update={"current_location": location})
+        self._entities[Character][name] = moved
+        self._lists.pop(Character, None)
+        # Names are unchanged: only the entity the index resolves to is replaced
+        if self._index is not None and self._index.character(name) is character:
+            self._index.characters[name.casefold()] = moved
+        return moved
+
+    def append_event(self, event: CharacterAction):
+        """
+        Add an event, dropping the oldest ones beyond max_events.
+        """
+        self.events.append(event)
+        if self.max_events is not None and len(self.events) > self.max_events:
+            del self.events[: len(self.events) - self.max_events]
+
+    @property
+    def index(self) -> SceneIndex:
+        if self._index is None:
+            self._index = SceneIndex(self.NPCs, self.locations, self.items)
+        return self._index
+
+    def guided_regex(self, protagonist: ProtagonistCharacter) -> re.Pattern:
+        """
+        Guided regex of the protagonist's skills, shared by protagonists with the same skills.
+        """
+        key = tuple(
+            (skill.name, tuple(skill.parameter_types)) for skill in protagonist.skills
+        )
+        regex = self._regexes.get(key)
+        if regex is None:
+            regex = self._regexes[key] = get_guided_regex(
+                protagonist.skills, self.NPCs, self.locations, self.items, self.index
+            )
+        return regex
+
+    @property
+    def prompt_prefix(self) -> str:
+        if self._prefix is None:
+            self._prefix = NPCPromptPrefix(self.context, self.locations, self.NPCs)
+        return self._prefix
+
+    async def get_action(
+        self, stepper: "NPCStepper | StepperPool", protagonist: ProtagonistCharacter
+    ) -> CharacterAction:
+        """
+        Prompt the protagonist for an action in the current state of the scene.
+        """
+        return await stepper.get_action(
+            self.context,
+            self.locations,
+            self.NPCs,
+            protagonist,
+            self.items,
+            self.events,
+            scene_index=self.index,
+            guided_regex=self.guided_regex(protagonist),
+            prompt_prefix=self.prompt_prefix,
+        )
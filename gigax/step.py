@@ -1,54 +1,572 @@
-import time
+import asyncio
+import contextlib
+import copy
+import functools
 import logging
-import traceback
-from openai import AsyncOpenAI
-from gigax.prompt import NPCPrompt, llama_chat_template
+import re
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+from weakref import WeakKeyDictionary
+
+from pydantic import BaseModel
+
+from gigax.cache import LRUCache
+from gigax.compact import CompactScene
+from gigax.index_store import IndexStore, tokenizer_fingerprint
+from gigax.memory import Embedder, MemoryRetriever
+from gigax.metrics import MetricsHook, StepMetrics
+from gigax.parse import (
+    ActionParsingError,
+    ActionStreamParser,
+    CharacterAction,
+    ProtagonistCharacter,
+    get_guided_completions,
+    get_guided_regex,
+    repair_action_text,
+)
+from gigax.prefix_cache import PrefixCache, expand_kv_cache
+from gigax.prompt import (
+    LlamaChatFormatter,
+    NPCPrompt,
+    NPCPromptBuilder,
+    NPCPromptPrefix,
+    approximate_token_count,
+)
+from gigax.response_cache import ResponseCache
 from gigax.scene import (
     Character,
     Item,
     Location,
+    SceneIndex,
 )
-from dotenv import load_dotenv
-from outlines import models
-from outlines.generate import regex  # type: ignore
-from gigax.parse import CharacterAction, ProtagonistCharacter, get_guided_regex
+from gigax.throttle import AdaptiveConcurrencyLimiter, SingleFlight, TokenBucket
 
-load_dotenv()
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from outlines import models
+    from outlines.fsm.guide import Guide, Instruction
 
 logger = logging.getLogger("uvicorn")
 
+API_TEMPERATURE = 0.8
+API_RETRY_BACKOFF = 0.5  # Seconds before the first retry of a failed API request, then doubled
+# Raised by CharacterAction.from_str on a response that is not a valid action (or no response at all)
+PARSE_ERRORS = (ActionParsingError, ValueError, TypeError)
+
+
+def is_retryable_api_error(error: Exception) -> bool:
+    """
+    Whether an API error is worth retrying after backing off: rate limits, server and connection errors.
+    """
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError))
+
+
+def is_llamacpp(model: object) -> bool:
+    """
+    Whether model is a local llama.cpp model. outlines is only imported for local models, which loaded it.
+    """
+    if isinstance(model, str):
+        return False
+    from outlines import models
+
+    return isinstance(model, models.LlamaCpp)
+
+
+def is_transformers(model: object) -> bool:
+    """
+    Whether model is a local transformers model.
+    """
+    if isinstance(model, str):
+        return False
+    from outlines import models
+
+    return isinstance(model, models.Transformers)
+
+
+class CancellableGuide:
+    """
+    Wraps a guide so that generation stops, by forcing EOS, as soon as cancel_event is set.
+    """
+
+    def __init__(self, guide: "Guide", cancel_event: threading.Event):
+        self.guide = guide
+        self.cancel_event = cancel_event
+        self.eos_token_id = guide.eos_token_id  # type: ignore
+
+    def get_next_instruction(self, state: int) -> "Instruction":
+        if self.cancel_event.is_set():
+            from outlines.fsm.guide import Write
+
+            return Write([self.eos_token_id])
+        return self.guide.get_next_instruction(state)
+
+    def get_next_state(self, state: int, token_id: int) -> int:
+        return self.guide.get_next_state(state, token_id)
+
+    def is_final_state(self, state: int) -> bool:
+        return self.cancel_event.is_set() or self.guide.is_final_state(state)
+
+    def copy(self) -> "CancellableGuide":
+        return CancellableGuide(self.guide.copy(), self.cancel_event)
+
+
+class StepRequest(BaseModel):
+    """
+    Everything needed to step one NPC, i.e. the arguments of NPCStepper.get_action.
+    """
+
+    context: str
+    locations: list[Location]
+    NPCs: list[Character]
+    protagonist: ProtagonistCharacter
+    items: list[Item]
+    events: list[CharacterAction]
+
+
+@dataclass
+class PreparedStep:
+    """
+    What a step derived from its scene before generation, see NPCStepper._prepare_step.
+    response is set beforehand if the step needs no generation, and cached if it was a cached one.
+    responses are the raw responses generated for the step, regenerations included.
+    """
+
+    protagonist: ProtagonistCharacter
+    NPCs: list[Character]
+    locations: list[Location]
+    items: list[Item]
+    scene_index: SceneIndex | CompactScene
+    guided_regex: re.Pattern
+    response: str | None = None
+    cached: bool = False
+    prompt: str | None = None
+    prompt_prefix: str | None = None
+    key: str | None = None
+    generate: Callable[[], Awaitable[str]] | None = None
+    responses: list[str] = field(default_factory=list)
+
 
 class NPCStepper:
     def __init__(
         self,
-        model: str | models.LogitsGenerator,
+        model: "str | models.LogitsGenerator",
         api_key: str | None = None,
         api_url: str = "https://gig.ax/llm/v1",
+        generator_cache_size: int = 32,
+        index_store: IndexStore | str | None = None,
+        local_concurrency: int = 1,
+        max_connections: int = 64,
+        max_concurrent_requests: int = 64,
+        request_timeout: float = 30.0,
+        prefix_cache_bytes: int = 0,
+        prompt_token_budget: int | None = None,
+        memory_top_k: int | None = None,
+        memory_embedder: Embedder | None = None,
+        metrics_hooks: list[MetricsHook] | None = None,
+        max_enumerated_completions: int = 0,
+        response_cache: ResponseCache | None = None,
+        max_parse_attempts: int = 2,
+        parse_retry_seconds: float | None = None,
+        default_action: Callable[[ProtagonistCharacter], CharacterAction] | None = None,
+        api_single_flight: bool = False,
+        api_rate_limit: float | None = None,
+        api_burst: int | None = None,
+        adaptive_concurrency: bool = False,
+        api_max_retries: int = 2,
+        temperature: float | None = None,
     ):
         self.model = model
         self.api_key = api_key
         self.api_url = api_url
+        # Compiled guided generators, keyed by (model, regex pattern). The key holds the model itself,
+        # as the generator does, so that a new model allocated at the address of a dropped one never
+        # gets its entries; they are released once evicted
+        self.generator_cache: LRUCache = LRUCache(maxsize=generator_cache_size)
+        # Generation threads (local_concurrency > 1) share the caches of compiled objects
+        self._generator_lock = threading.Lock()
+        # Optional on-disk store of compiled regex indices, shared across processes
+        self.index_store = (
+            IndexStore(index_store) if isinstance(index_store, str) else index_store
+        )
+        # Tokenizers and chat templates do not hold the model: they are weakly keyed by it, and go with it
+        self._tokenizers: WeakKeyDictionary[Any, tuple] = WeakKeyDictionary()
+        self._chat_formatters: WeakKeyDictionary[Any, LlamaChatFormatter] = WeakKeyDictionary()
+        # Model states after the prompt prefix shared by the NPCs of a scene (disabled if 0)
+        self.prefix_cache = (
+            PrefixCache(max_bytes=prefix_cache_bytes, lock=self._generator_lock)
+            if prefix_cache_bytes > 0
+            else None
+        )
+        # Local generation runs in its own threads, so that decoding never blocks the event loop.
+        # llama.cpp and torch release the GIL while decoding; a Llama instance is not thread-safe,
+        # hence a single concurrent generation per model by default.
+        self.local_concurrency = local_concurrency
+        self._executor: ThreadPoolExecutor | None = None
+        # API mode reuses a single client, so that steps share pooled keep-alive connections
+        self.max_connections = max_connections
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_timeout = request_timeout
+        self._client: AsyncOpenAI | None = None
+        self._api_semaphore: asyncio.Semaphore | AdaptiveConcurrencyLimiter | None = None
+        # Optional flow control of API requests: identical requests in flight are sent once,
+        # at most api_rate_limit requests are sent per second, and with adaptive_concurrency,
+        # the number of concurrent requests backs off on errors and latency spikes
+        self.api_flights: SingleFlight | None = SingleFlight() if api_single_flight else None
+        self.api_rate_limiter = (
+            TokenBucket(api_rate_limit, api_burst) if api_rate_limit is not None else None
+        )
+        self.adaptive_concurrency = adaptive_concurrency
+        self.api_max_retries = api_max_retries
+        # Optional token budget for the prompt, trimming old events and memories to fit
+        self.prompt_builder = (
+            NPCPromptBuilder(max_tokens=prompt_token_budget, count_tokens=self.count_tokens)
+            if prompt_token_budget is not None
+            else None
+        )
+        # Optional local retrieval, to only prompt with the memories relevant to the current scene
+        self.memory_retriever = (
+            MemoryRetriever(embedder=memory_embedder, k=memory_top_k)
+            if memory_top_k is not None
+            else None
+        )
+        # Receive the per-phase timings, token counts and cache hits of every step
+        self.metrics_hooks = list(metrics_hooks or [])
+        # When the guided regex only allows a few completions (disabled if 0): with a single one,
+        # the model is skipped; with transformers models, the others are scored in one forward pass
+        self.max_enumerated_completions = max_enumerated_completions
+        # Optional cache of the responses to identical prompts, e.g. idle NPCs in an unchanged scene
+        self.response_cache = response_cache
+        # Sampling temperature, API_TEMPERATURE through the API and 1.0 locally by default.
+        # At 0, responses are decoded greedily, and the response cache keeps a single one per prompt
+        if temperature is None:
+            temperature = API_TEMPERATURE if isinstance(model, str) else 1.0
+        self.temperature = temperature
+        # Recovery from responses that do not parse: they are repaired if possible, else regenerated,
+        # up to max_parse_attempts generations per step and parse_retry_seconds since the step started,
+        # else replaced by default_action(protagonist) if given, else ActionParsingError is raised
+        self.max_parse_attempts = max_parse_attempts
+        self.parse_retry_seconds = parse_retry_seconds
+        self.default_action = default_action
 
         if isinstance(model, str) and not self.api_key:
             raise ValueError("You must provide an API key to use our API.")
 
-        if not isinstance(model, (models.LlamaCpp, models.Transformers)):
+        if not (isinstance(model, str) or is_llamacpp(model) or is_transformers(model)):
             raise NotImplementedError(
                 "Only LlamaCpp and Transformers models are supported in local mode for now."
             )
 
+        if self.index_store is not None and not isinstance(model, str):
+            _, fingerprint = self.get_tokenizer(model)
+            count = self.index_store.preload(fingerprint)
+            logger.info(f"Loaded {count} stored regex indices from {self.index_store.path}")
+
+    def get_completions(
+        self, protagonist: ProtagonistCharacter, scene_index: SceneIndex
+    ) -> list[str] | None:
+        """
+        The few completions allowed by the protagonist's guided regex, if there are at most
+        max_enumerated_completions of them.
+        """
+        if self.max_enumerated_completions <= 0:
+            return None
+        return get_guided_completions(
+            protagonist.skills, scene_index, self.max_enumerated_completions
+        )
+
+    def emit_metrics(self, metrics: StepMetrics):
+        """
+        Hand the metrics of a step to every hook. A failing hook never fails the step.
+        """
+        logger.debug(f"Step metrics: {metrics}")
+        for hook in self.metrics_hooks:
+            try:
+                hook(metrics)
+            except Exception:
+                logger.exception(f"Error in metrics hook {hook}")
+
+    def sampling_params(self) -> dict:
+        """
+        The parameters that the responses are sampled with, part of the response cache key.
+        """
+        if isinstance(self.model, str):
+            return {"temperature": self.temperature}
+        sampler = "greedy" if self.temperature == 0 else "multinomial"
+        return {"sampler": sampler, "temperature": self.temperature}
+
+    def sampler(self):
+        """
+        The outlines sampler of local generation, at the stepper's temperature.
+        """
+        from outlines.samplers import greedy, multinomial
+
+        if self.temperature == 0:
+            return greedy()
+        return multinomial(temperature=self.temperature)
+
+    def model_name(self) -> str:
+        if isinstance(self.model, str):
+            return self.model
+        llm = self.model.model
+        return (
+            getattr(llm, "model_path", None)
+            or getattr(llm, "name_or_path", None)
+            or type(llm).__name__
+        )
+
+    def response_key(self, prompt: str, guided_regex: str) -> str | None:
+        """
+        Response cache key of a prompt, or None if the stepper has no response cache.
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.key(
+            str(prompt), guided_regex, self.model_name(), self.sampling_params()
+        )
+
+    def get_cached_response(self, key: str | None, metrics: StepMetrics) -> str | None:
+        if key is None:
+            return None
+        response = self.response_cache.get(key, self.sampling_params())  # type: ignore
+        metrics.cache("response", response is not None)
+        return response
+
+    def cache_response(self, key: str | None, response: str):
+        if key is not None:
+            self.response_cache.put(key, response, self.sampling_params())  # type: ignore
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Number of tokens of text for the stepper's model (approximated in API mode).
+        """
+        if is_llamacpp(self.model):
+            return len(
+                self.model.model.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+            )
+        if is_transformers(self.model):
+            return len(
+                self.model.tokenizer.tokenizer.encode(text, add_special_tokens=False)
+            )
+        return approximate_token_count(text)
+
+    def render_prompt(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        prefix: str | None = None,
+    ) -> str:
+        """
+        Render the NPC prompt, with the most relevant memories and within the token budget
+        if the stepper is configured for it. The prompt prefix is rendered if not given.
+        """
+        if self.memory_retriever is not None:
+            protagonist = protagonist.model_copy(
+                update={"memories": self.memory_retriever.retrieve(protagonist, events)}
+            )
+        render = self.prompt_builder or NPCPrompt
+        return render(
+            context=context,
+            locations=locations,
+            NPCs=NPCs,
+            protagonist=protagonist,
+            items=items,
+            events=events,
+            prefix=prefix,
+        )
+
+    def get_tokenizer(self, llm: "models.LogitsGenerator") -> tuple:
+        """
+        Return the outlines tokenizer of a local model, along with its fingerprint.
+        """
+        with self._generator_lock:
+            return self._get_tokenizer(llm)
+
+    def _get_tokenizer(self, llm: "models.LogitsGenerator") -> tuple:
+        if llm not in self._tokenizers:
+            from outlines.integrations.llamacpp import LlamaCppTokenizer
+
+            tokenizer = (
+                LlamaCppTokenizer(llm.model)
+                if is_llamacpp(llm)
+                else llm.tokenizer
+            )
+            self._tokenizers[llm] = (tokenizer, tokenizer_fingerprint(tokenizer))
+        return self._tokenizers[llm]
+
+    def build_generator(
+        self,
+        llm: "models.LogitsGenerator",
+        guided_regex: str,
+    ):
+        """
+        Compile a guided generator, reusing the index from the on-disk store if there is one.
+        """
+        from outlines.generate import regex  # type: ignore
+        from outlines.generate.api import SequenceGenerator, SequenceGeneratorAdapter
+
+        if self.index_store is None:
+            return regex(llm, guided_regex, self.sampler())
+
+        tokenizer, fingerprint = self._get_tokenizer(llm)  # Called with the lock held
+        guide = self.index_store.get_or_compile(tokenizer, guided_regex, fingerprint)
+        if is_llamacpp(llm):
+            from outlines.integrations.llamacpp import LogitsProcessor
+
+            return SequenceGeneratorAdapter(
+                llm, LogitsProcessor(tokenizer=tokenizer, fsm=guide), self.sampler()
+            )
+        return SequenceGenerator(guide, llm, self.sampler(), llm.device)
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """
+        Long-lived API client, with a bounded pool of keep-alive connections.
+        The API backend is only loaded on first use.
+        """
+        if self._client is None:
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            self._client = AsyncOpenAI(
+                base_url=self.api_url,
+                api_key=self.api_key,
+                timeout=self.request_timeout,
+                # The adaptive concurrency limiter retries requests itself, after backing off
+                max_retries=0 if self.adaptive_concurrency else self.api_max_retries,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections,
+                    ),
+                    timeout=self.request_timeout,
+                ),
+            )
+        return self._client
+
+    @property
+    def api_semaphore(self) -> asyncio.Semaphore | AdaptiveConcurrencyLimiter:
+        if self._api_semaphore is None:
+            self._api_semaphore = (
+                AdaptiveConcurrencyLimiter(max_limit=self.max_concurrent_requests)
+                if self.adaptive_concurrency
+                else asyncio.Semaphore(self.max_concurrent_requests)
+            )
+        return self._api_semaphore
+
+    async def acquire_api_token(self):
+        if self.api_rate_limiter is not None:
+            await self.api_rate_limiter.acquire()
+
+    @contextlib.asynccontextmanager
+    async def api_request(self, **kwargs) -> AsyncIterator:
+        """
+        Send a chat completion request within the rate and concurrency limits, and hold its
+        concurrency slot until the block exits, e.g. while its stream is being read.
+        With adaptive concurrency, the limiter is fed the latency of every request (until the
+        response headers, for streams) and its errors, and failed requests are retried once a slot
+        is free again under the lowered limit. Streams are only retried before being read.
+        """
+        limiter = self.api_semaphore
+        adaptive = isinstance(limiter, AdaptiveConcurrencyLimiter)
+        for attempt in range(self.api_max_retries + 1):
+            await self.acquire_api_token()
+            async with limiter as started:
+                try:
+                    response = await self.client.chat.completions.create(**kwargs)
+                except Exception as e:
+                    if not adaptive or not is_retryable_api_error(e):
+                        raise
+                    limiter.on_error(started)  # type: ignore
+                    if attempt == self.api_max_retries:
+                        raise
+                    logger.warning(f"API request failed, retrying: {e}")
+                else:
+                    if adaptive:
+                        limiter.on_success(started)  # type: ignore
+                    yield response
+                    return
+            await asyncio.sleep(API_RETRY_BACKOFF * 2**attempt)
+
+    async def aclose(self):
+        """
+        Close the API client and its connections, and release the local generation threads.
+        """
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        self.close()
+
     async def generate_api(
         self,
         model: str,
         prompt: str,
         guided_regex: str,
-        temperature: float = 0.8,
+        temperature: float = API_TEMPERATURE,
+        metrics: StepMetrics | None = None,
     ) -> str:
-        client = AsyncOpenAI(base_url=self.api_url, api_key=self.api_key)
+        messages = [
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ]
+
+        async def request():
+            async with self.api_request(
+                model=model,
+                messages=messages,
+                max_tokens=100,
+                temperature=temperature,
+                extra_body={"guided_regex": guided_regex},
+            ) as response:
+                return response
+
+        if self.api_flights is not None:
+            # Identical requests in flight, e.g. NPCs of a scene in the same tick, share a response
+            key = (model, prompt, guided_regex, temperature)
+            response, joined = await self.api_flights.do(key, request)
+            if metrics is not None:
+                metrics.cache("inflight", joined)
+            if joined:
+                return response.choices[0].message.content  # type: ignore
+        else:
+            response = await request()
+
+        content = response.choices[0].message.content
+        if metrics is not None:
+            if response.usage is not None:
+                metrics.prompt_tokens += response.usage.prompt_tokens
+                metrics.generated_tokens += response.usage.completion_tokens
+            else:
+                metrics.prompt_tokens += approximate_token_count(prompt)
+                metrics.generated_tokens += approximate_token_count(content or "")
 
-        # Time the query
-        start = time.time()
+        # Return the NPC's response
+        return content  # type: ignore
 
+    async def stream_api(
+        self,
+        model: str,
+        prompt: str,
+        guided_regex: str,
+        parser: ActionStreamParser,
+        temperature: float = API_TEMPERATURE,
+        metrics: StepMetrics | None = None,
+    ) -> AsyncIterator[CharacterAction]:
+        """
+        Stream the completion of the API into parser, yielding partial actions.
+        The stream is closed as soon as the action is complete.
+        """
         messages = [
             {
                 "role": "user",
@@ -56,45 +574,125 @@ class NPCStepper:
             },
         ]
 
-        response = await client.chat.completions.create(
+        # Streams are not coalesced by api_single_flight: each caller reads its own partial actions
+        async with self.api_request(
             model=model,
             messages=messages,
             max_tokens=100,
             temperature=temperature,
-            extra_body=dict(guided_regex=guided_regex),
-        )
+            stream=True,
+            extra_body={"guided_regex": guided_regex},
+        ) as stream:
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    partial = parser.feed(chunk.choices[0].delta.content or "")
+                    if partial is not None:
+                        yield partial
+                    if parser.complete:
+                        break
+            finally:
+                await stream.close()
 
-        # Log the query time
-        print(f"Query time: {time.time() - start}")
+        if metrics is not None:
+            metrics.prompt_tokens += approximate_token_count(prompt)
+            metrics.generated_tokens += approximate_token_count(parser.text)
 
-        # Return the NPC's response
-        return response.choices[0].message.content  # type: ignore
+    def get_generator(
+        self,
+        llm: "models.LogitsGenerator",
+        guided_regex: str,
+        cancel_event: threading.Event | None = None,
+        metrics: StepMetrics | None = None,
+    ):
+        """
+        Return a guided generator for the given regex, compiling its FSM only on a cache miss.
+        If cancel_event is given, the generation stops as soon as it is set.
+        """
+        from outlines.generate.api import SequenceGeneratorAdapter
 
-    def generate_local(
+        metrics = metrics or StepMetrics()
+        key = (llm, guided_regex)
+        with metrics.phase("fsm"), self._generator_lock:
+            metrics.cache("generator", key in self.generator_cache)
+            generator = self.generator_cache.get_or_create(
+                key, lambda: self.build_generator(llm, guided_regex)
+            )
+        if isinstance(generator, SequenceGeneratorAdapter):
+            # LlamaCpp logits processors hold the FSM state of the sequence being generated,
+            # so each call gets a fresh processor sharing the same compiled FSM
+            generator = copy.copy(generator)
+            generator.logits_processor = generator.logits_processor.copy()
+            if cancel_event is not None:
+                generator.logits_processor.fsm = CancellableGuide(
+                    generator.logits_processor.fsm, cancel_event
+                )
+        elif cancel_event is not None:
+            generator = copy.copy(generator)
+            generator.fsm = CancellableGuide(generator.fsm, cancel_event)
+        return generator
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.local_concurrency,
+                thread_name_prefix="gigax-generate",
+            )
+        return self._executor
+
+    async def run_local(self, func, *args, **kwargs):
+        """
+        Run a blocking local generation method in the stepper's executor, without blocking the event loop.
+        If the awaiting task is cancelled, the generation is stopped at the next token.
+        """
+        cancel_event = threading.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(func, *args, cancel_event=cancel_event, **kwargs),
+            )
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    def close(self):
+        """
+        Release the threads used for local generation.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_chat_formatter(self, llm: "models.LlamaCpp") -> LlamaChatFormatter:
+        """
+        Return the chat formatter of a llama.cpp model, compiling its template on first use.
+        """
+        with self._generator_lock:
+            if llm not in self._chat_formatters:
+                self._chat_formatters[llm] = LlamaChatFormatter(llm.model)
+            return self._chat_formatters[llm]
+
+    def format_chat_prompt(
         self,
         prompt: str,
-        llm: models.LogitsGenerator,
-        guided_regex: str,
+        llm: "models.LogitsGenerator",
     ) -> str:
-        # Time the query
-        start = time.time()
-
-        generator = regex(llm, guided_regex)
+        """
+        Wrap the NPC prompt in the chat template of the local model.
+        """
         messages = [
             {"role": "user", "content": f"{prompt}"},
         ]
-        if isinstance(llm, models.LlamaCpp):  # type: ignore
+        if is_llamacpp(llm):
 
             # Llama-cpp-python has a convenient create_chat_completion() method that guesses the chat prompt
             # But outlines does not support it for generation, so we do this ugly hack instead
-            bos_token = llm.model._model.token_get_text(
-                int(llm.model.metadata["tokenizer.ggml.bos_token_id"])
-            )
-            chat_prompt = llama_chat_template(
-                messages, bos_token, llm.model.metadata["tokenizer.chat_template"]
-            )
+            chat_prompt = self.get_chat_formatter(llm)(prompt)
 
-        elif isinstance(llm, models.Transformers):  # type: ignore
+        elif is_transformers(llm):
             chat_prompt = llm.tokenizer.tokenizer.apply_chat_template(
                 messages,
                 tokenize=False,
@@ -105,15 +703,472 @@ class NPCStepper:
                     f"Expected a string, but received type {type(chat_prompt)} with value {chat_prompt}"
                 )
 
-        res = generator(chat_prompt)
+        return chat_prompt
+
+    def use_prefix_cache(
+        self,
+        generator,
+        llm: "models.LogitsGenerator",
+        prompt: str,
+        prompt_prefix: str,
+        chat_prompt: str,
+        metrics: StepMetrics | None = None,
+    ):
+        """
+        Start the generation from the cached model state after the prompt prefix (and chat template header).
+        """
+        start = chat_prompt.find(prompt)
+        if self.prefix_cache is None or start < 0:
+            return generator
+        chat_prefix = chat_prompt[: start + len(prompt_prefix)]
+
+        metrics = metrics or StepMetrics()
+        hits = self.prefix_cache.stats.hits
+        with metrics.phase("prefix"):
+            if is_llamacpp(llm):
+                self.prefix_cache.load_llamacpp(llm, chat_prompt, chat_prefix)
+            else:
+                generator = copy.copy(generator)
+                generator.model = self.prefix_cache.wrap_transformers(
+                    llm, chat_prompt, chat_prefix
+                )
+        metrics.cache("prefix", self.prefix_cache.stats.hits > hits)
+        return generator
+
+    def generate_local(
+        self,
+        prompt: str,
+        llm: "models.LogitsGenerator",
+        guided_regex: str,
+        cancel_event: threading.Event | None = None,
+        prompt_prefix: str | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> str:
+        metrics = metrics or StepMetrics()
+        generator = self.get_generator(llm, guided_regex, cancel_event, metrics)
+        with metrics.phase("chat_template"):
+            chat_prompt = self.format_chat_prompt(prompt, llm)
+        if prompt_prefix is not None:
+            generator = self.use_prefix_cache(
+                generator, llm, prompt, prompt_prefix, chat_prompt, metrics
+            )
+
+        with metrics.phase("decode"):
+            res = generator(chat_prompt)
         if not isinstance(res, str):
             raise ValueError(
                 f"Expected a string, but received type {type(res)} with value {res}"
             )
 
-        logger.info(f"Query time: {time.time() - start}")
+        metrics.prompt_tokens += self.count_tokens(chat_prompt)
+        metrics.generated_tokens += self.count_tokens(res)
         return res
 
+    def generate_local_batch(
+        self,
+        prompts: list[str],
+        llm: "models.LogitsGenerator",
+        guided_regexes: list[str],
+        cancel_event: threading.Event | None = None,
+        prompt_prefixes: list[str] | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> list[str]:
+        """
+        Generate one completion per (prompt, regex) pair with a local model.
+        Transformers models decode the whole batch at once, each sequence masked by its own FSM.
+        """
+        metrics = metrics or StepMetrics()
+        with metrics.phase("chat_template"):
+            chat_prompts = [self.format_chat_prompt(prompt, llm) for prompt in prompts]
+
+        if is_transformers(llm):
+            import torch
+            from outlines.generate.generator import sequence_generator
+
+            guides = [
+                self.get_generator(llm, guided_regex, cancel_event, metrics).fsm.copy()
+                for guided_regex in guided_regexes
+            ]
+            token_ids, attention_masks = llm.tokenizer.encode(chat_prompts)
+            token_ids = token_ids.to(llm.device)
+            attention_masks = attention_masks.to(llm.device)
+            rng = torch.Generator(device=llm.device)
+            rng.seed()
+
+            states = sequence_generator(
+                llm,
+                self.sampler(),
+                guides,
+                token_ids,
+                torch.zeros(len(prompts), dtype=torch.float, device=llm.device),
+                attention_masks,
+                [0 for _ in prompts],
+                rng=rng,
+            )
+            last_state = None
+            with metrics.phase("decode"):
+                for last_state in states:
+                    pass
+            if last_state is None:
+                return ["" for _ in prompts]
+            results = llm.tokenizer.decode(last_state.token_ids[:, token_ids.shape[1] :])
+
+        else:
+            # llama-cpp-python has no batch inference: requests sharing a regex run back to back,
+            # so their FSM is compiled once, and in prompt order, so consecutive prompts share prefixes
+            results = ["" for _ in prompts]
+            order = sorted(
+                range(len(prompts)), key=lambda i: (guided_regexes[i], chat_prompts[i])
+            )
+            for i in order:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                generator = self.get_generator(
+                    llm, guided_regexes[i], cancel_event, metrics
+                )
+                if prompt_prefixes is not None:
+                    generator = self.use_prefix_cache(
+                        generator,
+                        llm,
+                        prompts[i],
+                        prompt_prefixes[i],
+                        chat_prompts[i],
+                        metrics,
+                    )
+                with metrics.phase("decode"):
+                    results[i] = generator(chat_prompts[i])
+
+        metrics.prompt_tokens += sum(self.count_tokens(chat_prompt) for chat_prompt in chat_prompts)
+        metrics.generated_tokens += sum(self.count_tokens(r) for r in results)
+        return results
+
+    def stream_local(
+        self,
+        prompt: str,
+        llm: "models.LogitsGenerator",
+        guided_regex: str,
+        parser: ActionStreamParser,
+        on_partial: Callable[[CharacterAction], None],
+        cancel_event: threading.Event | None = None,
+        prompt_prefix: str | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> str:
+        """
+        Generate with a local model token by token, feeding parser and calling on_partial with
+        each new partial action. Decoding stops as soon as the action is complete, without waiting
+        for the EOS token.
+        """
+        metrics = metrics or StepMetrics()
+        generator = self.get_generator(llm, guided_regex, cancel_event, metrics)
+        with metrics.phase("chat_template"):
+            chat_prompt = self.format_chat_prompt(prompt, llm)
+        if prompt_prefix is not None:
+            generator = self.use_prefix_cache(
+                generator, llm, prompt, prompt_prefix, chat_prompt, metrics
+            )
+
+        with metrics.phase("decode"):
+            tokens = generator.stream(chat_prompt)
+            try:
+                for token in tokens:
+                    partial = parser.feed(token)
+                    if partial is not None:
+                        on_partial(partial)
+                    if parser.complete:
+                        break
+            finally:
+                tokens.close()
+
+        metrics.prompt_tokens += self.count_tokens(chat_prompt)
+        metrics.generated_tokens += self.count_tokens(parser.text)
+        return parser.text
+
+    def score_completions(
+        self,
+        prompt: str,
+        llm: "models.Transformers",
+        completions: list[str],
+        cancel_event: threading.Event | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> str:
+        """
+        Sample one of a few completions by its likelihood, instead of decoding token by token:
+        the prompt is evaluated once, then every completion (and EOS) in one batched forward pass.
+        """
+        import torch
+
+        metrics = metrics or StepMetrics()
+        with metrics.phase("chat_template"):
+            chat_prompt = self.format_chat_prompt(prompt, llm)
+
+        tokenizer = llm.tokenizer
+        candidates = [
+            tokenizer.tokenizer.encode(completion, add_special_tokens=False)
+            + [tokenizer.eos_token_id]
+            for completion in completions
+        ]
+        with metrics.phase("decode"), torch.inference_mode():
+            prompt_ids, prompt_mask = tokenizer.encode([chat_prompt])
+            output = llm.model(
+                prompt_ids.to(llm.device),
+                attention_mask=prompt_mask.to(llm.device),
+                use_cache=True,
+                return_dict=True,
+            )
+            first_logprobs = torch.log_softmax(output.logits[0, -1].float(), dim=-1)
+
+            # Right-padded completions, all attending to the shared prompt
+            length = max(len(candidate) for candidate in candidates)
+            input_ids = torch.full((len(candidates), length), tokenizer.pad_token_id)
+            mask = torch.zeros((len(candidates), length), dtype=torch.long)
+            for i, candidate in enumerate(candidates):
+                input_ids[i, : len(candidate)] = torch.tensor(candidate)
+                mask[i, : len(candidate)] = 1
+            output = llm.model(
+                input_ids.to(llm.device),
+                attention_mask=torch.cat(
+                    [prompt_mask.repeat(len(candidates), 1), mask], dim=1
+                ).to(llm.device),
+                past_key_values=expand_kv_cache(output.past_key_values, len(candidates)),
+                use_cache=True,
+                return_dict=True,
+            )
+            logprobs = torch.log_softmax(output.logits[:, :-1].float(), dim=-1).cpu()
+            token_logprobs = logprobs.gather(2, input_ids[:, 1:, None]).squeeze(2)
+            scores = first_logprobs.cpu()[input_ids[:, 0]] + (
+                token_logprobs * mask[:, 1:]
+            ).sum(dim=1)
+            if self.temperature == 0:
+                choice = int(scores.argmax())
+            else:
+                choice = int(
+                    torch.multinomial(torch.softmax(scores / self.temperature, dim=0), 1)
+                )
+
+        metrics.prompt_tokens += prompt_ids.shape[1]
+        metrics.generated_tokens += len(candidates[choice]) - 1
+        return completions[choice]
+
+    async def generate(
+        self,
+        prompt: str,
+        guided_regex: re.Pattern,
+        completions: list[str] | None = None,
+        prompt_prefix: str | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> str:
+        """
+        Generate the response to a prompt, with the local model or through the API.
+        """
+        metrics = metrics or StepMetrics()
+        if completions is not None and is_transformers(self.model):
+            return await self.run_local(
+                self.score_completions, prompt, self.model, completions, metrics=metrics
+            )
+        if not isinstance(self.model, str):
+            return await self.run_local(
+                self.generate_local,
+                prompt,
+                self.model,
+                guided_regex.pattern,
+                prompt_prefix=prompt_prefix,
+                metrics=metrics,
+            )
+        with metrics.phase("decode"):
+            return await self.generate_api(
+                self.model,
+                prompt,
+                guided_regex.pattern,
+                temperature=self.temperature,
+                metrics=metrics,
+            )
+
+    async def parse_action(
+        self,
+        res: str,
+        protagonist: ProtagonistCharacter,
+        NPCs: list[Character],
+        locations: list[Location],
+        items: list[Item],
+        guided_regex: re.Pattern,
+        scene_index: SceneIndex | CompactScene,
+        regenerate: Callable[[], Awaitable[str]] | None = None,
+        start: float | None = None,
+        metrics: StepMetrics | None = None,
+    ) -> tuple[CharacterAction, str | None]:
+        """
+        Parse a response into an action, recovering from responses that do not parse: by repairing
+        them from their longest valid prefix, then by regenerating them with regenerate() within the
+        attempt and time budgets, then with the default action.
+        Return the action and the response it was parsed from (None for the default action).
+        """
+        metrics = metrics or StepMetrics()
+        start = time.perf_counter() if start is None else start
+
+        def parse(text: str) -> CharacterAction:
+            return CharacterAction.from_str(
+                text, protagonist, NPCs, locations, items, guided_regex, scene_index
+            )
+
+        with metrics.phase("parse"):
+            try:
+                return parse(res), res
+            except PARSE_ERRORS as e:
+                error = e
+        metrics.parse_failures += 1
+        logger.warning(f"Could not parse the action of NPC {protagonist.name}: {res!r}")
+
+        attempts = 1
+        while True:
+            with metrics.phase("parse"):
+                repaired = repair_action_text(
+                    res, protagonist, scene_index, guided_regex
+                )
+                if repaired is not None:
+                    try:
+                        action = parse(repaired)
+                        metrics.recovery("repair")
+                        return action, repaired
+                    except PARSE_ERRORS:
+                        pass  # Not a valid action either: regenerate
+            within_budget = (
+                self.parse_retry_seconds is None
+                or time.perf_counter() - start < self.parse_retry_seconds
+            )
+            if regenerate is None or attempts >= self.max_parse_attempts or not within_budget:
+                break
+            attempts += 1
+            metrics.parse_retries += 1
+            res = await regenerate()
+            with metrics.phase("parse"):
+                try:
+                    action = parse(res)
+                    metrics.recovery("retry")
+                    return action, res
+                except PARSE_ERRORS as e:
+                    error = e
+            logger.warning(f"Could not parse the action of NPC {protagonist.name}: {res!r}")
+
+        if self.default_action is not None:
+            metrics.recovery("default")
+            return self.default_action(protagonist), None
+        raise ActionParsingError(
+            f"Could not parse the action of NPC {protagonist.name}: {res}"
+        ) from error
+
+    def _prepare_step(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        metrics: StepMetrics,
+        scene_index: SceneIndex | CompactScene | None = None,
+        guided_regex: re.Pattern | None = None,
+        prompt_prefix: str | None = None,
+    ) -> PreparedStep:
+        """
+        Derive what a step needs before generation: the scene index, guided regex and prompt,
+        along with the response if it needs no generation (single allowed action, or cached).
+        """
+        with metrics.phase("regex"):
+            if scene_index is None:
+                scene_index = SceneIndex(NPCs, locations, items)
+            elif isinstance(scene_index, CompactScene) and prompt_prefix is None:
+                prompt_prefix = scene_index.prompt_prefix()
+            if guided_regex is None:
+                guided_regex = get_guided_regex(
+                    protagonist.skills, NPCs, locations, items, scene_index
+                )
+            completions = self.get_completions(protagonist, scene_index)
+        step = PreparedStep(protagonist, NPCs, locations, items, scene_index, guided_regex)
+        if completions is not None and len(completions) == 1:
+            # The regex only allows one action: no need to prompt the model
+            step.response = completions[0]
+            return step
+
+        with metrics.phase("prompt"):
+            step.prompt = self.render_prompt(
+                context=context,
+                locations=locations,
+                NPCs=NPCs,
+                protagonist=protagonist,
+                items=items,
+                events=events,
+                prefix=prompt_prefix,
+            )
+        logger.info(
+            f"Prompting NPC {protagonist.name} with the following prompt: {step.prompt}"
+        )
+        step.key = self.response_key(step.prompt, guided_regex.pattern)
+        step.response = self.get_cached_response(step.key, metrics)
+        step.cached = step.response is not None
+        if self.prefix_cache is not None:
+            step.prompt_prefix = prompt_prefix or NPCPromptPrefix(context, locations, NPCs)
+        step.generate = functools.partial(
+            self.generate,
+            step.prompt,
+            guided_regex,
+            completions,
+            prompt_prefix=step.prompt_prefix,
+            metrics=metrics,
+        )
+        return step
+
+    async def _finish_step(
+        self,
+        step: PreparedStep,
+        response: str,
+        start: float,
+        metrics: StepMetrics,
+    ) -> CharacterAction:
+        """
+        Parse the response of a prepared step, regenerating it if needed, and cache it once parsed.
+        Generated responses are kept in step.responses, as they were before parsing.
+        """
+        regenerate = step.generate
+        if step.generate is not None and not step.cached:
+            step.responses.append(response)
+
+            async def regenerate() -> str:
+                res = await step.generate()  # type: ignore
+                step.responses.append(res)
+                return res
+
+        action, parsed = await self.parse_action(
+            response,
+            step.protagonist,
+            step.NPCs,
+            step.locations,
+            step.items,
+            step.guided_regex,
+            step.scene_index,
+            regenerate=regenerate,
+            start=start,
+            metrics=metrics,
+        )
+        if not step.cached and parsed is not None:
+            self.cache_response(step.key, parsed)
+        logger.info(f"NPC {step.protagonist.name} responded with: {action}")
+        return action
+
+    @contextlib.contextmanager
+    def _reporting(
+        self, metrics: StepMetrics, start: float, steps: list[PreparedStep]
+    ) -> Iterator[None]:
+        """
+        Hand the metrics of the steps to the hooks once the enclosed block is done.
+        Failed steps are reported too, with their parse failures.
+        """
+        try:
+            yield
+        finally:
+            metrics.seconds = time.perf_counter() - start
+            metrics.responses = [step.responses for step in steps]
+            self.emit_metrics(metrics)
+
     async def get_action(
         self,
         context: str,
@@ -122,46 +1177,182 @@ class NPCStepper:
         protagonist: ProtagonistCharacter,
         items: list[Item],
         events: list[CharacterAction],
+        scene_index: SceneIndex | CompactScene | None = None,
+        guided_regex: re.Pattern | None = None,
+        prompt_prefix: str | None = None,
     ) -> CharacterAction:
         """
         Prompt the NPC for an input.
+        The scene index, guided regex and prompt prefix are derived from the scene if not given,
+        e.g. by a Scene session that keeps them between steps. A CompactScene given as the scene
+        index also provides the prompt prefix.
         """
-
-        prompt = NPCPrompt(
-            context=context,
-            locations=locations,
-            NPCs=NPCs,
-            protagonist=protagonist,
-            items=items,
-            events=events,
+        start = time.perf_counter()
+        metrics = StepMetrics(npc=protagonist.name)
+        step = self._prepare_step(
+            context,
+            locations,
+            NPCs,
+            protagonist,
+            items,
+            events,
+            metrics,
+            scene_index=scene_index,
+            guided_regex=guided_regex,
+            prompt_prefix=prompt_prefix,
         )
+        res = step.response if step.response is not None else await step.generate()  # type: ignore
+        with self._reporting(metrics, start, [step]):
+            return await self._finish_step(step, res, start, metrics)
 
-        logger.info(
-            f"Prompting NPC {protagonist.name} with the following prompt: {prompt}"
+    async def stream_action(
+        self,
+        context: str,
+        locations: list[Location],
+        NPCs: list[Character],
+        protagonist: ProtagonistCharacter,
+        items: list[Item],
+        events: list[CharacterAction],
+        scene_index: SceneIndex | CompactScene | None = None,
+        guided_regex: re.Pattern | None = None,
+        prompt_prefix: str | None = None,
+    ) -> AsyncIterator[CharacterAction]:
+        """
+        Prompt the NPC for an input, yielding partial actions while it is generated, e.g. to start
+        a say bubble before its content is finished. The last action yielded is the complete one.
+        """
+        start = time.perf_counter()
+        metrics = StepMetrics(npc=protagonist.name)
+        step = self._prepare_step(
+            context,
+            locations,
+            NPCs,
+            protagonist,
+            items,
+            events,
+            metrics,
+            scene_index=scene_index,
+            guided_regex=guided_regex,
+            prompt_prefix=prompt_prefix,
         )
-        guided_regex = get_guided_regex(protagonist.skills, NPCs, locations, items)
+        parser = ActionStreamParser(protagonist, step.scene_index)
 
-        # Generate the response
-        if isinstance(self.model, models.LogitsGenerator):
-            res = self.generate_local(
-                prompt,
-                self.model,
-                guided_regex.pattern,
+        if step.response is not None:
+            parser.feed(step.response)
+        elif not isinstance(self.model, str):
+            # Partial actions are handed from the generation thread to the event loop
+            loop = asyncio.get_running_loop()
+            partials: asyncio.Queue[CharacterAction] = asyncio.Queue()
+            generation = asyncio.ensure_future(
+                self.run_local(
+                    self.stream_local,
+                    step.prompt,
+                    self.model,
+                    step.guided_regex.pattern,
+                    parser,
+                    lambda partial: loop.call_soon_threadsafe(partials.put_nowait, partial),
+                    prompt_prefix=step.prompt_prefix,
+                    metrics=metrics,
+                )
             )
+            try:
+                while not generation.done() or not partials.empty():
+                    next_partial = asyncio.ensure_future(partials.get())
+                    await asyncio.wait(
+                        [next_partial, generation], return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if next_partial.done():
+                        yield next_partial.result()
+                    else:
+                        next_partial.cancel()
+                generation.result()
+            finally:
+                # Stops the generation if the caller stopped iterating
+                generation.cancel()
         else:
-            res = await self.generate_api(
-                self.model,
-                prompt,
-                guided_regex.pattern,
+            stream = self.stream_api(
+                self.model,  # type: ignore
+                step.prompt,  # type: ignore
+                step.guided_regex.pattern,
+                parser,
+                temperature=self.temperature,
+                metrics=metrics,
             )
+            async with contextlib.aclosing(stream):
+                while True:
+                    # Only receiving and parsing the chunks is timed, not the caller's work between them
+                    with metrics.phase("decode"):
+                        partial = await anext(stream, None)
+                    if partial is None:
+                        break
+                    yield partial
 
-        try:
-            # Parse response
-            parsed_action = CharacterAction.from_str(
-                res, protagonist, NPCs, locations, items, guided_regex
+        # Responses that do not parse are regenerated without streaming
+        with self._reporting(metrics, start, [step]):
+            action = await self._finish_step(step, parser.text, start, metrics)
+        yield action
+
+    async def get_actions(
+        self, batch: list[StepRequest], return_exceptions: bool = False
+    ) -> list[CharacterAction]:
+        """
+        Prompt several NPCs at once, e.g. every NPC of a game tick.
+        Local models decode the whole batch in one generation, API requests are sent concurrently.
+        As with asyncio.gather, if return_exceptions is True, parsing errors are returned in place
+        of the actions instead of being raised.
+        """
+        start = time.perf_counter()
+        metrics = StepMetrics(batch_size=len(batch), batch=True)
+        steps = [
+            self._prepare_step(
+                request.context,
+                request.locations,
+                request.NPCs,
+                request.protagonist,
+                request.items,
+                request.events,
+                metrics,
             )
-        except Exception:
-            logger.error(f"Error while parsing the action: {traceback.format_exc()}")
+            for request in batch
+        ]
+        # Only the NPCs without a single allowed action or a cached response are generated
+        pending = [step for step in steps if step.response is None]
 
-        logger.info(f"NPC {protagonist.name} responded with: {parsed_action}")
-        return parsed_action
+        if not pending:
+            generated = []
+        elif not isinstance(self.model, str):
+            generated = await self.run_local(
+                self.generate_local_batch,
+                [step.prompt for step in pending],
+                self.model,
+                [step.guided_regex.pattern for step in pending],
+                prompt_prefixes=(
+                    [step.prompt_prefix for step in pending]
+                    if self.prefix_cache is not None
+                    else None
+                ),
+                metrics=metrics,
+            )
+        else:
+            with metrics.phase("decode"):
+                generated = await asyncio.gather(
+                    *(
+                        self.generate_api(
+                            self.model,  # type: ignore
+                            step.prompt,  # type: ignore
+                            step.guided_regex.pattern,
+                            temperature=self.temperature,
+                            metrics=metrics,
+                        )
+                        for step in pending
+                    )
+                )
+        for step, res in zip(pending, generated):
+            step.response = res
+
+        with self._reporting(metrics, start, steps):
+            actions = await asyncio.gather(
+                *(self._finish_step(step, step.response, start, metrics) for step in steps),  # type: ignore
+                return_exceptions=return_exceptions,
+            )
+        return list(actions)
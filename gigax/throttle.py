@@ -0,0 +1,170 @@
+"""This module contains the flow control of API requests: in-flight deduplication, rate limiting and adaptive concurrency."""
+
+import asyncio
+import time
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+V = TypeVar("V")
+
+
+class SingleFlight(Generic[V]):
+    """
+    Deduplicates concurrent calls: while a call for a key is in flight, the other calls for
+    the same key wait for its result instead of making their own.
+    The call runs in its own task, so that it is only cancelled once all its callers gave up.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[Hashable, int] = {}
+        self.calls = 0
+        self.joined = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[V]]) -> tuple[V, bool]:
+        """
+        Return the result of func(), or of the call in flight for key, and whether it was joined.
+        """
+        joined = key in self._calls
+        if joined:
+            self.joined += 1
+            task = self._calls[key]
+        else:
+            self.calls += 1
+            task = self._calls[key] = asyncio.ensure_future(func())
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _: self._forget(key, task))
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task), joined
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters[key] == 1:
+                task.cancel()  # Nobody is waiting for the call anymore
+            raise
+        finally:
+            if key in self._waiters and self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved, even if every caller gave up
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate acquisitions per second on average, in bursts of up to burst.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.waited = 0.0  # Seconds spent waiting for tokens, in total
+        self._lock = asyncio.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Take a token, waiting for one to be available. Waiters are served in order.
+        """
+        async with self._lock:
+            self.refill()
+            while self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self.refill()
+            self.tokens -= 1
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit on concurrent requests adapted to the server (AIMD): it grows by one request after a full
+    limit of successful requests, and is multiplied by backoff on errors (e.g. 429 Too Many Requests)
+    or when a request takes more than latency_tolerance times the average latency.
+    Requests started before the last decrease do not decrease it again, so that a burst of errors
+    counts once.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: int | None = None,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit if initial_limit is not None else max_limit)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.clock = clock
+        self.latency = 0.0  # Moving average of successful request durations, in seconds
+        self.in_flight = 0
+        self.errors = 0
+        self.decreases = 0
+        self._last_decrease = -float("inf")
+        self._condition = asyncio.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    async def __aenter__(self) -> float:
+        """
+        Wait for a free slot, and return the time the request starts.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.capacity)
+            self.in_flight += 1
+        return self.clock()
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def decrease(self, started: float):
+        if started <= self._last_decrease:
+            return
+        self._last_decrease = self.clock()
+        self.decreases += 1
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def on_error(self, started: float):
+        self.errors += 1
+        self.decrease(started)
+
+    def on_success(self, started: float):
+        seconds = self.clock() - started
+        if self.latency > 0 and seconds > self.latency_tolerance * self.latency:
+            self.decrease(started)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.capacity)
+        self.latency = (
+            seconds if self.latency == 0 else self.latency + self.smoothing * (seconds - self.latency)
+        )
@@ -15,6 +15,9 @@ setup(
         "outlines",
         "pydantic",
         "openai",
+        "httpx",
+        "numpy",
+        "jinja2",
         "outlines",
         "transformers",
         "llama-cpp-python",
@@ -26,5 +29,8 @@ setup(
         "Programming Language :: Python :: 3",
     ],
     python_requires=">=3.10",
+    entry_points={
+        "console_scripts": ["gigax=gigax.cli:main"],
+    },
     zip_safe=False,
 )
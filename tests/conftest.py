@@ -1,6 +1,11 @@
 import pytest
-from gigax.scene import Character, Item, Location, ParameterType
+from outlines import models
+
+from gigax.fakes import FakeLlama, FakeOpenAIServer
 from gigax.parse import CharacterAction, ProtagonistCharacter, Skill
+from gigax.scene import Character, Item, Location, ParameterType
+from gigax.step import NPCStepper, StepRequest
+from tests.helpers import FakeHFModel, FakeHFTokenizer
 
 
 @pytest.fixture()
@@ -63,3 +68,62 @@ def events(protagonist, items):
             parameters=[items[0], "What a fine sword!"],
         )
     ]
+
+
+@pytest.fixture()
+def fake_llama(protagonist, NPCs):
+    return FakeLlama(reply=f"{protagonist.skills[0].name} {NPCs[0].name}")
+
+
+@pytest.fixture()
+def fake_openai_server(protagonist, NPCs):
+    server = FakeOpenAIServer(reply=f"{protagonist.skills[0].name} {NPCs[0].name}").start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture()
+def step_request(context, locations, NPCs, protagonist, items, events):
+    """
+    Factory of StepRequests on the scene above, with the given fields replaced,
+    e.g. step_request(protagonist=merchant).
+    """
+
+    def make(**fields) -> StepRequest:
+        return StepRequest(
+            **{
+                "context": context,
+                "locations": locations,
+                "NPCs": NPCs,
+                "protagonist": protagonist,
+                "items": items,
+                "events": events,
+                **fields,
+            }
+        )
+
+    return make
+
+
+@pytest.fixture()
+def transformers_stepper():
+    """
+    Factory of steppers on a fake transformers model spelling out replies, closed after the test.
+    The FakeHFModel is stepper.model.model, e.g. for its batch sizes and calls.
+    """
+    steppers: list[NPCStepper] = []
+
+    def make(
+        replies: list[str] | None = None, delay: float = 0.0, **kwargs
+    ) -> NPCStepper:
+        if replies is None:
+            replies = ["Attack John the Brave"]
+        tokenizer = FakeHFTokenizer()
+        llm = FakeHFModel(replies, tokenizer, delay=delay)
+        stepper = NPCStepper(model=models.Transformers(llm, tokenizer), **kwargs)  # type: ignore
+        steppers.append(stepper)
+        return stepper
+
+    yield make
+    for stepper in steppers:
+        stepper.close()
@@ -0,0 +1,129 @@
+"""Fake models for the tests, importable by worker processes (unlike conftest)."""
+
+import time
+from typing import ClassVar
+
+import torch
+
+from gigax.fakes import FakeLlama
+
+
+class FakeLlamaReplica:
+    """
+    Picklable model factory for worker processes, loading a FakeLlama.
+    """
+
+    def __init__(self, reply: str, delay: float = 0.0):
+        self.reply = reply
+        self.delay = delay
+
+    def __call__(self, n_threads: int):
+        from outlines import models
+
+        llama = FakeLlama(self.reply)
+        if self.delay:
+            generate = llama.generate
+
+            def slow_generate(*args, **kwargs):
+                time.sleep(self.delay)
+                yield from generate(*args, **kwargs)
+
+            llama.generate = slow_generate  # type: ignore
+        return models.LlamaCpp(llama)  # type: ignore
+
+
+class FakeHFTokenizer:
+    """
+    Character-level stand-in for a transformers tokenizer.
+    """
+
+    eos_token = "</s>"
+    eos_token_id = 0
+    pad_token_id = 0
+    all_special_tokens: ClassVar[list[str]] = [eos_token]
+
+    def __init__(self):
+        self.vocabulary = [self.eos_token] + [chr(c) for c in range(32, 127)]
+
+    def get_vocab(self) -> dict[str, int]:
+        return {token: i for i, token in enumerate(self.vocabulary)}
+
+    def encode(self, text: str, **kwargs) -> list[int]:
+        return [self.vocabulary.index(c) if c in self.vocabulary else 1 for c in text]
+
+    def __call__(self, prompts: list[str], **kwargs) -> dict:
+        encoded = [self.encode(prompt) for prompt in prompts]
+        length = max(len(ids) for ids in encoded)
+        # Left padding, as outlines expects
+        input_ids = [[self.pad_token_id] * (length - len(ids)) + ids for ids in encoded]
+        attention_mask = [[0] * (length - len(ids)) + [1] * len(ids) for ids in encoded]
+        return {
+            "input_ids": torch.tensor(input_ids),
+            "attention_mask": torch.tensor(attention_mask),
+        }
+
+    def batch_decode(self, token_ids, skip_special_tokens: bool = True) -> list[str]:
+        return [
+            "".join(self.vocabulary[int(t)] for t in ids if int(t) != self.eos_token_id)
+            for ids in token_ids
+        ]
+
+    def convert_tokens_to_string(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        return "".join(f"<|{m['role']}|>{m['content']}<|end|>" for m in messages) + "<|assistant|>"
+
+
+class FakeHFOutput:
+    def __init__(self, logits, past_key_values):
+        self.logits = logits
+        self.past_key_values = past_key_values
+
+
+class FakeHFModel:
+    """
+    Stand-in for a transformers causal LM: row i of the batch greedily spells out replies[i] after the
+    assistant header. Its "KV cache" is the history of token ids seen so far.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, replies: list[str], tokenizer: FakeHFTokenizer, delay: float = 0.0):
+        self.replies = replies
+        self.tokenizer = tokenizer
+        self.delay = delay
+        self.batch_sizes: list[int] = []
+        self.calls = 0
+        self.evaluated = 0
+
+    def __call__(self, input_ids, attention_mask=None, past_key_values=None, **kwargs):
+        self.calls += 1
+        self.evaluated += input_ids.shape[1]
+        time.sleep(self.delay)
+        batch_size = input_ids.shape[0]
+        if past_key_values is None:
+            self.batch_sizes.append(batch_size)
+            history = input_ids
+        else:
+            history = torch.cat([past_key_values[0][0], input_ids], dim=1)
+
+        vocabulary = self.tokenizer.vocabulary
+        new_tokens = input_ids.shape[1]
+        # Lower token ids are preferred, so that EOS wins once the reply is spelled out
+        logits = -10.0 * torch.arange(len(vocabulary), dtype=torch.float).repeat(
+            batch_size, new_tokens, 1
+        )
+        for row, token_ids in enumerate(history.tolist()):
+            reply = self.replies[row % len(self.replies)]
+            text, header_end = "", None
+            for position, token_id in enumerate(token_ids):
+                if token_id != self.tokenizer.eos_token_id:
+                    text += vocabulary[token_id]
+                if text.endswith("<|assistant|>"):
+                    header_end = len(text)
+                column = position - (len(token_ids) - new_tokens)
+                step = len(text) - header_end if header_end is not None else 0
+                if column >= 0 and step < len(reply):
+                    logits[row, column, vocabulary.index(reply[step])] = 1000.0
+        return FakeHFOutput(logits, ((history,),))
@@ -0,0 +1,37 @@
+import asyncio
+
+from gigax.step import NPCStepper
+
+
+def test_stepper_api_client_reuse(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    fake_openai_server.delay = 0.05
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=fake_openai_server.url,
+        max_concurrent_requests=2,
+    )
+
+    async def step_many():
+        actions = [
+            await stepper.get_action(context, locations, NPCs, protagonist, items, events)
+            for _ in range(3)
+        ]
+        actions += await asyncio.gather(
+            *(
+                stepper.get_action(context, locations, NPCs, protagonist, items, events)
+                for _ in range(6)
+            )
+        )
+        await stepper.aclose()
+        return actions
+
+    actions = asyncio.run(step_many())
+
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 9
+    assert len(fake_openai_server.requests) == 9
+    # Keep-alive connections are reused, and never more than 2 requests are in flight
+    assert fake_openai_server.max_in_flight == 2
+    assert len(fake_openai_server.connections) <= 2
@@ -0,0 +1,48 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama
+from gigax.scene import ParameterType, Skill
+from gigax.step import NPCStepper, StepRequest
+
+
+def get_batch(step_request, protagonist) -> list[StepRequest]:
+    traveller = protagonist.model_copy(
+        update={
+            "name": "Bertha",
+            "skills": [
+                Skill(
+                    name="Move",
+                    description="Go somewhere",
+                    parameter_types=[ParameterType.location],
+                )
+            ],
+        }
+    )
+    return [step_request(protagonist=npc) for npc in [protagonist, traveller]]
+
+
+def test_get_actions_transformers(transformers_stepper, step_request, protagonist):
+    stepper = transformers_stepper(["Attack John the Brave", "Move Old Town"])
+
+    batch = get_batch(step_request, protagonist)
+    actions = asyncio.run(stepper.get_actions(batch))
+
+    assert [str(action) for action in actions] == [
+        "Aldren: Attack John the Brave",
+        "Bertha: Move Old Town",
+    ]
+    # A single decode for the whole batch
+    assert stepper.model.model.batch_sizes == [2]
+
+
+def test_get_actions_llamacpp(step_request, protagonist):
+    llm = FakeLlama(reply="Attack John the Brave")
+    stepper = NPCStepper(model=models.LlamaCpp(llm))
+
+    batch = get_batch(step_request, protagonist)
+    actions = asyncio.run(stepper.get_actions(batch[:1] * 3))
+
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 3
+    assert stepper.generator_cache.stats.misses == 1
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from outlines import models
+
+from gigax.cache import LRUCache
+from gigax.parse import get_guided_regex
+from gigax.scene import Character, Item, Location, ProtagonistCharacter
+from gigax.step import NPCStepper
+
+
+def test_lru_cache():
+    cache: LRUCache[int] = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used entry
+    cache.put("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get_or_create("c", lambda: 0) == 3
+    assert len(cache) == 2
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (2, 1, 1)
+
+
+def test_stepper_generator_cache(
+    fake_llama,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+):
+    model = models.LlamaCpp(fake_llama)
+    stepper = NPCStepper(model=model, generator_cache_size=4)
+    guided_regex = get_guided_regex(protagonist.skills, NPCs, locations, items)
+
+    first = stepper.get_generator(model, guided_regex.pattern)
+    second = stepper.get_generator(model, guided_regex.pattern)
+
+    assert stepper.generator_cache.stats.misses == 1
+    assert stepper.generator_cache.stats.hits == 1
+    # The compiled FSM is shared, but each call gets its own logits processor state
+    assert first.logits_processor is not second.logits_processor
+    assert first.logits_processor.fsm is second.logits_processor.fsm
+
+    # Generation threads compile each regex once, for each model
+    other = models.LlamaCpp(fake_llama)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda llm: stepper.get_generator(llm, "Attack|Move"), [model, other] * 4))
+    assert (model, "Attack|Move") in stepper.generator_cache
+    assert (other, "Attack|Move") in stepper.generator_cache
+    assert stepper.generator_cache.stats.misses == 3
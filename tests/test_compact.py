@@ -0,0 +1,67 @@
+import asyncio
+
+from gigax.compact import CompactAction, CompactScene
+from gigax.parse import CharacterAction, get_guided_regex
+from gigax.prompt import NPCPromptPrefix
+from gigax.scene import Character, Location, ParameterType, Skill
+from gigax.step import NPCStepper
+
+
+def test_compact_scene_round_trip(context, locations, NPCs, protagonist, items):
+    elsewhere = Location(name="Dark Forest", description="Outside of the scene")
+    NPCs = NPCs + [
+        Character(name="Mary", description="A baker", current_location=elsewhere),
+        protagonist,
+    ]
+    scene = CompactScene(context, locations, NPCs, items)
+
+    assert scene.to_models() == (context, locations, NPCs, items)
+    assert scene.to_models()[2][-1] is protagonist
+    assert scene.location_names == ("Old Town",)
+    assert scene.find("location", "dark forest") is None
+    assert scene.find("character", "MARY").name == "Mary"  # type: ignore
+
+
+def test_compact_scene_step(context, locations, NPCs, protagonist, items):
+    skills = protagonist.skills + [
+        Skill(
+            name="Give",
+            description="Give an item",
+            parameter_types=[ParameterType.character, ParameterType.item, ParameterType.amount],
+        )
+    ]
+    scene = CompactScene(context, locations, NPCs, items)
+    guided_regex = scene.guided_regex(skills)
+
+    assert scene.prompt_prefix() == NPCPromptPrefix(context, locations, NPCs)
+    assert guided_regex.pattern == get_guided_regex(skills, NPCs, locations, items).pattern
+
+    compact = scene.parse_action("Give john the brave Sword 3", "Aldren", guided_regex)
+    action = CharacterAction.from_str(
+        "Give john the brave Sword 3", protagonist, NPCs, locations, items, guided_regex
+    )
+    assert str(compact) == str(action) == "Aldren: Give John the Brave Sword 3"
+    assert compact.to_model(protagonist, scene) == action
+    assert CompactAction.from_model(action, scene) == compact
+
+
+def test_compact_scene_as_scene_index(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    scene = CompactScene(context, locations, NPCs, items)
+    stepper = NPCStepper(model="gigax-test", api_key="test", api_url=fake_openai_server.url)
+
+    async def run():
+        action = await stepper.get_action(
+            context, locations, NPCs, protagonist, items, events, scene_index=scene
+        )
+        await stepper.aclose()
+        return action
+
+    action = asyncio.run(run())
+    assert str(action) == "Aldren: Attack John the Brave"
+    # The entity comes from the compact scene, converted once
+    assert action.parameters[0] == NPCs[0]
+    assert scene.character("JOHN THE BRAVE") is action.parameters[0]
+    prompt = fake_openai_server.requests[0]["messages"][0]["content"]
+    assert prompt.startswith(scene.prompt_prefix())
@@ -0,0 +1,85 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama
+from gigax.parse import get_guided_completions
+from gigax.scene import Character, ParameterType, SceneIndex, Skill
+from gigax.step import NPCStepper
+
+
+def test_get_guided_completions(locations, NPCs, protagonist, items):
+    scene_index = SceneIndex(NPCs, locations, items)
+    move = Skill(
+        name="Move", description="Go somewhere", parameter_types=[ParameterType.location]
+    )
+    say = Skill(name="Say", description="Talk", parameter_types=[ParameterType.content])
+
+    assert get_guided_completions(protagonist.skills, scene_index, limit=4) == [
+        "Attack John the Brave"
+    ]
+    assert get_guided_completions(
+        protagonist.skills + [move], scene_index, limit=4
+    ) == ["Attack John the Brave", "Move Old Town"]
+    assert get_guided_completions(protagonist.skills + [move], scene_index, limit=1) is None
+    # Contents are unbounded
+    assert get_guided_completions([say], scene_index, limit=4) is None
+
+
+def test_single_completion_skips_the_model(
+    context, locations, NPCs, protagonist, items, events
+):
+    llama = FakeLlama("Attack John the Brave")
+    stepper = NPCStepper(model=models.LlamaCpp(llama), max_enumerated_completions=4)  # type: ignore
+
+    action = asyncio.run(
+        stepper.get_action(context, locations, NPCs, protagonist, items, events)
+    )
+
+    assert str(action) == "Aldren: Attack John the Brave"
+    assert llama.prompts == []
+
+
+def test_few_completions_are_scored(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    stepper = transformers_stepper(max_enumerated_completions=4)
+    llm = stepper.model.model
+    john = NPCs[0]
+    NPCs = [
+        Character(name="John", description="John's cousin", current_location=john.current_location),
+        john,
+        Character(name="Mary", description="A baker", current_location=john.current_location),
+    ]
+
+    action = asyncio.run(
+        stepper.get_action(context, locations, NPCs, protagonist, items, events)
+    )
+
+    assert str(action) == "Aldren: Attack John the Brave"
+    # One pass over the prompt, then one over the 3 completions
+    assert llm.calls == 2
+    assert llm.batch_sizes == [1]
+
+
+def test_get_actions_skips_single_completions(transformers_stepper, step_request, protagonist):
+    stepper = transformers_stepper(['Say "Hello"'], max_enumerated_completions=4)
+    talker = protagonist.model_copy(
+        update={
+            "name": "Bertha",
+            "skills": [
+                Skill(name="Say", description="Talk", parameter_types=[ParameterType.content])
+            ],
+        }
+    )
+    batch = [step_request(protagonist=npc) for npc in [protagonist, talker, protagonist]]
+
+    actions = asyncio.run(stepper.get_actions(batch))
+
+    assert [str(action) for action in actions] == [
+        "Aldren: Attack John the Brave",
+        "Bertha: Say Hello",
+        "Aldren: Attack John the Brave",
+    ]
+    # Only the talker was decoded
+    assert stepper.model.model.batch_sizes == [1]
@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+
+BACKENDS = ["outlines", "openai", "httpx", "torch", "transformers", "llama_cpp", "dotenv"]
+
+
+def import_in_subprocess(statement: str) -> tuple[float, list[str]]:
+    """
+    Import time in a fresh interpreter, and the backends it loaded.
+    """
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [m for m in {BACKENDS!r} if m in sys.modules]]))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    seconds, loaded = json.loads(output.splitlines()[-1])
+    return seconds, loaded
+
+
+def test_scene_import_is_lightweight():
+    seconds, loaded = import_in_subprocess("import gigax.scene, gigax.parse")
+    assert loaded == []
+    assert seconds < 1.0, f"Importing gigax.scene and gigax.parse took {seconds:.3f}s"
+
+
+def test_backends_load_lazily():
+    _, loaded = import_in_subprocess("import gigax")
+    assert loaded == []
+
+    # outlines and the local backends are only loaded for local models, the API backend on first use
+    _, loaded = import_in_subprocess(
+        "import gigax; gigax.step.NPCStepper('gigax-test', api_key='test').count_tokens('Hi')"
+    )
+    assert loaded == []
@@ -0,0 +1,58 @@
+from outlines import models
+from outlines.fsm.guide import RegexGuide
+from outlines.integrations.llamacpp import LlamaCppTokenizer
+
+from gigax.index_store import IndexStore, StoredRegexGuide, tokenizer_fingerprint
+from gigax.parse import get_guided_regex
+from gigax.scene import Character, Item, Location, ProtagonistCharacter
+from gigax.step import NPCStepper
+
+
+def test_index_store(
+    tmp_path,
+    fake_llama,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+):
+    tokenizer = LlamaCppTokenizer(fake_llama)
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    pattern = get_guided_regex(protagonist.skills, NPCs, locations, items).pattern
+
+    store = IndexStore(tmp_path)
+    assert store.get(fingerprint, pattern) is None
+    compiled = RegexGuide(pattern, tokenizer)
+    store.put(fingerprint, pattern, compiled)
+
+    # A fresh store (e.g. in a new process) memory-maps the same index
+    warm_store = IndexStore(tmp_path)
+    assert warm_store.preload(fingerprint) == 1
+    stored = warm_store.get(fingerprint, pattern)
+    assert isinstance(stored, StoredRegexGuide)
+
+    for state, transitions in compiled.states_to_token_maps.items():
+        assert sorted(stored.get_next_instruction(state).tokens) == sorted(transitions)
+        for token, next_state in transitions.items():
+            assert stored.get_next_state(state, token) == next_state
+    assert stored.final_states == compiled.final_states
+    assert stored.get_next_state(0, tokenizer.eos_token_id) == -1
+
+
+def test_stepper_index_store(
+    tmp_path,
+    fake_llama,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+):
+    model = models.LlamaCpp(fake_llama)
+    pattern = get_guided_regex(protagonist.skills, NPCs, locations, items).pattern
+
+    NPCStepper(model=model, index_store=str(tmp_path)).get_generator(model, pattern)
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+
+    warm_stepper = NPCStepper(model=model, index_store=str(tmp_path))
+    generator = warm_stepper.get_generator(model, pattern)
+    assert isinstance(generator.logits_processor.fsm, StoredRegexGuide)
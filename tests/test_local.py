@@ -0,0 +1,57 @@
+import asyncio
+
+from gigax.scene import ParameterType, Skill
+
+
+def test_get_action_does_not_block_event_loop(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    stepper = transformers_stepper(delay=0.01)
+
+    async def step_and_tick():
+        task = asyncio.create_task(
+            stepper.get_action(context, locations, NPCs, protagonist, items, events)
+        )
+        ticks = 0
+        while not task.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        return await task, ticks
+
+    action, ticks = asyncio.run(step_and_tick())
+    assert str(action) == "Aldren: Attack John the Brave"
+    assert ticks > 1
+
+
+def test_get_action_cancellation(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    speech = 'Say "' + "la" * 200 + '"'
+    stepper = transformers_stepper([speech], delay=0.01)
+    talker = protagonist.model_copy(
+        update={
+            "skills": [
+                Skill(
+                    name="Say",
+                    description="Say something",
+                    parameter_types=[ParameterType.content],
+                )
+            ]
+        }
+    )
+
+    async def step_and_cancel():
+        task = asyncio.create_task(
+            stepper.get_action(context, locations, NPCs, talker, items, events)
+        )
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(step_and_cancel())
+    # Wait for the generation thread to wind down: it stopped well before the end of the speech
+    stepper.executor.submit(lambda: None).result()
+    assert stepper.model.model.calls < len(speech)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from gigax.memory import HashingEmbedder, MemoryRetriever, MemoryStore
+from gigax.parse import CharacterAction
+from gigax.scene import Location, ProtagonistCharacter
+
+
+def test_hashing_embedder():
+    embedder = HashingEmbedder(dim=64)
+    embeddings = embedder(["The old dragon sleeps", "The old dragon sleeps", ""])
+    assert embeddings.shape == (3, 64)
+    assert np.allclose(embeddings[0], embeddings[1])
+    assert np.isclose(np.linalg.norm(embeddings[0]), 1.0)
+
+
+def test_memory_store():
+    store = MemoryStore(HashingEmbedder(), capacity=2)
+    store.add(["Fought a dragon in the mountains", "Bought bread at the bakery"])
+    store.add(["Lost a sword in the river", "Sold a horse at the market"])  # Grows the array
+    assert len(store) == 4
+    assert store.search("the dragon of the mountains", k=1) == [0]
+    assert store.search("bread bakery market", k=2) == [1, 3]
+
+
+def test_memory_retriever(protagonist: ProtagonistCharacter):
+    forest = Location(name="Dark Forest", description="Wolves howl in the dark forest.")
+    wanderer = protagonist.model_copy(
+        update={
+            "current_location": forest,
+            "memories": [
+                "Saved the village",
+                "Was chased by wolves in the dark forest",
+                "Lost a friend",
+                "Learnt to bake bread",
+            ],
+        }
+    )
+    events = [
+        CharacterAction(command="Say", protagonist=wanderer, parameters=["I hear wolves"])
+    ]
+    retriever = MemoryRetriever(k=1)
+    assert retriever.retrieve(wanderer, events) == ["Was chased by wolves in the dark forest"]
+
+    # New memories are embedded incrementally
+    wanderer.memories.append("Ate wolves stew in the forest")
+    retriever.retrieve(wanderer, events)
+    assert len(retriever.stores[wanderer.name]) == 5
@@ -0,0 +1,102 @@
+import asyncio
+
+from gigax.metrics import Histogram, PrometheusExporter, StepMetrics
+from gigax.step import NPCStepper
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value)
+
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+    assert histogram.cumulative_counts() == [("0.1", 2), ("1.0", 3), ("+Inf", 4)]
+
+
+def test_prometheus_exporter():
+    exporter = PrometheusExporter(buckets=(0.1, 1.0))
+    metrics = StepMetrics(npc="Aldren", seconds=0.5, prompt_tokens=100, generated_tokens=10)
+    metrics.phases = {"decode": 0.4, "prompt": 0.05}
+    metrics.cache("generator", True)
+    metrics.cache("generator", False)
+    exporter(metrics)
+    exporter(metrics)
+
+    text = exporter.render()
+    assert "# TYPE gigax_step_phase_seconds histogram" in text
+    assert 'gigax_step_phase_seconds_bucket{phase="decode",le="1.0"} 2' in text
+    assert 'gigax_step_phase_seconds_count{phase="prompt"} 2' in text
+    # Phases are rendered in step order
+    assert text.index('phase="prompt"') < text.index('phase="decode"')
+    assert "gigax_steps_total 2" in text
+    assert "gigax_prompt_tokens_total 200" in text
+    assert "gigax_generated_tokens_total 20" in text
+    assert 'gigax_cache_hits_total{cache="generator"} 2' in text
+    assert 'gigax_cache_misses_total{cache="generator"} 2' in text
+    assert metrics.tokens_per_second == 25.0
+
+    # Batches have their own latency histogram
+    exporter(StepMetrics(batch_size=4, batch=True, seconds=2.0))
+    text = exporter.render()
+    assert "gigax_steps_total 6" in text
+    assert "gigax_step_seconds_count 2" in text
+    assert 'gigax_batch_seconds_bucket{le="1.0"} 0' in text
+    assert "gigax_batch_seconds_count 1" in text
+
+
+def test_stepper_metrics_local(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    steps: list[StepMetrics] = []
+
+    def failing_hook(metrics: StepMetrics):
+        raise RuntimeError("A failing hook never fails the step")
+
+    stepper = transformers_stepper(metrics_hooks=[steps.append, failing_hook])
+
+    async def step_twice():
+        return [
+            await stepper.get_action(context, locations, NPCs, protagonist, items, events)
+            for _ in range(2)
+        ]
+
+    actions = asyncio.run(step_twice())
+
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 2
+    assert len(steps) == 2
+    first, second = steps
+    assert first.npc == "Aldren"
+    assert set(first.phases) == {"prompt", "regex", "fsm", "chat_template", "decode", "parse"}
+    assert first.seconds >= sum(first.phases.values())
+    assert first.prompt_tokens > 0
+    assert first.generated_tokens == len("Attack John the Brave")  # One token per character
+    # The generator compiled by the first step is reused by the second one
+    assert first.cache_misses == {"generator": 1}
+    assert second.cache_hits == {"generator": 1}
+
+
+def test_stepper_metrics_api(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    exporter = PrometheusExporter()
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=fake_openai_server.url,
+        metrics_hooks=[exporter],
+    )
+
+    async def step():
+        action = await stepper.get_action(
+            context, locations, NPCs, protagonist, items, events
+        )
+        await stepper.aclose()
+        return action
+
+    asyncio.run(step())
+
+    text = exporter.render()
+    assert "gigax_steps_total 1" in text
+    assert 'gigax_step_phase_seconds_count{phase="decode"} 1' in text
+    assert "gigax_generated_tokens_total 0" not in text
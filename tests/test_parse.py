@@ -1,5 +1,17 @@
-from gigax.parse import CharacterAction, get_guided_regex
-from gigax.scene import Character, Item, Location, ProtagonistCharacter
+import re
+
+from gigax.parse import CharacterAction, get_guided_regex, guided_regex_cache
+from gigax.scene import (
+    Character,
+    Item,
+    Location,
+    ParameterType,
+    ProtagonistCharacter,
+    SceneIndex,
+    Skill,
+    names_to_regex,
+    skill_regex_fragments,
+)
 
 
 def test_parse(
@@ -25,3 +37,69 @@ def test_parse(
     assert character_action.command == "Attack"
     assert character_action.protagonist == protagonist
     assert character_action.parameters == [NPCs[0]]
+
+
+def test_names_to_regex():
+    names = ("John", "Johanna", "Jon", "Jonathan", "Old Town", "Old Tower", "Mr. (X)")
+    pattern = names_to_regex(names)
+    assert pattern.count("Jo") == 1  # The common prefix is factored out
+
+    compiled = re.compile(pattern)
+    for name in names:
+        assert compiled.fullmatch(name)
+    for other in ["Jo", "Johann", "Old", "Old Towe", "Mr. X"]:
+        assert not compiled.fullmatch(other)
+
+
+def test_parse_case_insensitive(
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+):
+    scene_index = SceneIndex(NPCs, locations, items)
+    assert scene_index.character("JOHN THE BRAVE") is NPCs[0]
+    assert scene_index.item("unknown") is None
+
+    compiled_combined_regex = get_guided_regex(
+        protagonist.skills, NPCs, locations, items, scene_index
+    )
+    character_action = CharacterAction.from_str(
+        "ATTACK john the brave",
+        protagonist,
+        NPCs,
+        locations,
+        items,
+        compiled_combined_regex,
+        scene_index,
+    )
+    assert character_action.command == "Attack"
+    assert character_action.parameters == [NPCs[0]]
+
+
+def test_guided_regex_memoised(
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+):
+    assert skill_regex_fragments("Say", (ParameterType.character, ParameterType.content)) == (
+        (r"Say\s+(?P<Say_character>", "character"),
+        (r')\s+(?P<Say_content>"[^"]*")', None),
+    )
+
+    regex = get_guided_regex(protagonist.skills, NPCs, locations, items)
+    hits = guided_regex_cache.stats.hits
+    # Equal skills (whatever their description) and entity names share the same pattern
+    skills = [skill.model_copy(update={"description": "Other"}) for skill in protagonist.skills]
+    renamed = [NPCs[0].model_copy(update={"description": "Other"})]
+    assert get_guided_regex(skills, renamed, locations, items) is regex
+    assert guided_regex_cache.stats.hits == hits + 1
+
+    wait = Skill(name="Wait", description="Do nothing", parameter_types=[])
+    other = get_guided_regex(protagonist.skills + [wait], NPCs, locations, items)
+    assert other is not regex and other.match("wait")
+    newcomer = NPCs[0].model_copy(update={"name": "Bertha"})
+    assert get_guided_regex(protagonist.skills, NPCs + [newcomer], locations, items).match(
+        "Attack Bertha"
+    )
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from gigax.pool import StepperPool, split_cores
+from gigax.session import Scene
+from tests.helpers import FakeLlamaReplica
+
+
+def test_split_cores():
+    assert split_cores(list(range(8)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert split_cores([0], 2) == [[0], [0]]
+
+
+def test_stepper_pool(step_request, context, locations, NPCs, protagonist, items, events):
+    steps = []
+    pool = StepperPool(
+        FakeLlamaReplica("Attack John the Brave", delay=0.2),
+        replicas=2,
+        metrics_hooks=[steps.append],
+    )
+    request = step_request()
+
+    async def run():
+        with pytest.raises(RuntimeError, match="not started"):
+            await pool.get_actions([request])
+        await pool.astart()
+        first = asyncio.create_task(pool.get_actions([request, request]))
+        second = asyncio.create_task(
+            pool.get_action(context, locations, NPCs, protagonist, items, events)
+        )
+        await asyncio.sleep(0)
+        # Each step went to the least-loaded worker
+        in_flight = [worker.in_flight for worker in pool.workers]
+        return in_flight, await first, await second
+
+    try:
+        in_flight, batch, action = asyncio.run(run())
+    finally:
+        pool.close()
+
+    assert in_flight == [2, 1]
+    assert [str(a) for a in batch + [action]] == ["Aldren: Attack John the Brave"] * 3
+    assert sorted(metrics.batch_size for metrics in steps) == [1, 2]
+    assert pool.workers == []
+
+
+def test_stepper_pool_scene(context, locations, NPCs, protagonist, items, events):
+    pool = StepperPool(FakeLlamaReplica("Attack John the Brave"), replicas=1)
+    scene = Scene(context, locations, NPCs, items, events)
+
+    async def run():
+        async with pool:
+            action = await scene.get_action(pool, protagonist)
+            streamed = [
+                action
+                async for action in pool.stream_action(
+                    context, locations, NPCs, protagonist, items, events
+                )
+            ]
+        return action, streamed
+
+    action, streamed = asyncio.run(run())
+
+    assert str(action) == "Aldren: Attack John the Brave"
+    # Only the complete action is streamed
+    assert [str(a) for a in streamed] == ["Aldren: Attack John the Brave"]
@@ -0,0 +1,68 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama
+from gigax.prefix_cache import PrefixCache
+from gigax.step import NPCStepper
+
+
+def test_prefix_cache_memory_budget():
+    cache = PrefixCache(max_bytes=100)
+    cache.put(("a",), "state a", 60)
+    cache.put(("b",), "state b", 30)
+    assert cache.get(("a",)) == "state a"
+    cache.put(("c",), "state c", 30)  # Evicts "b", the least recently used entry
+
+    assert cache.get(("b",)) is None
+    assert cache.nbytes == 90
+    cache.put(("d",), "too large", 101)
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+    # Keyed by the prefix tokens only: a cache holds the states of a single model
+    assert PrefixCache.key([1, 2, 3]) == PrefixCache.key([1, 2, 3]) != PrefixCache.key([1, 2])
+
+
+def step_two_npcs(stepper, context, locations, NPCs, protagonist, items, events):
+    neighbour = protagonist.model_copy(update={"name": "Bertha"})
+
+    async def step():
+        return [
+            await stepper.get_action(context, locations, NPCs, npc, items, events)
+            for npc in [protagonist, neighbour]
+        ]
+
+    return [str(action) for action in asyncio.run(step())]
+
+
+def test_prefix_cache_transformers(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    evaluated = {}
+    for prefix_cache_bytes in [0, 1 << 20]:
+        stepper = transformers_stepper(prefix_cache_bytes=prefix_cache_bytes)
+        actions = step_two_npcs(stepper, context, locations, NPCs, protagonist, items, events)
+        assert actions == ["Aldren: Attack John the Brave", "Bertha: Attack John the Brave"]
+        evaluated[prefix_cache_bytes] = stepper.model.model.evaluated
+
+    assert stepper.prefix_cache.stats.hits == 1
+    assert stepper.prefix_cache.stats.misses == 1
+    # The prefix shared by the two NPCs is only evaluated once
+    assert evaluated[1 << 20] < evaluated[0]
+
+
+def test_prefix_cache_llamacpp(context, locations, NPCs, protagonist, items, events):
+    evaluated = {}
+    for prefix_cache_bytes in [0, 1 << 20]:
+        llm = FakeLlama(reply="Attack John the Brave")
+        stepper = NPCStepper(
+            model=models.LlamaCpp(llm), prefix_cache_bytes=prefix_cache_bytes
+        )
+        actions = step_two_npcs(stepper, context, locations, NPCs, protagonist, items, events)
+        assert actions == ["Aldren: Attack John the Brave", "Bertha: Attack John the Brave"]
+        evaluated[prefix_cache_bytes] = llm.evaluated
+
+    assert stepper.prefix_cache.stats.hits == 1
+    assert evaluated[1 << 20] < evaluated[0]
+    # Generation threads share the cache under the stepper's lock
+    assert stepper.prefix_cache.lock is stepper._generator_lock
@@ -1,5 +1,14 @@
+from gigax.fakes import FakeLlama
 from gigax.parse import CharacterAction
-from gigax.prompt import NPCPrompt
+from gigax.prompt import (
+    LlamaChatFormatter,
+    NPCPrompt,
+    NPCPromptBuilder,
+    NPCPromptPrefix,
+    NPCPromptSuffix,
+    approximate_token_count,
+    llama_chat_template,
+)
 from gigax.scene import Character, Item, Location, ProtagonistCharacter
 
 
@@ -36,3 +45,92 @@ Attack <character> : Deliver a powerful blow
 Aldren:"""
 
     assert prompt == test_prompt, f"{prompt} != {test_prompt}"
+
+
+def test_prompt_templates_render_like_outlines(
+    context: str,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+    events: list[CharacterAction],
+):
+    import outlines
+
+    for template, args in [
+        (NPCPromptPrefix, (context, locations, NPCs)),
+        (NPCPromptSuffix, (protagonist, items, events)),
+    ]:
+        assert template(*args) == outlines.prompt(template.fn)(*args)
+
+
+def test_prompt_builder(
+    context: str,
+    locations: list[Location],
+    NPCs: list[Character],
+    protagonist: ProtagonistCharacter,
+    items: list[Item],
+    events: list[CharacterAction],
+):
+    counted: list[str] = []
+
+    def count_tokens(text: str) -> int:
+        counted.append(text)
+        return approximate_token_count(text)
+
+    # A large budget leaves the prompt untouched
+    builder = NPCPromptBuilder(max_tokens=10_000, count_tokens=count_tokens)
+    assert builder(context, locations, NPCs, protagonist, items, events) == NPCPrompt(
+        context, locations, NPCs, protagonist, items, events
+    )
+
+    history = [
+        CharacterAction(
+            command="Say", protagonist=protagonist, parameters=[f"Message number {i}"]
+        )
+        for i in range(200)
+    ]
+    builder = NPCPromptBuilder(max_tokens=250, count_tokens=count_tokens)
+    prompt = builder(context, locations, NPCs, protagonist, items, history)
+
+    assert approximate_token_count(prompt) <= 250
+    assert "Message number 199" in prompt
+    assert "Message number 100" not in prompt
+    assert "Find the ancient artifact" in prompt  # Quests come first
+
+    # The next step only tokenizes what is new: the base prompt is unchanged
+    counted.clear()
+    history.append(
+        CharacterAction(command="Say", protagonist=protagonist, parameters=["Hello"])
+    )
+    prompt = builder(context, locations, NPCs, protagonist, items, history)
+    assert "Aldren: Say Hello" in prompt
+    assert counted == ["Aldren: Say Hello"]
+
+    # A new location only re-tokenizes the rest of the base prompt, not its prefix
+    counted.clear()
+    moved = protagonist.model_copy(
+        update={"current_location": Location(name="Market", description="Busy")}
+    )
+    builder(context, locations, NPCs, moved, items, history)
+    assert len(counted) == 1 and "CURRENT LOCATION: Market" in counted[0]
+
+
+def test_llama_chat_formatter():
+    llama = FakeLlama()
+    formatter = LlamaChatFormatter(llama)
+    messages = [{"role": "user", "content": " Hello\nworld "}]
+
+    assert formatter.header == "</s><|user|>"
+    assert formatter.footer == "<|end|><|assistant|>"
+    assert formatter(" Hello\nworld ") == llama_chat_template(
+        messages, "</s>", llama.chat_template  # type: ignore
+    )
+
+    # Templates that alter the message are rendered for every prompt
+    llama.metadata["tokenizer.chat_template"] = (
+        "{% for message in messages %}[{{ message['content'] | trim }}]{% endfor %}"
+    )
+    formatter = LlamaChatFormatter(llama)
+    assert formatter.header is None
+    assert formatter(" Hello ") == "[Hello]"
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from gigax.fakes import FakeOpenAIServer
+from gigax.metrics import PrometheusExporter, StepMetrics
+from gigax.parse import (
+    ActionParsingError,
+    CharacterAction,
+    ParameterType,
+    Skill,
+    get_guided_regex,
+    repair_action_text,
+)
+from gigax.scene import Character, SceneIndex
+from gigax.step import NPCStepper
+
+
+@pytest.fixture()
+def speaker(protagonist):
+    say = Skill(
+        name="Say",
+        description="Say something",
+        parameter_types=[ParameterType.character, ParameterType.content],
+    )
+    return protagonist.model_copy(update={"skills": protagonist.skills + [say]})
+
+
+def test_repair_action_text(speaker, NPCs, locations, items):
+    scene_index = SceneIndex(NPCs, locations, items)
+    # Truncated while writing the content
+    assert (
+        repair_action_text('Say John the Brave "Hello the', speaker, scene_index)
+        == 'Say John the Brave "Hello the"'
+    )
+    assert repair_action_text(None, speaker, scene_index) is None  # e.g. no API content
+    assert repair_action_text(" Attack John the Brave", speaker, scene_index) == (
+        "Attack John the Brave"
+    )
+    assert repair_action_text("Attack John", speaker, scene_index) is None
+    assert repair_action_text('Say John the Brave "', speaker, scene_index) == (
+        'Say John the Brave ""'
+    )
+    assert repair_action_text("Say John the", speaker, scene_index) is None
+    assert repair_action_text("Sing", speaker, scene_index) is None
+
+    # Shorter prefixes are tried until one is accepted, even if a longer name could follow it
+    names = [
+        Character(name=name, description="A northerner", current_location=locations[0])
+        for name in ["Jon", "Jon Snow"]
+    ]
+    scene_index = SceneIndex(names, locations, items)
+    guided_regex = get_guided_regex(speaker.skills, names, locations, items, scene_index)
+    assert (
+        repair_action_text("Attack Jon Sn", speaker, scene_index, guided_regex)
+        == "Attack Jon"
+    )
+
+
+def test_stepper_recovery(step_request, context, locations, NPCs, speaker, items, events):
+    replies: list[str | None] = []
+    server = FakeOpenAIServer(respond=lambda prompt: replies.pop(0)).start()
+    exporter = PrometheusExporter()
+    steps: list[StepMetrics] = []
+
+    def wait(protagonist):
+        return CharacterAction(command="Wait", protagonist=protagonist, parameters=[])
+
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=server.url,
+        metrics_hooks=[steps.append, exporter],
+    )
+    request = step_request(protagonist=speaker)
+
+    async def step():
+        return await stepper.get_action(context, locations, NPCs, speaker, items, events)
+
+    async def run():
+        # Repaired without prompting the model again
+        replies.extend(['Say John the Brave "Well met'])
+        repaired = await step()
+        # Regenerated
+        replies.extend(["Atack John the Brave", "Attack John the Brave"])
+        retried = await step()
+        # Regenerated, with no content at all the first time
+        replies.extend([None, "Attack John the Brave"])
+        assert str(await step()) == "Aldren: Attack John the Brave"
+        # Out of attempts: raised, or returned with return_exceptions
+        replies.extend(["Sing", "Dance"])
+        with pytest.raises(ActionParsingError):
+            await step()
+        replies.extend(["Sing", "Dance"])
+        [error] = await stepper.get_actions([request], return_exceptions=True)
+        # Out of attempts, with a default action
+        stepper.default_action = wait
+        replies.extend(["Sing", "Dance"])
+        default = await step()
+        await stepper.aclose()
+        return repaired, retried, error, default
+
+    repaired, retried, error, default = asyncio.run(run())
+    server.stop()
+
+    assert str(repaired) == "Aldren: Say John the Brave Well met"
+    assert str(retried) == "Aldren: Attack John the Brave"
+    assert isinstance(error, ActionParsingError)
+    assert str(default) == "Aldren: Wait "
+    assert len(server.requests) == 11
+    assert [(m.parse_failures, m.parse_retries, m.parse_recoveries) for m in steps] == [
+        (1, 0, {"repair": 1}),
+        (1, 1, {"retry": 1}),
+        (1, 1, {"retry": 1}),
+        (1, 1, {}),
+        (1, 1, {}),
+        (1, 1, {"default": 1}),
+    ]
+
+    text = exporter.render()
+    assert "gigax_parse_failures_total 6" in text
+    assert "gigax_parse_retries_total 5" in text
+    assert 'gigax_parse_recoveries_total{method="repair"} 1' in text
+    assert 'gigax_parse_recoveries_total{method="default"} 1' in text
+
+
+def test_parse_retry_budget(context, locations, NPCs, protagonist, items, events):
+    server = FakeOpenAIServer(reply="Sing").start()
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=server.url,
+        max_parse_attempts=5,
+        parse_retry_seconds=0.0,
+    )
+
+    async def run():
+        try:
+            with pytest.raises(ActionParsingError):
+                await stepper.get_action(context, locations, NPCs, protagonist, items, events)
+        finally:
+            await stepper.aclose()
+
+    asyncio.run(run())
+    server.stop()
+    # No time left to regenerate
+    assert len(server.requests) == 1
@@ -0,0 +1,152 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama, FakeOpenAIServer
+from gigax.metrics import StepMetrics
+from gigax.parse import CharacterAction
+from gigax.replay import (
+    StepRecorder,
+    TraceEntry,
+    action_to_command,
+    load_trace,
+    percentile,
+    replay,
+    trace_responder,
+)
+from gigax.scene import Character
+from gigax.step import NPCStepper
+
+
+def test_action_to_command(protagonist, items):
+    action = CharacterAction(
+        command="Give", protagonist=protagonist, parameters=[items[0], 3, "Take it"]
+    )
+    assert action_to_command(action) == 'Give Sword 3 "Take it"'
+    assert percentile([3.0, 1.0, 2.0, 4.0], 0.5) == 2.0
+    assert percentile([3.0, 1.0, 2.0, 4.0], 0.99) == 4.0
+
+
+def test_record_and_replay(
+    tmp_path, step_request, context, locations, NPCs, protagonist, items, events
+):
+    path = str(tmp_path / "trace.jsonl")
+    recorder = StepRecorder(
+        NPCStepper(model=models.LlamaCpp(FakeLlama("Attack John the Brave"))),  # type: ignore
+        path,
+    )
+    request = step_request(
+        protagonist=protagonist.model_copy(update={"name": "Bertha"}), events=[]
+    )
+
+    async def record():
+        await recorder.get_action(context, locations, NPCs, protagonist, items, events)
+        await recorder.get_actions([request])
+
+    asyncio.run(record())
+    recorder.close()
+    recorder.stepper.close()
+    trace = load_trace(path)
+    assert [entry.action for entry in trace] == [
+        "Aldren: Attack John the Brave",
+        "Bertha: Attack John the Brave",
+    ]
+    assert trace[1].request == request
+
+    # Replayed offline, with a fake model giving the recorded responses
+    llama = FakeLlama(token_latency=0.001)
+    stepper = NPCStepper(model=models.LlamaCpp(llama))  # type: ignore
+    llama.respond = trace_responder(stepper, trace)
+    report = asyncio.run(replay(stepper, trace))
+    stepper.close()
+
+    summary = report.summary()
+    assert summary["steps"] == 2
+    assert summary["mismatches"] == 0
+    assert summary["latency"]["p50"] >= 0.001 * len("Attack John the Brave")
+    assert {"prompt", "regex", "decode", "parse"} <= set(summary["phases"])
+    assert stepper.metrics_hooks == []
+
+
+def test_replay_api(step_request, protagonist):
+    trace = [
+        TraceEntry(
+            request=step_request(protagonist=protagonist.model_copy(update={"name": name})),
+            response="Attack John the Brave",
+            action=f"{name}: Attack John the Brave",
+            seconds=0.0,
+        )
+        for name in ["Aldren", "Bertha"]
+    ]
+    server = FakeOpenAIServer(token_latency=0.001).start()
+    stepper = NPCStepper(model="gigax-test", api_key="test", api_url=server.url)
+    server.respond = trace_responder(stepper, trace)
+
+    async def run():
+        report = await replay(stepper, trace, concurrency=2)
+        await stepper.aclose()
+        return report
+
+    report = asyncio.run(run())
+    server.stop()
+
+    assert report.mismatches == 0
+    assert len(server.requests) == 2
+
+
+def test_record_parse_failures(tmp_path, step_request, current_location):
+    path = str(tmp_path / "trace.jsonl")
+    replies = iter(["Attack Nobody", "Attack John the Brave"] * 2)
+    server = FakeOpenAIServer(
+        respond=lambda prompt: "Attack Mary" if "castle" in prompt else next(replies)
+    ).start()
+    stepper = NPCStepper(model="gigax-test", api_key="test", api_url=server.url)
+    recorder = StepRecorder(stepper, path)
+    # The same NPC in two scenes
+    mary = Character(name="Mary", description="A ghost", current_location=current_location)
+    requests = [step_request(), step_request(context="A haunted castle.", NPCs=[mary])]
+
+    async def record():
+        await recorder.get_actions(requests)
+        await asyncio.gather(
+            *(
+                recorder.get_action(
+                    r.context, r.locations, r.NPCs, r.protagonist, r.items, r.events
+                )
+                for r in requests
+            )
+        )
+        recorder.close()
+        await stepper.aclose()
+
+    asyncio.run(record())
+    server.stop()
+    # The raw responses of each step are recorded, including the ones that did not parse
+    trace = load_trace(path)
+    recorded = [(entry.action, entry.response, entry.retries) for entry in trace]
+    expected = [
+        ("Aldren: Attack John the Brave", "Attack Nobody", ["Attack John the Brave"]),
+        ("Aldren: Attack Mary", "Attack Mary", []),
+    ]
+    assert recorded[:2] == expected
+    # The concurrent steps are recorded as they finish
+    assert sorted(recorded[2:]) == expected
+    assert stepper.metrics_hooks == []
+
+    server = FakeOpenAIServer(token_latency=0.001).start()
+    stepper = NPCStepper(model="gigax-test", api_key="test", api_url=server.url)
+    server.respond = trace_responder(stepper, trace)
+    steps: list[StepMetrics] = []
+    stepper.metrics_hooks.append(steps.append)
+
+    async def run():
+        report = await replay(stepper, trace)
+        await stepper.aclose()
+        return report
+
+    report = asyncio.run(run())
+    server.stop()
+
+    assert report.mismatches == 0
+    assert len(server.requests) == 6
+    assert sorted(m.parse_recoveries.get("retry", 0) for m in steps) == [0, 0, 1, 1]
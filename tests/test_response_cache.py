@@ -0,0 +1,118 @@
+import asyncio
+
+from outlines import models
+
+from gigax.cache import TTLCache
+from gigax.fakes import FakeLlama
+from gigax.response_cache import ResponseCache
+from gigax.step import NPCStepper
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_ttl_cache():
+    clock = FakeClock()
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=10.0, clock=clock)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    clock.now = 5.0
+    assert cache.get("a") == "A"
+    cache.put("c", "C")  # Evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.stats.evictions == 1
+
+    clock.now = 10.0
+    assert cache.get("a") is None
+    assert cache.get("c") == "C"
+    assert cache.stats.expirations == 1
+
+
+def test_response_cache_candidates():
+    cache = ResponseCache(candidates=2)
+    sampling = {"temperature": 0.8}
+    key = cache.key("prompt", "regex", "model", sampling)
+    assert key == cache.key("prompt", "regex", "model", {"temperature": 0.8})
+    assert key != cache.key("prompt", "regex", "model", {"temperature": 0.5})
+
+    # Misses until there are enough candidates to pick from
+    cache.put(key, "Attack John", sampling)
+    assert cache.get(key, sampling) is None
+    cache.put(key, "Wait", sampling)
+    cache.put(key, "Say Hi", sampling)  # Already full
+    assert {cache.get(key, sampling) for _ in range(50)} == {"Attack John", "Wait"}
+    assert cache.stats.misses == 1
+
+    # Deterministic sampling only needs one response
+    greedy = {"temperature": 0}
+    key = cache.key("prompt", "regex", "model", greedy)
+    cache.put(key, "Wait", greedy)
+    assert cache.get(key, greedy) == "Wait"
+
+
+def test_stepper_response_cache(
+    step_request, context, locations, NPCs, protagonist, items, events
+):
+    llama = FakeLlama("Attack John the Brave")
+    stepper = NPCStepper(
+        model=models.LlamaCpp(llama),  # type: ignore
+        response_cache=ResponseCache(),
+        metrics_hooks=[lambda metrics: steps.append(metrics)],
+    )
+    steps = []
+    request = step_request()
+
+    async def run():
+        first = await stepper.get_action(context, locations, NPCs, protagonist, items, events)
+        actions = await stepper.get_actions([request, request])
+        streamed = [
+            action
+            async for action in stepper.stream_action(
+                context, locations, NPCs, protagonist, items, events
+            )
+        ]
+        return [first] + actions + streamed
+
+    actions = asyncio.run(run())
+    stepper.close()
+
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 4
+    # Only the first step prompted the model
+    assert len(llama.prompts) == 1
+    assert steps[0].cache_misses == {"generator": 1, "response": 1}
+    assert steps[1].cache_hits == {"response": 2}
+    assert steps[2].cache_hits == {"response": 1}
+    assert stepper.response_cache.stats.hit_rate == 0.75  # type: ignore
+
+
+def test_stepper_temperature(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    llama = FakeLlama("Attack John the Brave")
+    stepper = NPCStepper(
+        model=models.LlamaCpp(llama),  # type: ignore
+        response_cache=ResponseCache(candidates=3),
+        temperature=0,
+    )
+    api_stepper = NPCStepper(
+        model="gigax-test", api_key="test", api_url=fake_openai_server.url, temperature=0.3
+    )
+
+    async def run():
+        for _ in range(2):
+            await stepper.get_action(context, locations, NPCs, protagonist, items, events)
+        await api_stepper.get_action(context, locations, NPCs, protagonist, items, events)
+        await api_stepper.aclose()
+
+    asyncio.run(run())
+    stepper.close()
+
+    # Greedy decoding: a single response is cached per prompt
+    assert stepper.sampling_params() == {"sampler": "greedy", "temperature": 0}
+    assert len(llama.prompts) == 1
+    assert fake_openai_server.requests[0]["temperature"] == 0.3
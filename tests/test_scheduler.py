@@ -0,0 +1,109 @@
+import asyncio
+import functools
+
+import pytest
+
+from gigax.scene import Skill
+from gigax.scheduler import DeadlineExceededError, Priority, TickScheduler, idle_action
+
+
+def test_scheduler_priorities(transformers_stepper, step_request, protagonist):
+    stepper = transformers_stepper(delay=0.002)
+    scheduler = TickScheduler(stepper, max_batch_size=1)
+    done: list[str] = []
+
+    async def step(name: str, priority: Priority):
+        request = step_request(protagonist=protagonist.model_copy(update={"name": name}))
+        action = await scheduler.submit(request, priority)
+        done.append(action.protagonist.name)
+
+    async def tick():
+        first = asyncio.create_task(step("Villager 1", Priority.background))
+        await asyncio.sleep(0)  # The first villager is being stepped
+        await asyncio.gather(
+            first,
+            step("Villager 2", Priority.background),
+            step("Guard", Priority.normal),
+            step("Merchant", Priority.interactive),
+        )
+        await scheduler.close()
+
+    asyncio.run(tick())
+
+    assert done == ["Villager 1", "Merchant", "Guard", "Villager 2"]
+    assert scheduler.stats[Priority.background].met == 2
+    assert scheduler.stats[Priority.interactive].miss_rate == 0.0
+
+
+def test_scheduler_deadlines(transformers_stepper, step_request, protagonist):
+    stepper = transformers_stepper(delay=0.01)
+    llm = stepper.model.model
+    scheduler = TickScheduler(stepper, max_batch_size=1)
+
+    wait = Skill(name="Wait", description="Stay idle", parameter_types=[])
+
+    def get_request(name: str):
+        return step_request(
+            protagonist=protagonist.model_copy(
+                update={"name": name, "skills": protagonist.skills + [wait]}
+            )
+        )
+
+    async def tick():
+        villager = asyncio.create_task(
+            scheduler.submit(
+                get_request("Villager"),
+                Priority.background,
+            )
+        )
+        await asyncio.sleep(0)
+        # The merchant waits for the villager's step, and misses its deadline
+        merchant = await scheduler.submit(
+            get_request("Merchant"),
+            Priority.interactive,
+            deadline=0.05,
+        )
+        await villager
+
+        # Steps are known to take longer than this deadline: the guard is not even decoded
+        scheduler.step_seconds = 10.0
+        calls = llm.calls
+        scheduler.fallback = None
+        try:
+            await scheduler.submit(
+                get_request("Guard"),
+                Priority.interactive,
+                deadline=1.0,
+            )
+        except DeadlineExceededError:
+            pass
+        else:
+            raise AssertionError("The guard should have missed its deadline")
+        assert llm.calls == calls
+        await scheduler.close()
+        return merchant, await villager
+
+    merchant, villager = asyncio.run(tick())
+
+    assert str(villager) == "Villager: Attack John the Brave"
+    assert merchant.command == "Wait"
+    stats = scheduler.stats[Priority.interactive]
+    assert (stats.submitted, stats.met, stats.missed, stats.dropped) == (2, 0, 2, 1)
+    assert stats.miss_rate == 1.0
+    assert scheduler.stats[Priority.background].miss_rate == 0.0
+    assert 'gigax_deadline_miss_rate{priority="interactive"} 1.0' in scheduler.render_metrics()
+
+
+def test_idle_action(step_request, protagonist):
+    skills = protagonist.skills + [
+        Skill(name="Rest", description="Take a break", parameter_types=[])
+    ]
+    request = step_request(protagonist=protagonist.model_copy(update={"skills": skills}))
+
+    action = functools.partial(idle_action, command="rest")(request)
+    assert action.command == "Rest" and action.parameters == []
+    # The idle command must be a skill of the NPC, without parameters
+    with pytest.raises(DeadlineExceededError, match="no Wait skill"):
+        idle_action(request)
+    with pytest.raises(DeadlineExceededError, match="no Attack skill"):
+        idle_action(request, command="Attack")
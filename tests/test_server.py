@@ -0,0 +1,94 @@
+import asyncio
+
+import httpx
+
+from gigax.server import StepServer
+
+
+def test_server(transformers_stepper, step_request):
+    stepper = transformers_stepper(delay=0.005)
+    request = step_request().model_dump_json()
+
+    async def serve_and_query():
+        server = StepServer(stepper, port=0, max_batch_size=4, max_wait=0.05)
+        await server.start()
+        async with httpx.AsyncClient(base_url=server.url) as client:
+            responses = await asyncio.gather(
+                *(client.post("/step", content=request) for _ in range(4))
+            )
+            health = await client.get("/health")
+            metrics = await client.get("/metrics")
+            invalid = await client.post("/step", content=b"{}")
+            unknown = await client.get("/unknown")
+        await server.close()
+        return responses, health, metrics, invalid, unknown
+
+    responses, health, metrics, invalid, unknown = asyncio.run(serve_and_query())
+
+    assert [response.status_code for response in responses] == [200] * 4
+    assert responses[0].json()["action"] == "Aldren: Attack John the Brave"
+    assert responses[0].json()["command"] == "Attack"
+    # The 4 concurrent requests were decoded in a single batch
+    assert stepper.model.model.batch_sizes == [4]
+    assert health.json()["status"] == "ok"
+    assert "gigax_steps_total 4" in metrics.text
+    assert "gigax_batch_size_count 1" in metrics.text
+    assert invalid.status_code == 400
+    assert unknown.status_code == 404
+
+
+def test_server_backpressure(transformers_stepper, step_request):
+    stepper = transformers_stepper(delay=0.01)
+    request = step_request().model_dump_json()
+
+    async def overload():
+        server = StepServer(stepper, port=0, max_batch_size=1, max_wait=0, max_queue_size=1)
+        await server.start()
+        async with httpx.AsyncClient(base_url=server.url) as client:
+            first = asyncio.create_task(client.post("/step", content=request))
+            await asyncio.sleep(0.05)  # The first request is being decoded
+            queued = asyncio.create_task(client.post("/step", content=request))
+            await asyncio.sleep(0.05)
+            rejected = await client.post("/step", content=request)
+            responses = [await first, await queued, rejected]
+        await server.close()
+        return responses
+
+    first, queued, rejected = asyncio.run(overload())
+
+    assert first.status_code == 200
+    assert queued.status_code == 200
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "1"
+
+
+def test_server_client_disconnect(transformers_stepper, step_request):
+    stepper = transformers_stepper(delay=0.01)
+    request = step_request().model_dump_json().encode()
+
+    async def give_up():
+        server = StepServer(stepper, port=0, max_batch_size=1, max_wait=0)
+        await server.start()
+        async with httpx.AsyncClient(base_url=server.url) as client:
+            first = asyncio.create_task(client.post("/step", content=request))
+            await asyncio.sleep(0.05)  # The first request is being decoded
+            _, writer = await asyncio.open_connection(server.host, server.port)
+            writer.write(
+                b"POST /step HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(request) + request
+            )
+            await writer.drain()
+            await asyncio.sleep(0.05)
+            writer.close()  # Gone before its turn
+            first = await first
+            await asyncio.sleep(0.1)
+            health = await client.get("/health?verbose=1")
+        await server.close()
+        return first, health
+
+    first, health = asyncio.run(give_up())
+
+    assert first.status_code == 200
+    # Query strings do not change the route
+    assert health.status_code == 200 and health.json()["queue_size"] == 0
+    # The request of the client that went away was never decoded
+    assert stepper.model.model.batch_sizes == [1]
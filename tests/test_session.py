@@ -0,0 +1,67 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama
+from gigax.parse import CharacterAction, get_guided_regex
+from gigax.prompt import NPCPrompt
+from gigax.scene import Character, Item, Location
+from gigax.session import Scene
+from gigax.step import NPCStepper
+
+
+def test_scene_deltas(context, locations, NPCs, protagonist, items, events):
+    scene = Scene(context, locations, NPCs, items, events, max_events=2)
+    assert scene.index.character_names == ("John the Brave",)
+    assert scene.guided_regex(protagonist).pattern == (
+        get_guided_regex(protagonist.skills, NPCs, locations, items).pattern
+    )
+
+    # Moves and events leave the derived data untouched
+    forest = Location(name="Dark Forest", description="A scary forest")
+    scene.add(forest)
+    index, regex, prefix = scene.index, scene.guided_regex(protagonist), scene.prompt_prefix
+    john = scene.move("John the Brave", "Dark Forest")
+    scene.append_event(events[0])
+    scene.append_event(events[0])
+    assert len(scene.events) == 2
+    assert scene.index is index
+    assert scene.index.character("john the brave") is john
+    assert scene.guided_regex(protagonist) is regex
+    assert scene.prompt_prefix is prefix
+    assert scene.NPCs[0].current_location == forest
+
+    # Items are not part of the prompt prefix
+    scene.add(Item(name="Shield", description="A wooden shield"))
+    assert scene.prompt_prefix is prefix
+    assert scene.index is not index
+
+    scene.add(Character(name="Mary", description="A baker", current_location=forest))
+    assert scene.prompt_prefix.endswith("- NPCS: John the Brave, Mary")
+    assert "Mary" in scene.guided_regex(protagonist).pattern
+    assert scene.remove(Character, "Mary").name == "Mary"
+    assert scene.prompt_prefix == prefix
+
+
+def test_scene_get_action(context, locations, NPCs, protagonist, items, events):
+    llama = FakeLlama("Attack John the Brave")
+    stepper = NPCStepper(model=models.LlamaCpp(llama))  # type: ignore
+    scene = Scene(context, locations, NPCs, items, events)
+
+    action = asyncio.run(scene.get_action(stepper, protagonist))
+    assert str(action) == "Aldren: Attack John the Brave"
+    assert NPCPrompt(context, locations, NPCs, protagonist, items, events) in llama.prompts[0]
+
+    # The stepper sees the scene updated by the deltas
+    scene.remove(Character, "John the Brave")
+    scene.add(Character(name="Mary", description="A baker", current_location=locations[0]))
+    scene.append_event(
+        CharacterAction(command="Say", protagonist=protagonist, parameters=["Hello Mary"])
+    )
+    llama.reply = "Attack Mary"
+    action = asyncio.run(scene.get_action(stepper, protagonist))
+    stepper.close()
+
+    assert str(action) == "Aldren: Attack Mary"
+    assert action.parameters[0] is scene.get(Character, "Mary")
+    assert "Aldren: Say Hello Mary" in llama.prompts[1]
@@ -0,0 +1,134 @@
+import asyncio
+
+from outlines import models
+
+from gigax.fakes import FakeLlama
+from gigax.metrics import StepMetrics
+from gigax.parse import ActionStreamParser
+from gigax.scene import Character, ParameterType, SceneIndex, Skill
+from gigax.step import NPCStepper
+
+
+def get_talker(protagonist):
+    return protagonist.model_copy(
+        update={
+            "skills": protagonist.skills
+            + [
+                Skill(
+                    name="Say",
+                    description="Say something to someone",
+                    parameter_types=[ParameterType.character, ParameterType.content],
+                )
+            ]
+        }
+    )
+
+
+def stream(stepper, *args) -> list[str]:
+    async def collect():
+        return [str(action) async for action in stepper.stream_action(*args)]
+
+    return asyncio.run(collect())
+
+
+def test_action_stream_parser(locations, NPCs, protagonist, items):
+    john = NPCs[0]
+    NPCs = [
+        Character(name="John", description="A farmer", current_location=john.current_location),
+        john,
+    ]
+    scene_index = SceneIndex(NPCs, locations, items)
+    talker = get_talker(protagonist)
+
+    parser = ActionStreamParser(talker, scene_index)
+    partials = [parser.feed(char) for char in 'Say John the Brave "Hi there"']
+    assert [str(p) for p in partials if p is not None] == [
+        "Aldren: Say ",
+        "Aldren: Say John the Brave",
+        "Aldren: Say John the Brave ",  # Empty content, as soon as its quote opens
+        "Aldren: Say John the Brave H",
+        "Aldren: Say John the Brave Hi",
+        "Aldren: Say John the Brave Hi ",
+        "Aldren: Say John the Brave Hi t",
+        "Aldren: Say John the Brave Hi th",
+        "Aldren: Say John the Brave Hi the",
+        "Aldren: Say John the Brave Hi ther",
+        "Aldren: Say John the Brave Hi there",
+    ]
+    assert parser.complete
+
+    # "John" could still be the beginning of "John the Brave"
+    parser = ActionStreamParser(talker, scene_index)
+    parser.feed("Attack John")
+    assert not parser.complete
+    parser.feed(" the Brave")
+    assert parser.complete
+
+
+def test_stream_action_llamacpp(context, locations, NPCs, protagonist, items, events):
+    talker = get_talker(protagonist)
+    reply = 'Say John the Brave "Hello"'
+
+    llama = FakeLlama(reply)
+    stepper = NPCStepper(model=models.LlamaCpp(llama))  # type: ignore
+    actions = stream(stepper, context, locations, NPCs, talker, items, events)
+    stepper.close()
+
+    assert actions[0] == "Aldren: Say "
+    assert "Aldren: Say John the Brave Hell" in actions
+    assert actions[-1] == "Aldren: Say John the Brave Hello"
+
+    # Decoding stopped at the closing quote: its token was never evaluated to sample EOS
+    full_llama = FakeLlama(reply)
+    stepper = NPCStepper(model=models.LlamaCpp(full_llama))  # type: ignore
+    asyncio.run(stepper.get_action(context, locations, NPCs, talker, items, events))
+    stepper.close()
+    assert llama.evaluated == full_llama.evaluated - 1
+
+
+def test_stream_action_transformers(
+    transformers_stepper, context, locations, NPCs, protagonist, items, events
+):
+    stepper = transformers_stepper(['Say John the Brave "Hello"'])
+
+    actions = stream(stepper, context, locations, NPCs, get_talker(protagonist), items, events)
+
+    assert actions[0] == "Aldren: Say "
+    assert actions[-1] == "Aldren: Say John the Brave Hello"
+
+
+def test_stream_action_api(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    steps: list[StepMetrics] = []
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=fake_openai_server.url,
+        metrics_hooks=[steps.append],
+    )
+
+    async def collect(delay: float = 0.0):
+        actions = []
+        async for action in stepper.stream_action(
+            context, locations, NPCs, protagonist, items, events
+        ):
+            actions.append(str(action))
+            await asyncio.sleep(delay)
+        return actions
+
+    async def run():
+        actions = await collect()
+        await collect(delay=0.1)  # The caller's work is not part of the decode time
+        await stepper.aclose()
+        return actions
+
+    actions = asyncio.run(run())
+
+    assert actions == [
+        "Aldren: Attack ",
+        "Aldren: Attack John the Brave",
+        "Aldren: Attack John the Brave",
+    ]
+    assert fake_openai_server.requests[0]["stream"] is True
+    assert steps[1].phases["decode"] < 0.1
@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+from gigax.fakes import FakeOpenAIServer
+from gigax.metrics import StepMetrics
+from gigax.step import NPCStepper
+from gigax.throttle import AdaptiveConcurrencyLimiter, SingleFlight, TokenBucket
+
+
+def test_single_flight_and_token_bucket():
+    flights: SingleFlight[int] = SingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def run():
+        results = await asyncio.gather(*(flights.do("key", call) for _ in range(3)))
+        results.append(await flights.do("key", call))  # No longer in flight
+
+        bucket = TokenBucket(rate=100, burst=2)
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return results, time.monotonic() - start
+
+    results, seconds = asyncio.run(run())
+    assert results == [(42, False), (42, True), (42, True), (42, False)]
+    assert len(calls) == 2 and flights.joined == 2 and len(flights) == 0
+    # The burst is immediate, then one token every 10ms
+    assert seconds >= 0.03
+
+
+def test_single_flight_owner_cancelled():
+    flights: SingleFlight[int] = SingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def run():
+        owner = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0)
+        joiner = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        result = await joiner
+        # Once every caller gave up, the call is cancelled
+        alone = asyncio.ensure_future(flights.do("other", call))
+        await asyncio.sleep(0.01)
+        alone.cancel()
+        await asyncio.sleep(0)
+        return owner, result, alone
+
+    owner, result, alone = asyncio.run(run())
+    assert owner.cancelled() and alone.cancelled()
+    assert result == (42, True)
+    assert len(flights) == 0
+
+
+def test_adaptive_concurrency_limiter():
+    now = [0.0]
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8, clock=lambda: now[0])
+    # A burst of errors from requests started together backs off once
+    limiter.on_error(started=0.0)
+    limiter.on_error(started=0.0)
+    assert limiter.limit == 4 and limiter.errors == 2 and limiter.decreases == 1
+
+    # Additive increase: one more request per full limit of successes
+    now[0] = 1.0
+    for _ in range(4):
+        limiter.on_success(started=0.9)
+    assert limiter.capacity == 5
+    assert abs(limiter.latency - 0.1) < 1e-9
+
+    # Latency spike
+    now[0] = 2.0
+    limiter.on_success(started=1.0)
+    assert limiter.capacity == 2 and limiter.decreases == 2
+
+
+def test_stepper_single_flight(
+    fake_openai_server, context, locations, NPCs, protagonist, items, events
+):
+    fake_openai_server.delay = 0.05
+    steps: list[StepMetrics] = []
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=fake_openai_server.url,
+        api_single_flight=True,
+        metrics_hooks=[steps.append],
+    )
+
+    async def run():
+        actions = await asyncio.gather(
+            *(
+                stepper.get_action(context, locations, NPCs, protagonist, items, events)
+                for _ in range(4)
+            )
+        )
+        await stepper.aclose()
+        return actions
+
+    actions = asyncio.run(run())
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 4
+    assert len(fake_openai_server.requests) == 1
+    assert sum(m.cache_hits.get("inflight", 0) for m in steps) == 3
+    assert sum(m.generated_tokens for m in steps) > 0
+
+
+def test_stepper_adaptive_concurrency(
+    monkeypatch, context, locations, NPCs, protagonist, items, events
+):
+    monkeypatch.setattr("gigax.step.API_RETRY_BACKOFF", 0.01)
+    server = FakeOpenAIServer(reply="Attack John the Brave", delay=0.05, capacity=2).start()
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=server.url,
+        max_concurrent_requests=8,
+        adaptive_concurrency=True,
+        api_max_retries=5,
+        api_rate_limit=1000,
+        api_burst=8,
+    )
+
+    async def run():
+        actions = await asyncio.gather(
+            *(
+                stepper.get_action(
+                    context,
+                    locations,
+                    NPCs,
+                    protagonist.model_copy(update={"name": f"Villager {i}"}),
+                    items,
+                    events,
+                )
+                for i in range(8)
+            )
+        )
+        await stepper.aclose()
+        return actions
+
+    actions = asyncio.run(run())
+    server.stop()
+
+    assert len(actions) == 8
+    limiter = stepper.api_semaphore
+    assert isinstance(limiter, AdaptiveConcurrencyLimiter)
+    # The 429s of the overloaded server lowered the limit, and the rejected requests were retried
+    assert server.rejected > 0
+    assert limiter.errors == server.rejected
+    assert limiter.decreases < server.rejected
+    assert limiter.capacity < 8
+    assert len(server.requests) == 8 + server.rejected
+
+
+def test_stepper_stream_flow_control(
+    monkeypatch, context, locations, NPCs, protagonist, items, events
+):
+    monkeypatch.setattr("gigax.step.API_RETRY_BACKOFF", 0.01)
+    server = FakeOpenAIServer(reply="Attack John the Brave", delay=0.05, capacity=2).start()
+    stepper = NPCStepper(
+        model="gigax-test",
+        api_key="test",
+        api_url=server.url,
+        max_concurrent_requests=6,
+        adaptive_concurrency=True,
+        api_single_flight=True,
+        api_max_retries=5,
+    )
+
+    async def stream():
+        async for action in stepper.stream_action(
+            context, locations, NPCs, protagonist, items, events
+        ):
+            pass
+        return action
+
+    async def run():
+        actions = await asyncio.gather(*(stream() for _ in range(6)))
+        await stepper.aclose()
+        return actions
+
+    actions = asyncio.run(run())
+    server.stop()
+
+    assert [str(action) for action in actions] == ["Aldren: Attack John the Brave"] * 6
+    limiter = stepper.api_semaphore
+    assert isinstance(limiter, AdaptiveConcurrencyLimiter)
+    # Streams feed the limiter and are retried, but are never coalesced
+    assert server.rejected > 0 and limiter.errors == server.rejected
+    assert limiter.latency > 0 and limiter.capacity < 6
+    assert len(server.requests) == 6 + server.rejected